@@ -0,0 +1,19 @@
+"""shared test fixtures"""
+
+import pytest
+from app.job.job_queue import JobQueue
+from app.storage.file_index import FileIndex
+
+
+@pytest.fixture(autouse=True)
+def isolate_databases(mocker, tmp_path):
+    """point the job queue and file index at tmp_path, so that tests never
+    write databases of the working directory"""
+
+    mocker.patch(
+        "app.ocr.ocr.Ocr.ocr_progress", JobQueue(str(tmp_path / "ocr_job.db"))
+    )
+    mocker.patch(
+        "app.storage.storage.Storage.file_index",
+        FileIndex(str(tmp_path / "file_index.db")),
+    )
@@ -0,0 +1,256 @@
+"""persistent embedding cache"""
+
+import os
+import re
+import time
+import array
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from collections import Counter
+from loguru import logger
+from app.helper.sqlite import LocalConnection
+
+EMBEDDING_CACHE_DB = os.getenv("EMBEDDING_CACHE_DB", "embedding_cache.db")
+"""SQLite database file path of embedding cache, empty to disable cache"""
+
+EMBEDDING_CACHE_MAX_ITEMS = int(
+    os.getenv("EMBEDDING_CACHE_MAX_ITEMS", "100000")
+)
+"""max vectors in cache, least recently used vectors are evicted"""
+
+EMBEDDING_CACHE_TOUCH_INTERVAL = float(
+    os.getenv("EMBEDDING_CACHE_TOUCH_INTERVAL", "10")
+)
+"""
+Seconds between writes of last used time and hit/miss stats of lookups,
+lookups only read the database, their updates are kept in memory until
+then or the next put
+"""
+
+
+class EmbeddingCache:
+    """Content-addressed embedding cache shared across documents
+
+    Vector is keyed by hash of model id and normalized content,
+    saved in SQLite, shared by api and worker processes.
+    Lookups take no write lock, vector count is tracked in stats table
+    instead of counted on each put.
+    """
+
+    def __init__(
+        self,
+        db_path: str = EMBEDDING_CACHE_DB,
+        max_items: int = EMBEDDING_CACHE_MAX_ITEMS,
+        touch_interval: float = EMBEDDING_CACHE_TOUCH_INTERVAL,
+    ) -> None:
+        """init cache, database is connected lazily
+
+        Args:
+            db_path (str, optional): SQLite database file path.
+            Defaults to EMBEDDING_CACHE_DB.
+            max_items (int, optional): max vectors in cache.
+            Defaults to EMBEDDING_CACHE_MAX_ITEMS.
+            touch_interval (float, optional): seconds between writes of
+            lookups. Defaults to EMBEDDING_CACHE_TOUCH_INTERVAL.
+        """
+
+        self._max_items = max(1, max_items)
+        self._touch_interval = touch_interval
+        self._db = LocalConnection(db_path, self._init_db)
+
+        # last used time of keys and stats of lookups not written yet
+        self._lock = threading.Lock()
+        self._touched: dict[str, float] = {}
+        self._lookups: Counter[str] = Counter()
+        self._written_at = time.monotonic()
+
+    def _conn(self) -> sqlite3.Connection:
+        return self._db.get()
+
+    def _init_db(self, conn: sqlite3.Connection) -> None:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS stats ("
+                " name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+            )
+            # float64 vectors of the previous format are dropped,
+            # vectors are float32 the same as vector db
+            if conn.execute(
+                "SELECT 1 FROM sqlite_master"
+                " WHERE type = 'table' AND name = 'embedding'"
+            ).fetchone():
+                conn.execute("DROP TABLE embedding")
+                conn.execute("DELETE FROM stats WHERE name = 'size'")
+                logger.info("drop float64 vectors of embedding cache")
+
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embedding_f32 ("
+                " key TEXT PRIMARY KEY, vector BLOB NOT NULL,"
+                " last_used REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS embedding_f32_last_used"
+                " ON embedding_f32 (last_used)"
+            )
+            conn.execute(
+                "INSERT OR IGNORE INTO stats (name, value)"
+                " VALUES ('hits', 0), ('misses', 0)"
+            )
+            # counted once for cache created before size is tracked
+            conn.execute(
+                "INSERT OR IGNORE INTO stats (name, value)"
+                " SELECT 'size', COUNT(*) FROM embedding_f32"
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    @classmethod
+    def key(cls, model: str, content: str) -> str:
+        """return cache key of content embedding with model
+
+        Content is normalized with NFKC and whitespace collapsed,
+        so that the same paragraph from different OCR results share vector
+        """
+
+        normalized = unicodedata.normalize("NFKC", content)
+        normalized = re.sub(r"\s+", " ", normalized).strip()
+        return hashlib.sha256(
+            f"{model}\0{normalized}".encode("utf-8")
+        ).hexdigest()
+
+    def get_many(
+        self, model: str, content_list: list[str]
+    ) -> list[list[float] | None]:
+        """get vectors of content list
+
+        Returns:
+            list[list[float] | None]: vector list, same order as content_list,
+            None if not in cache
+        """
+
+        if len(content_list) == 0:
+            return []
+
+        keys = [EmbeddingCache.key(model, content) for content in content_list]
+        conn = self._conn()
+        rows = conn.execute(
+            "SELECT key, vector FROM embedding_f32 WHERE key IN"
+            f" ({', '.join('?' * len(keys))})",
+            keys,
+        ).fetchall()
+        found = {key: array.array("f", vector).tolist() for key, vector in rows}
+
+        hits = len([key for key in keys if key in found])
+        now = time.time()
+        with self._lock:
+            for key in found:
+                self._touched[key] = now
+            self._lookups.update(hits=hits, misses=len(keys) - hits)
+            due = time.monotonic() - self._written_at >= self._touch_interval
+        if due:
+            self.flush()
+
+        return [found.get(key) for key in keys]
+
+    def flush(self) -> None:
+        """write last used time and stats of lookups kept in memory"""
+
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._write_touched(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _write_touched(self, conn: sqlite3.Connection) -> None:
+        """write lookups kept in memory, in transaction"""
+
+        with self._lock:
+            touched, lookups = self._touched, self._lookups
+            self._touched, self._lookups = {}, Counter()
+            self._written_at = time.monotonic()
+
+        # lookups of other processes may be written before
+        conn.executemany(
+            "UPDATE embedding_f32 SET last_used = MAX(last_used, ?) WHERE key = ?",
+            [(last_used, key) for key, last_used in touched.items()],
+        )
+        conn.executemany(
+            "UPDATE stats SET value = value + ? WHERE name = ?",
+            [(value, name) for name, value in lookups.items()],
+        )
+
+    def put_many(
+        self,
+        model: str,
+        content_list: list[str],
+        vec_list: list[list[float]],
+    ) -> None:
+        """save vectors of content list, evict least recently used vectors
+        if cache is full"""
+
+        if len(content_list) == 0:
+            return
+
+        now = time.time()
+        vectors = {
+            EmbeddingCache.key(model, content): array.array("f", vec).tobytes()
+            for content, vec in zip(content_list, vec_list)
+        }
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # recently used vectors are not evicted
+            self._write_touched(conn)
+            (existed,) = conn.execute(
+                "SELECT COUNT(*) FROM embedding_f32 WHERE key IN"
+                f" ({', '.join('?' * len(vectors))})",
+                list(vectors),
+            ).fetchone()
+            conn.executemany(
+                "INSERT OR REPLACE INTO embedding_f32 (key, vector, last_used)"
+                " VALUES (?, ?, ?)",
+                [(key, vector, now) for key, vector in vectors.items()],
+            )
+            conn.execute(
+                "UPDATE stats SET value = value + ? WHERE name = 'size'",
+                (len(vectors) - existed,),
+            )
+            (count,) = conn.execute(
+                "SELECT value FROM stats WHERE name = 'size'"
+            ).fetchone()
+            evict = count - self._max_items
+            if evict > 0:
+                conn.execute(
+                    "DELETE FROM embedding_f32 WHERE key IN (SELECT key"
+                    " FROM embedding_f32 ORDER BY last_used LIMIT ?)",
+                    (evict,),
+                )
+                conn.execute(
+                    "UPDATE stats SET value = value - ? WHERE name = 'size'",
+                    (evict,),
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        if evict > 0:
+            logger.info(f"evict {evict} vectors from embedding cache")
+
+    def stats(self) -> dict:
+        """return hits, misses and size of cache"""
+
+        self.flush()
+        result = dict(
+            self._conn().execute("SELECT name, value FROM stats").fetchall()
+        )
+        result["max_items"] = self._max_items
+        return result
@@ -1,12 +1,14 @@
 """Embedding operations"""
 
 import os
+from typing import Callable
 from loguru import logger
 from tencentcloud.common.exception.tencent_cloud_sdk_exception import (
     TencentCloudSDKException,
 )
 from tencentcloud.hunyuan.v20230901 import models
 from app.client.hunyuan_client import new_hunyuan_client
+from app.embedding.cache import EmbeddingCache, EMBEDDING_CACHE_DB
 from app.exceptions.exceptions import InvalidResponseFromUpStream
 
 
@@ -21,6 +23,21 @@ class Embedding:
     ref: https://cloud.tencent.com/document/api/1729/102832
     """
 
+    EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "20"))
+    """
+    Max content count of one embedding request, InputList can not over 200
+
+    ref: https://cloud.tencent.com/document/api/1729/102832
+    """
+
+    EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "hunyuan-embedding")
+    """model id of embedding, part of the embedding cache key"""
+
+    cache: EmbeddingCache | None = (
+        EmbeddingCache() if EMBEDDING_CACHE_DB else None
+    )
+    """embedding cache shared across documents, None if disabled"""
+
     def __init__(self) -> None:
         self._client = new_hunyuan_client()
 
@@ -72,3 +89,119 @@ class Embedding:
         except TencentCloudSDKException as e:
             logger.error(f"GetEmbedding failed, e: {e}")
             raise e
+
+    def embedding_list(self, content_list: list[str]) -> list[list[float]]:
+        """embedding content list in one request
+
+        Args:
+            content_list (list[str]): Embedding content list, each content
+            need less or equal than 1024 Token, list len need less or equal
+            than EMBEDDING_BATCH_SIZE
+
+        Returns:
+            list[list[float]]: vector list, same order as content_list
+        """
+
+        if len(content_list) == 0:
+            return []
+
+        if len(content_list) > Embedding.EMBEDDING_BATCH_SIZE:
+            msg = (
+                f"content_list len {len(content_list)} over"
+                f" EMBEDDING_BATCH_SIZE {Embedding.EMBEDDING_BATCH_SIZE}"
+            )
+            logger.error(msg)
+            raise ValueError(msg)
+
+        try:
+            req = models.GetEmbeddingRequest()
+            req.InputList = content_list
+
+            rsp = self._client.GetEmbedding(req)
+            if not isinstance(rsp.Data, list):
+                msg = f"GetEmbedding rsp data is not list, {rsp.Data}"
+                logger.error(msg)
+                raise TypeError(msg)
+            if len(rsp.Data) != len(content_list):
+                msg = (
+                    f"GetEmbedding rsp data len {len(rsp.Data)} not equal"
+                    f" to content_list len {len(content_list)}"
+                )
+                logger.error(msg)
+                raise InvalidResponseFromUpStream(msg)
+
+            logger.info(
+                f"GetEmbedding success, content_list len: {len(content_list)},"
+                f" Usage: {rsp.Usage}, RequestId: {rsp.RequestId}"
+            )
+
+            # Index is the position of content in InputList
+            data_list: list[models.EmbeddingData]
+            data_list = sorted(rsp.Data, key=lambda data: data.Index or 0)
+
+            vec_list: list[list[float]] = []
+            for data in data_list:
+                if not data.Embedding:
+                    msg = "GetEmbedding Embedding vector is empty"
+                    logger.error(msg)
+                    raise InvalidResponseFromUpStream(msg)
+                vec_list.append(data.Embedding)
+
+            return vec_list
+        except TencentCloudSDKException as e:
+            logger.error(f"GetEmbedding failed, e: {e}")
+            raise e
+
+    def embedding_cached(self, content: str) -> list[float]:
+        """embedding content, use vector in cache if existed
+
+        Args:
+            content (str): Embedding content, need less or equal than 1024 Token
+
+        Returns:
+            list[float]: vector
+        """
+
+        return self.embedding_list_cached([content], self.embedding)[0]
+
+    def embedding_list_cached(
+        self,
+        content_list: list[str],
+        embedding_func: Callable[[str], list[float]] | None = None,
+    ) -> list[list[float]]:
+        """embedding content list, only contents not in cache are embedded
+
+        Args:
+            content_list (list[str]): see embedding_list
+            embedding_func (Callable, optional): embedding one content,
+            use embedding_list for all missed contents if None.
+            Defaults to None.
+
+        Returns:
+            list[list[float]]: vector list, same order as content_list
+        """
+
+        cache = Embedding.cache
+        if cache is None:
+            if embedding_func is not None:
+                return [embedding_func(content) for content in content_list]
+            return self.embedding_list(content_list)
+
+        model = Embedding.EMBEDDING_MODEL
+        vec_list = cache.get_many(model, content_list)
+        miss_index_list = [i for i, vec in enumerate(vec_list) if vec is None]
+        if len(miss_index_list) == 0:
+            return vec_list
+
+        miss_content_list = [content_list[i] for i in miss_index_list]
+        if embedding_func is not None:
+            miss_vec_list = [
+                embedding_func(content) for content in miss_content_list
+            ]
+        else:
+            miss_vec_list = self.embedding_list(miss_content_list)
+        cache.put_many(model, miss_content_list, miss_vec_list)
+
+        for i, vec in zip(miss_index_list, miss_vec_list):
+            vec_list[i] = vec
+        return vec_list
@@ -1,8 +1,11 @@
 """test embedding"""
 
 import json
+import sqlite3
 from tencentcloud.hunyuan.v20230901 import models
 from .embedding import Embedding
+from .worker_pool import EmbeddingWorkerPool
+from .cache import EmbeddingCache, EMBEDDING_CACHE_MAX_ITEMS
 
 
 # pylint: disable=duplicate-code
@@ -30,3 +33,182 @@ def test_embedding(mocker):
 
     em = Embedding()
     assert em.embedding("hello") == rsp_dict["Data"][0]["Embedding"]
+
+
+# pylint: disable=duplicate-code
+def test_embedding_list(mocker):
+    """test embedding list"""
+
+    with open(
+        "embedding/embedding_rsp_example.json", "r", encoding="utf-8"
+    ) as f:
+        rsp_dict = json.load(f)
+
+    # response data may not in the order of InputList
+    vec = rsp_dict["Data"][0]["Embedding"]
+    rsp_dict["Data"] = [
+        {"Embedding": vec[::-1], "Index": 1, "Object": "embedding"},
+        {"Embedding": vec, "Index": 0, "Object": "embedding"},
+    ]
+    rsp = models.GetEmbeddingResponse()
+    rsp.from_json_string(json.dumps(rsp_dict))
+
+    mocker.patch(
+        "tencentcloud.common.credential.Credential.__init__",
+        return_value=None,
+    )
+    mocker.patch(
+        "tencentcloud.hunyuan.v20230901.hunyuan_client"
+        ".HunyuanClient.GetEmbedding",
+        return_value=rsp,
+    )
+
+    em = Embedding()
+    assert not em.embedding_list([])
+    assert em.embedding_list(["hello", "world"]) == [vec, vec[::-1]]
+
+
+def test_embedding_worker_pool(mocker, tmp_path):
+    """test embedding worker pool keep order and record failed content"""
+
+    def _embedding(content: str) -> list[float]:
+        if content == "bad":
+            raise ValueError("bad content")
+        return [float(content)]
+
+    def _embedding_list(content_list: list[str]) -> list[list[float]]:
+        return [_embedding(content) for content in content_list]
+
+    mocker.patch(
+        "tencentcloud.common.credential.Credential.__init__",
+        return_value=None,
+    )
+    mocker.patch(
+        "app.embedding.embedding.Embedding.embedding", side_effect=_embedding
+    )
+    mocker.patch(
+        "app.embedding.embedding.Embedding.embedding_list",
+        side_effect=_embedding_list,
+    )
+    mocker.patch("app.helper.retry.time.sleep")
+    mocker.patch(
+        "app.embedding.embedding.Embedding.cache",
+        EmbeddingCache(str(tmp_path / "cache.db")),
+    )
+
+    content_list = [str(i) for i in range(10)]
+    content_list[7] = "bad"
+
+    pool = EmbeddingWorkerPool(concurrency=3, batch_size=3)
+    result: list = []
+    for start, vec_list in pool.iter_embedding(content_list):
+        assert start == len(result)
+        result.extend(vec_list)
+
+    expected: list = [[float(i)] for i in range(10)]
+    expected[7] = None
+    assert result == expected
+    assert pool.failed_index_list == [7]
+
+    content_list[7] = "7"
+    assert pool.retry_failed(content_list) == {7: [7.0]}
+    assert not pool.failed_index_list
+
+
+def test_embedding_cache(tmp_path):
+    """test embedding cache hit, miss and eviction"""
+
+    cache = EmbeddingCache(str(tmp_path / "cache.db"), max_items=2)
+    cache.put_many("m1", ["第一条 ", "第二条"], [[0.5, 0.25], [0.75, 0.125]])
+
+    # content is normalized, model is part of key
+    assert cache.get_many("m1", ["第一条", " 第二条", "第三条"]) == [
+        [0.5, 0.25],
+        [0.75, 0.125],
+        None,
+    ]
+    assert cache.get_many("m2", ["第一条"]) == [None]
+
+    # 第二条 is least recently used
+    cache.get_many("m1", ["第一条"])
+    cache.put_many("m1", ["第三条"], [[1.5, 2.5]])
+    assert cache.get_many("m1", ["第二条"]) == [None]
+
+    stats = cache.stats()
+    assert stats["hits"] == 3
+    assert stats["misses"] == 3
+    assert stats["size"] == 2
+
+
+def test_embedding_cache_lookup_read_only(tmp_path):
+    """test lookups are written lazily, put keeps size without counting"""
+
+    cache = EmbeddingCache(
+        str(tmp_path / "cache.db"), max_items=3, touch_interval=3600
+    )
+    cache.put_many("m1", ["a", "b", "c"], [[0.5], [0.25], [0.75]])
+    # replaced vector is counted once
+    cache.put_many("m1", ["a", "a"], [[0.5], [0.5]])
+
+    # lookups are kept in memory
+    other = EmbeddingCache(str(tmp_path / "cache.db"))
+    assert cache.get_many("m1", ["b", "x"]) == [[0.25], None]
+    assert other.stats()["hits"] == 0
+
+    # put writes lookups before eviction, c is least recently used
+    cache.put_many("m1", ["d"], [[0.125]])
+    assert cache.get_many("m1", ["c"]) == [None]
+    assert other.stats() == {
+        "hits": 1,
+        "misses": 1,
+        "size": 3,
+        "max_items": EMBEDDING_CACHE_MAX_ITEMS,
+    }
+
+
+def test_embedding_cache_float64_dropped(tmp_path):
+    """test float64 vectors of the previous format are dropped,
+    vectors are saved as float32"""
+
+    db_path = str(tmp_path / "cache.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute(
+        "CREATE TABLE embedding (key TEXT PRIMARY KEY, vector BLOB NOT NULL,"
+        " last_used REAL NOT NULL)"
+    )
+    conn.execute("INSERT INTO embedding VALUES ('k', x'00', 0)")
+    conn.commit()
+    conn.close()
+
+    cache = EmbeddingCache(db_path)
+    assert cache.stats()["size"] == 0
+    cache.put_many("m1", ["a"], [[0.5, 0.25]])
+    assert cache.get_many("m1", ["a"]) == [[0.5, 0.25]]
+    conn = sqlite3.connect(db_path)
+    (size,) = conn.execute(
+        "SELECT LENGTH(vector) FROM embedding_f32"
+    ).fetchone()
+    conn.close()
+    assert size == 8
+
+
+def test_embedding_list_cached(mocker, tmp_path):
+    """test only contents not in cache are embedded"""
+
+    mocker.patch(
+        "tencentcloud.common.credential.Credential.__init__",
+        return_value=None,
+    )
+    embedding_list = mocker.patch(
+        "app.embedding.embedding.Embedding.embedding_list",
+        side_effect=lambda content_list: [[1.0] for _ in content_list],
+    )
+    mocker.patch(
+        "app.embedding.embedding.Embedding.cache",
+        EmbeddingCache(str(tmp_path / "cache.db")),
+    )
+
+    em = Embedding()
+    assert em.embedding_list_cached(["a", "b"]) == [[1.0], [1.0]]
+    assert em.embedding_list_cached(["b", "c"]) == [[1.0], [1.0]]
+    assert embedding_list.call_args_list[1].args[0] == ["c"]
@@ -0,0 +1,176 @@
+"""Embedding worker pool"""
+
+import os
+import threading
+from typing import Iterator
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from loguru import logger
+from app.embedding.embedding import Embedding
+from app.helper.retry import retry
+
+
+class EmbeddingWorkerPool:
+    """Embedding content list with bounded concurrency
+
+    Content list is divided into batches, batches are embedded in
+    worker threads, results are returned in content order.
+    If a batch failed, its contents will be embedded one by one,
+    contents still failed are recorded in failed_index_list
+    """
+
+    EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "4"))
+    """
+    Max concurrent embedding requests, should be set according to
+    the rate limit of embedding provider
+    """
+
+    def __init__(
+        self,
+        concurrency: int = EMBEDDING_CONCURRENCY,
+        batch_size: int = Embedding.EMBEDDING_BATCH_SIZE,
+    ) -> None:
+        """init worker pool
+
+        Args:
+            concurrency (int, optional): max concurrent embedding requests.
+            Defaults to EMBEDDING_CONCURRENCY.
+            batch_size (int, optional): content count of one embedding request.
+            Defaults to Embedding.EMBEDDING_BATCH_SIZE.
+        """
+
+        self.concurrency = max(1, concurrency)
+        self.batch_size = max(1, batch_size)
+        self.max_pending_batches = self.concurrency * 2
+        """max batches embedding or waiting for consumer"""
+        self.failed_index_list: list[int] = []
+        """index of contents failed to embedding"""
+        self._queue_depth = 0
+
+        # embedding client is not shared between threads
+        self._local = threading.local()
+
+    @property
+    def queue_depth(self) -> int:
+        """batches embedding or waiting for consumer"""
+
+        return self._queue_depth
+
+    def _embedding(self) -> Embedding:
+        em = getattr(self._local, "embedding", None)
+        if em is None:
+            em = Embedding()
+            self._local.embedding = em
+        return em
+
+    # pylint: disable=broad-exception-caught
+    def _embedding_batch(
+        self, start: int, content_list: list[str]
+    ) -> list[list[float] | None]:
+        em = self._embedding()
+        try:
+            return retry(em.embedding_list_cached, content_list)
+        except Exception as e:
+            logger.warning(
+                f"embedding batch failed, start: {start}"
+                f", len: {len(content_list)}, embedding one by one, e: {e}"
+            )
+
+        vec_list: list[list[float] | None] = []
+        for offset, content in enumerate(content_list):
+            try:
+                vec_list.append(retry(em.embedding_cached, content))
+            except Exception as e:
+                logger.error(
+                    f"embedding content failed, index: {start + offset}"
+                    f", e: {e}"
+                )
+                vec_list.append(None)
+        return vec_list
+
+    def iter_embedding(
+        self, content_list: list[str]
+    ) -> Iterator[tuple[int, list[list[float] | None]]]:
+        """embedding content list concurrently, yield batch result in order
+
+        Args:
+            content_list (list[str]): embedding content list
+
+        Yields:
+            tuple[int, list[list[float] | None]]: start index of the batch
+            in content_list, and vector list of the batch, vector is None
+            if the content failed to embedding
+        """
+
+        self.failed_index_list = []
+        with ThreadPoolExecutor(
+            max_workers=self.concurrency,
+            thread_name_prefix="embedding",
+        ) as executor:
+            # submit batches ahead of consumer, but no more than
+            # max_pending_batches, consumer is the next stage (upsert)
+            futures: deque[tuple[int, Future]] = deque()
+            starts = iter(range(0, len(content_list), self.batch_size))
+            for start in starts:
+                batch = content_list[start : start + self.batch_size]
+                futures.append(
+                    (
+                        start,
+                        executor.submit(self._embedding_batch, start, batch),
+                    )
+                )
+                if len(futures) >= self.max_pending_batches:
+                    break
+
+            while len(futures) > 0:
+                start, future = futures.popleft()
+                vec_list = future.result()
+
+                next_start = next(starts, None)
+                if next_start is not None:
+                    batch = content_list[
+                        next_start : next_start + self.batch_size
+                    ]
+                    futures.append(
+                        (
+                            next_start,
+                            executor.submit(
+                                self._embedding_batch, next_start, batch
+                            ),
+                        )
+                    )
+                self._queue_depth = len(futures)
+
+                for offset, vec in enumerate(vec_list):
+                    if vec is None:
+                        self.failed_index_list.append(start + offset)
+                yield start, vec_list
+
+            self._queue_depth = 0
+
+    def retry_failed(self, content_list: list[str]) -> dict[int, list[float]]:
+        """embedding failed contents again
+
+        Args:
+            content_list (list[str]): the content list passed to iter_embedding
+
+        Returns:
+            dict[int, list[float]]: vector of contents embedding success this
+            time, key is index in content_list, failed_index_list will only
+            contain index still failed
+        """
+
+        index_list = self.failed_index_list
+        retry_content_list = [content_list[index] for index in index_list]
+
+        vec_dict: dict[int, list[float]] = {}
+        for start, vec_list in self.iter_embedding(retry_content_list):
+            for offset, vec in enumerate(vec_list):
+                if vec is not None:
+                    vec_dict[index_list[start + offset]] = vec
+
+        # map back to index in content_list
+        self.failed_index_list = [
+            index_list[index] for index in self.failed_index_list
+        ]
+        return vec_dict
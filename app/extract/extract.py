@@ -1,11 +1,15 @@
 """generate answer from query"""
 
 import os
+import time
+import asyncio
 from loguru import logger
 from app.embedding.embedding import Embedding
 from app.vectordb.vectordb import VDB
-from app.helper.token import num_tokens
+from app.storage.storage import Storage
+from app.helper.token import num_tokens_many
 from app.chat import openai, hunyuan
+from app.extract import postprocess
 from app.model.payload import API_HUNYUAN
 
 
@@ -42,36 +46,80 @@ class Extract:
     The token of model input = max token - output token
     """
 
+    EXTRACT_CONCURRENCY = int(os.getenv("EXTRACT_CONCURRENCY", "8"))
+    """max chat completions in flight of a batch"""
+
+    EXTRACT_KEYWORD_SEARCH = int(os.getenv("EXTRACT_KEYWORD_SEARCH", "1"))
+    """
+    Fuse keyword search results of query with vector search results,
+    set to 0 to use vector search results only
+    """
+
+    EXTRACT_TOP_K = int(os.getenv("EXTRACT_TOP_K", "10"))
+    """relevant texts searched of a query, and max after fusion"""
+
+    EXTRACT_READ_CONSISTENCY = os.getenv(
+        "EXTRACT_READ_CONSISTENCY", VDB.CONSISTENCY_EVENTUAL
+    )
+    """
+    Read consistency of vector search of a file ingested over
+    EXTRACT_STRONG_READ_SECONDS ago, strong or eventual
+    """
+
+    EXTRACT_STRONG_READ_SECONDS = float(
+        os.getenv("EXTRACT_STRONG_READ_SECONDS", "60")
+    )
+    """
+    Seconds after ingestion of a file completed that its vector search is
+    strong consistent, replicas may not have the latest documents yet.
+    Files not marked ready are always searched with strong consistency
+    """
+
+    RRF_K = 60
+    """
+    Constant of reciprocal rank fusion, score of a text is the sum of
+    1 / (RRF_K + rank) of each result list, a larger constant lowers
+    the weight of top ranks
+    """
+
     def __init__(self) -> None:
         pass
 
-    def generate_answer(self, query: str, file_id: str, api: str) -> str:
+    # pylint: disable-next=too-many-arguments,too-many-positional-arguments
+    def generate_answer(
+        self, query: str, file_id: str, api: str, top_k: int = 0, ef: int = 0
+    ) -> str:
         """generate answer from query using GPT and relevant texts search from
         vector database which relevanted to the file_id
 
         Args:
             query (str): query
+            top_k (int, optional): relevant texts, EXTRACT_TOP_K if 0.
+            Defaults to 0.
+            ef (int, optional): candidates examined by vector search,
+            VDB.VDB_SEARCH_EF if 0. Defaults to 0.
 
         Returns:
             str: answer
         """
 
-        # check vector databse document of file_id existed
-        vdb = VDB.default_vdb()
-        if not vdb.is_collection_existed(file_id):
-            msg = f"{file_id} fild_id of ducument not existed"
-            logger.error(msg)
-            raise ValueError(msg)
-
-        # document of file_id existed, set to collection
-        vdb.collection = file_id
+        vdb = self._get_vdb(file_id)
+        top_k = top_k or Extract.EXTRACT_TOP_K
 
         # embedding query text into vector using embedding model
         em = Embedding()
-        vec = em.embedding(query)
+        vec = em.embedding_cached(query)
 
         # search query text vector in vector database using file_id
-        relevanted_list = vdb.search(vec)
+        relevanted_list = vdb.search(
+            vec,
+            top_k=postprocess.get_fetch_k(top_k),
+            retrieve_vector=bool(postprocess.EXTRACT_MMR),
+            ef=ef,
+        )
+        relevanted_list = self._postprocess(
+            vdb, query, vec, relevanted_list, top_k
+        )
         if len(relevanted_list) == 0:
             return Extract.ANSWER_NOT_FOUND
 
@@ -84,6 +132,192 @@ class Extract:
 
         return answer
 
+    async def generate_answer_batch(
+        self, queries: list[str], file_id: str, api: str
+    ) -> list[str]:
+        """generate answers of queries on the same file, queries are embedded
+        together and searched in one vector database call, chat completions
+        run concurrently up to EXTRACT_CONCURRENCY
+
+        Args:
+            queries (list[str]): queries
+            file_id (str): file id
+            api (str): call api with API_OPENAI or API_HUNYUAN
+
+        Returns:
+            list[str]: answer of each query in the same order
+        """
+
+        vdb = await asyncio.to_thread(self._get_vdb, file_id)
+        relevanted_lists = await asyncio.to_thread(
+            self._search_batch, vdb, queries
+        )
+
+        semaphore = asyncio.Semaphore(Extract.EXTRACT_CONCURRENCY)
+
+        async def answer(query: str, relevanted_list: list[dict]) -> str:
+            if len(relevanted_list) == 0:
+                return Extract.ANSWER_NOT_FOUND
+
+            async with semaphore:
+                return await asyncio.to_thread(
+                    self.ask,
+                    query=query,
+                    relevanted_list=relevanted_list,
+                    api=api,
+                )
+
+        return list(
+            await asyncio.gather(
+                *(
+                    answer(query, relevanted_list)
+                    for query, relevanted_list in zip(queries, relevanted_lists)
+                )
+            )
+        )
+
+    def _get_vdb(self, file_id: str):
+        """return vector db of file_id collection
+
+        Raises:
+            ValueError: if document of file_id not existed
+        """
+
+        # file with the same content use the same vector collection
+        file_id = Storage.file_index.resolve(file_id)
+
+        # check vector databse document of file_id existed
+        vdb = VDB.default_vdb(consistency=self._get_consistency(file_id))
+        if not vdb.is_collection_existed(file_id):
+            msg = f"{file_id} fild_id of ducument not existed"
+            logger.error(msg)
+            raise ValueError(msg)
+
+        # document of file_id existed, set to collection
+        vdb.collection = file_id
+        return vdb
+
+    def _get_consistency(self, file_id: str) -> str:
+        """return read consistency of vector search of file_id,
+        strong right after its ingestion completed"""
+
+        ready_at = Storage.file_index.get_ready_at(file_id)
+        if (
+            ready_at is None
+            or time.time() - ready_at < Extract.EXTRACT_STRONG_READ_SECONDS
+        ):
+            return VDB.CONSISTENCY_STRONG
+
+        return Extract.EXTRACT_READ_CONSISTENCY
+
+    def _search_batch(self, vdb, queries: list[str]) -> list[list[dict]]:
+        """embed queries by EMBEDDING_BATCH_SIZE a request,
+        then search all vectors in one call"""
+
+        em = Embedding()
+        vec_list: list[list[float]] = []
+        for i in range(0, len(queries), Embedding.EMBEDDING_BATCH_SIZE):
+            vec_list.extend(
+                em.embedding_list_cached(
+                    queries[i : i + Embedding.EMBEDDING_BATCH_SIZE]
+                )
+            )
+
+        relevanted_lists = vdb.search_batch(
+            vec_list,
+            postprocess.get_fetch_k(Extract.EXTRACT_TOP_K),
+            bool(postprocess.EXTRACT_MMR),
+        )
+        logger.info(f"search batch success, queries: {len(queries)}")
+        return [
+            self._postprocess(
+                vdb, query, vec, relevanted_list, Extract.EXTRACT_TOP_K
+            )
+            for query, vec, relevanted_list in zip(
+                queries, vec_list, relevanted_lists
+            )
+        ]
+
+    # pylint: disable-next=too-many-arguments,too-many-positional-arguments
+    def _postprocess(
+        self,
+        vdb,
+        query: str,
+        vec: list[float],
+        relevanted_list: list[dict],
+        top_k: int,
+    ) -> list[dict]:
+        """fuse vector search results with keyword search results,
+        diversify them by maximal marginal relevance, then re-rank,
+        top_k at most"""
+
+        if not postprocess.EXTRACT_MMR:
+            relevanted_list = self._fuse_keyword(
+                vdb, query, relevanted_list, top_k
+            )
+            return postprocess.rerank(query, relevanted_list)
+
+        relevanted_list = self._fuse_keyword(
+            vdb, query, relevanted_list, postprocess.get_fetch_k(top_k)
+        )
+        # keyword search results have no vector
+        missing = [doc["id"] for doc in relevanted_list if "vector" not in doc]
+        if missing:
+            vectors = vdb.get_vectors(missing)
+            relevanted_list = [
+                (
+                    doc
+                    if doc["id"] not in vectors
+                    else {**doc, "vector": vectors[doc["id"]]}
+                )
+                for doc in relevanted_list
+            ]
+        relevanted_list = postprocess.mmr(vec, relevanted_list, top_k)
+        return postprocess.rerank(query, relevanted_list)
+
+    def _fuse_keyword(
+        self, vdb, query: str, relevanted_list: list[dict], top_k: int
+    ) -> list[dict]:
+        """fuse keyword search results of query in the collection of vdb
+        with its vector search results, top_k at most"""
+
+        if not Extract.EXTRACT_KEYWORD_SEARCH:
+            return relevanted_list
+
+        keyword_list = Storage.keyword_index.search(
+            vdb.collection, query, top_k
+        )
+        return Extract.fuse_rrf([relevanted_list, keyword_list], top_k)
+
+    @classmethod
+    def fuse_rrf(cls, ranked_lists: list[list[dict]], top_k: int) -> list[dict]:
+        """fuse ranked lists by reciprocal rank fusion
+
+        Args:
+            ranked_lists (list[list[dict]]): lists of texts with id,
+            best first
+            top_k (int): max texts
+
+        Returns:
+            list[dict]: texts ranked by fused score, best first, text in
+            more than one list is the item of the first list, with score
+            replaced by fused score
+        """
+
+        scores: dict[str, float] = {}
+        items: dict[str, dict] = {}
+        for ranked_list in ranked_lists:
+            for rank, item in enumerate(ranked_list, 1):
+                doc_id = item["id"]
+                scores[doc_id] = scores.get(doc_id, 0.0) + 1 / (
+                    Extract.RRF_K + rank
+                )
+                items.setdefault(doc_id, item)
+
+        # sort is stable, ties keep the order of the first list
+        best = sorted(scores, key=lambda d: -scores[d])[:top_k]
+        return [{**items[doc_id], "score": scores[doc_id]} for doc_id in best]
+
     def query_message(
         self,
         query: str,
@@ -101,20 +335,28 @@ class Extract:
             str: a message for GPT, with relevant source texts
         """
 
-        strings: list[str] = []
-        for relevanted in relevanted_list:
-            strings.append(relevanted["content"])
-
         introduction = Extract.ASK_INTRODUCTION
         question = f"\n\nQuestion: {query}"
-        message = introduction
-        for string in strings:
-            next_article = f'\n\nparagraph section:\n"""\n{string}\n"""'
-            if num_tokens(message + next_article + question) > token_budget:
+        articles: list[str] = []
+        for relevanted in relevanted_list:
+            articles.append(
+                f'\n\nparagraph section:\n"""\n{relevanted["content"]}\n"""'
+            )
+
+        # count tokens of each part once, instead of the whole message
+        # for every article
+        counts = num_tokens_many([introduction, question, *articles])
+        message_tokens = counts[0] + counts[1]
+        message = [introduction]
+        for next_article, article_tokens in zip(articles, counts[2:]):
+            if message_tokens + article_tokens > token_budget:
                 break
 
-            message += next_article
-        return message + question
+            message.append(next_article)
+            message_tokens += article_tokens
+
+        message.append(question)
+        return "".join(message)
 
     def ask(
         self,
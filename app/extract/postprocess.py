@@ -0,0 +1,135 @@
+"""post-retrieval stage between vector search and query message
+
+Search results in similarity order often have near-duplicate chunks,
+which use up the token budget of the query message with the same
+evidence. Results are diversified by maximal marginal relevance on their
+vectors, then optionally re-ranked by a local reranker of RERANKERS.
+"""
+
+import os
+from typing import Callable
+import numpy as np
+from loguru import logger
+from app.storage.keyword_index import get_grams
+
+EXTRACT_MMR = int(os.getenv("EXTRACT_MMR", "0"))
+"""
+Set to 1 to select search results by maximal marginal relevance,
+candidates are searched with their vectors, more payload and latency
+"""
+
+EXTRACT_MMR_FETCH_FACTOR = int(os.getenv("EXTRACT_MMR_FETCH_FACTOR", "2"))
+"""candidates of maximal marginal relevance are top_k * it"""
+
+EXTRACT_MMR_LAMBDA = float(os.getenv("EXTRACT_MMR_LAMBDA", "0.7"))
+"""
+Weight of relevance to query against similarity to selected results,
+1 for similarity order, 0 for the most diverse
+"""
+
+EXTRACT_RERANKER = os.getenv("EXTRACT_RERANKER", "")
+"""reranker of RERANKERS after fusion, empty for none,
+checked by check_reranker at startup"""
+
+
+def get_fetch_k(top_k: int) -> int:
+    """return candidates to search for top_k results"""
+
+    if not EXTRACT_MMR:
+        return top_k
+
+    return top_k * max(1, EXTRACT_MMR_FETCH_FACTOR)
+
+
+def _without_vector(doc: dict) -> dict:
+    return {k: v for k, v in doc.items() if k != "vector"}
+
+
+def mmr(
+    query_vector: list[float], relevanted_list: list[dict], top_k: int
+) -> list[dict]:
+    """select top_k of relevanted_list by maximal marginal relevance
+
+    Each step selects the result with the highest
+    EXTRACT_MMR_LAMBDA * relevance - (1 - EXTRACT_MMR_LAMBDA) * max
+    similarity to selected results, both are cosine similarity.
+
+    Args:
+        query_vector (list[float]): query vector
+        relevanted_list (list[dict]): search results with vector
+        top_k (int): max results
+
+    Returns:
+        list[dict]: selected results in selected order, without vector,
+        the first top_k of relevanted_list if any result has no vector
+    """
+
+    if len(relevanted_list) == 0 or any(
+        "vector" not in doc for doc in relevanted_list
+    ):
+        return [_without_vector(doc) for doc in relevanted_list[:top_k]]
+
+    vectors = np.asarray(
+        [doc["vector"] for doc in relevanted_list], dtype=np.float32
+    ).reshape(len(relevanted_list), -1)
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    query = np.asarray(query_vector, dtype=np.float32)
+    relevance = vectors @ (query / max(float(np.linalg.norm(query)), 1e-12))
+    similarity = vectors @ vectors.T
+
+    selected: list[int] = []
+    max_similarity = np.zeros(len(relevanted_list), dtype=np.float32)
+    for _ in range(min(top_k, len(relevanted_list))):
+        scores = (
+            EXTRACT_MMR_LAMBDA * relevance
+            - (1 - EXTRACT_MMR_LAMBDA) * max_similarity
+        )
+        scores[selected] = -np.inf
+        best = int(scores.argmax())
+        selected.append(best)
+        max_similarity = np.maximum(max_similarity, similarity[best])
+    return [_without_vector(relevanted_list[i]) for i in selected]
+
+
+def ngram_rerank(query: str, relevanted_list: list[dict]) -> list[dict]:
+    """order results by the number of distinct character n-grams of query
+    their content has, results of the same number keep their order"""
+
+    query_grams = set(get_grams(query))
+    if len(query_grams) == 0:
+        return relevanted_list
+
+    coverage = [
+        len(query_grams.intersection(get_grams(doc["content"])))
+        for doc in relevanted_list
+    ]
+    order = sorted(range(len(relevanted_list)), key=lambda i: -coverage[i])
+    return [relevanted_list[i] for i in order]
+
+
+RERANKERS: dict[str, Callable[[str, list[dict]], list[dict]]] = {
+    "ngram": ngram_rerank,
+}
+"""local rerankers by name, a reranker returns results in new order"""
+
+
+def check_reranker() -> None:
+    """check EXTRACT_RERANKER at startup, not on each query
+
+    Raises:
+        ValueError: if EXTRACT_RERANKER is not in RERANKERS
+    """
+
+    if EXTRACT_RERANKER and EXTRACT_RERANKER not in RERANKERS:
+        msg = f"reranker {EXTRACT_RERANKER} not supported"
+        logger.error(msg)
+        raise ValueError(msg)
+
+
+def rerank(query: str, relevanted_list: list[dict]) -> list[dict]:
+    """re-rank results by EXTRACT_RERANKER"""
+
+    if not EXTRACT_RERANKER:
+        return relevanted_list
+
+    return RERANKERS[EXTRACT_RERANKER](query, relevanted_list)
@@ -1,13 +1,21 @@
 """test extract"""
 
-# pylint: disable=unused-import
+# pylint: disable=unused-import,protected-access
 
+import time
+import asyncio
+import threading
+import pytest
 from app.model.payload import API_OPENAI
+from app.storage.file_index import FileIndex
+from app.storage.keyword_index import KeywordIndex, get_grams
+from app.vectordb.vectordb import VDB
 
 # need to import, otherwise mocker.patch can not find module.
 # Don't know why. If someone know why, please tell me.
 from app.chat.openai import chat_completions  # noqa
 from .extract import Extract
+from . import postprocess
 
 
 def _relevanted_list() -> list:
@@ -47,3 +55,237 @@ def test_ask(mocker):
         ex.ask(query=query, relevanted_list=relevanted_list, api=API_OPENAI)
         == answer
     )
+
+
+def test_generate_answer_batch(mocker):
+    """test queries embedded and searched together, answered concurrently"""
+
+    mocker.patch("app.extract.extract.Storage.file_index.resolve", str)
+    mocker.patch("app.extract.extract.Extract.EXTRACT_KEYWORD_SEARCH", 0)
+    embedding_class = mocker.patch("app.extract.extract.Embedding")
+    embedding_class.EMBEDDING_BATCH_SIZE = 2
+    embedding = embedding_class.return_value
+    embedding.embedding_list_cached.side_effect = lambda queries: [
+        [float(len(query))] for query in queries
+    ]
+    vdb = mocker.patch("app.extract.extract.VDB.default_vdb").return_value
+    vdb.search_batch.return_value = [_relevanted_list(), [], _relevanted_list()]
+
+    in_flight = 0
+    max_in_flight = 0
+    lock = threading.Lock()
+
+    def fake_chat_completions(messages):
+        nonlocal in_flight, max_in_flight
+        with lock:
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+        time.sleep(0.05)
+        with lock:
+            in_flight -= 1
+        return messages[0]["content"].rsplit("Question: ", 1)[1]
+
+    mocker.patch("app.chat.openai.chat_completions", fake_chat_completions)
+
+    queries = ["query 1", "query 22", "query 333"]
+    answers = asyncio.run(
+        Extract().generate_answer_batch(queries, "a-file-id", API_OPENAI)
+    )
+    assert answers == ["query 1", Extract.ANSWER_NOT_FOUND, "query 333"]
+    assert vdb.collection == "a-file-id"
+    vdb.search_batch.assert_called_once_with(
+        [[7.0], [8.0], [9.0]], Extract.EXTRACT_TOP_K, False
+    )
+    assert embedding.embedding_list_cached.call_count == 2
+    assert max_in_flight == 2
+
+
+def test_keyword_index(tmp_path):
+    """test n-gram keyword index ranks exact terms, and updates in place"""
+
+    assert get_grams("第１２条 AB") == ["第1", "12", "2条", "ab"]
+
+    index = KeywordIndex(str(tmp_path / "keyword_index.db"))
+    index.set_chunks(
+        "a-file-id",
+        {
+            "a-file-id-0": "第12条 契約の解除について定める。",
+            "a-file-id-1": "第21条 損害賠償について定める。",
+            "a-file-id-2": "本契約における用語の定義。",
+        },
+    )
+    index.set_chunks("b-file-id", {"b-file-id-0": "第１２条 解除"})
+
+    result = index.search("a-file-id", "第12条の内容は？", top_k=2)
+    # 第21条 shares no gram with 第12条
+    assert [doc["id"] for doc in result] == ["a-file-id-0"]
+    assert result[0]["content"] == "第12条 契約の解除について定める。"
+    assert index.search("a-file-id", "？") == []
+    assert index.search("c-file-id", "第12条") == []
+
+    index.set_chunks(
+        "a-file-id",
+        {
+            "a-file-id-1": "第21条 損害賠償について定める。",
+            "a-file-id-3": "第12条 契約期間は一年とする。",
+        },
+    )
+    result = index.search("a-file-id", "第12条について")
+    assert [doc["id"] for doc in result] == ["a-file-id-3", "a-file-id-1"]
+    assert index.search("a-file-id", "解除") == []
+    assert [doc["id"] for doc in index.search("b-file-id", "解除")] == [
+        "b-file-id-0"
+    ]
+
+
+def test_generate_answer_fuse_keyword(mocker):
+    """test keyword search results fused with vector search results"""
+
+    mocker.patch("app.extract.extract.Storage.file_index.resolve", str)
+    mocker.patch("app.extract.extract.Embedding")
+    vdb = mocker.patch("app.extract.extract.VDB.default_vdb").return_value
+    vdb.search.return_value = _relevanted_list()
+    keyword_search = mocker.patch(
+        "app.extract.extract.Storage.keyword_index.search",
+        return_value=[
+            {"id": "keyword-only", "score": 9.0, "content": "test_content_3"},
+            {
+                "id": "656d65a3-aa6c-47fe-a70e-5a70a04d9c9e",
+                "score": 8.0,
+                "content": "test_content_2",
+            },
+        ],
+    )
+    ask = mocker.patch.object(Extract, "ask", return_value="answer")
+
+    assert Extract().generate_answer("query", "a-file-id", API_OPENAI) == (
+        "answer"
+    )
+    # maximal marginal relevance is disabled by default
+    vdb.search.assert_called_once_with(
+        mocker.ANY,
+        top_k=Extract.EXTRACT_TOP_K,
+        retrieve_vector=False,
+        ef=0,
+    )
+    keyword_search.assert_called_once_with(
+        "a-file-id", "query", Extract.EXTRACT_TOP_K
+    )
+    relevanted_list = ask.call_args.kwargs["relevanted_list"]
+    assert [doc["content"] for doc in relevanted_list] == [
+        "test_content_2",
+        "test_content_1",
+        "test_content_3",
+    ]
+    assert relevanted_list[0]["score"] == 1 / 62 + 1 / 62
+
+    # per request search parameters, fused texts are top_k at most
+    mocker.patch.object(postprocess, "EXTRACT_MMR", 1)
+    Extract().generate_answer("query", "a-file-id", API_OPENAI, top_k=2, ef=8)
+    vdb.search.assert_called_with(
+        mocker.ANY, top_k=4, retrieve_vector=True, ef=8
+    )
+    # fused before maximal marginal relevance, fetch_k of each search
+    keyword_search.assert_called_with("a-file-id", "query", 4)
+    assert len(ask.call_args.kwargs["relevanted_list"]) == 2
+
+    assert [
+        doc["id"]
+        for doc in Extract.fuse_rrf(
+            [[{"id": "a"}, {"id": "b"}], [{"id": "b"}, {"id": "c"}]], 2
+        )
+    ] == ["b", "a"]
+
+
+def test_generate_answer_fuse_before_mmr(mocker):
+    """test keyword-only near-duplicates are skipped by maximal marginal
+    relevance after fusion"""
+
+    mocker.patch("app.extract.extract.Storage.file_index.resolve", str)
+    embedding = mocker.patch("app.extract.extract.Embedding").return_value
+    embedding.embedding_cached.return_value = [1.0, 0.0]
+    mocker.patch.object(postprocess, "EXTRACT_MMR", 1)
+    mocker.patch.object(postprocess, "EXTRACT_MMR_LAMBDA", 0.3)
+    vdb = mocker.patch("app.extract.extract.VDB.default_vdb").return_value
+    vdb.search.return_value = [
+        {"id": "a", "score": 1.0, "content": "a", "vector": [1.0, 0.0]},
+        {"id": "b", "score": 0.5, "content": "b", "vector": [0.6, 0.8]},
+    ]
+    vdb.get_vectors.return_value = {"a-copy": [1.0, 0.01]}
+    mocker.patch(
+        "app.extract.extract.Storage.keyword_index.search",
+        return_value=[{"id": "a-copy", "score": 9.0, "content": "a-copy"}],
+    )
+    ask = mocker.patch.object(Extract, "ask", return_value="answer")
+
+    Extract().generate_answer("query", "a-file-id", API_OPENAI, top_k=2)
+    vdb.get_vectors.assert_called_once_with(["a-copy"])
+    relevanted_list = ask.call_args.kwargs["relevanted_list"]
+    assert [doc["id"] for doc in relevanted_list] == ["a", "b"]
+    assert all("vector" not in doc for doc in relevanted_list)
+
+
+def test_mmr():
+    """test near-duplicate results are skipped for diverse ones"""
+
+    relevanted_list = [
+        {"id": "a", "content": "a", "vector": [1.0, 0.0, 0.0]},
+        {"id": "a-copy", "content": "a", "vector": [0.99, 0.141, 0.0]},
+        {"id": "b", "content": "b", "vector": [0.8, 0.0, 0.6]},
+        {"id": "c", "content": "c", "vector": [0.0, 1.0, 0.0]},
+    ]
+    # in similarity order, a-copy is the second
+    result = postprocess.mmr([1.0, 0.0, 0.3], relevanted_list, 3)
+    assert [doc["id"] for doc in result] == ["a", "b", "a-copy"]
+    assert all("vector" not in doc for doc in result)
+
+    # similarity order without vectors
+    result = postprocess.mmr(
+        [1.0, 0.0, 0.0], [{"id": "a"}, {"id": "b"}, {"id": "c"}], 2
+    )
+    assert [doc["id"] for doc in result] == ["a", "b"]
+    assert postprocess.mmr([1.0, 0.0, 0.0], [], 2) == []
+
+
+def test_rerank(mocker):
+    """test reranker of EXTRACT_RERANKER"""
+
+    relevanted_list = [
+        {"id": "a", "content": "契約の解除"},
+        {"id": "b", "content": "第12条 契約期間"},
+        {"id": "c", "content": "第12条 契約の解除"},
+    ]
+    assert postprocess.rerank("第12条の解除", relevanted_list) == (
+        relevanted_list
+    )
+
+    mocker.patch.object(postprocess, "EXTRACT_RERANKER", "ngram")
+    result = postprocess.rerank("第12条の解除", relevanted_list)
+    assert [doc["id"] for doc in result] == ["c", "b", "a"]
+
+    postprocess.check_reranker()
+    mocker.patch.object(postprocess, "EXTRACT_RERANKER", "unknown")
+    with pytest.raises(ValueError):
+        postprocess.check_reranker()
+
+
+def test_get_consistency(mocker, tmp_path):
+    """test search is strong consistent until a while after ingestion"""
+
+    file_index = FileIndex(str(tmp_path / "file_index.db"))
+    mocker.patch("app.storage.storage.Storage.file_index", file_index)
+    mocker.patch.object(Extract, "EXTRACT_STRONG_READ_SECONDS", 60)
+    ex = Extract()
+
+    # not marked ready
+    assert ex._get_consistency("a-file") == VDB.CONSISTENCY_STRONG
+
+    file_index.set_ready("a-file")
+    assert ex._get_consistency("a-file") == VDB.CONSISTENCY_STRONG
+
+    mocker.patch("time.time", return_value=time.time() + 61)
+    assert ex._get_consistency("a-file") == VDB.CONSISTENCY_EVENTUAL
+    mocker.patch.object(
+        Extract, "EXTRACT_READ_CONSISTENCY", VDB.CONSISTENCY_STRONG
+    )
+    assert ex._get_consistency("a-file") == VDB.CONSISTENCY_STRONG
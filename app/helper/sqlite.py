@@ -0,0 +1,49 @@
+"""SQLite connection of each thread"""
+
+import os
+import sqlite3
+import threading
+from typing import Callable
+
+
+# pylint: disable=too-few-public-methods
+class LocalConnection:
+    """SQLite connection of the current thread and process
+
+    sqlite connection can not be shared between threads and processes,
+    a connection is opened lazily for each thread, and again after fork.
+    Connections are autocommit in WAL mode, so that api and worker
+    processes read while another one writes.
+    """
+
+    def __init__(
+        self, db_path: str, on_connect: Callable[[sqlite3.Connection], None]
+    ) -> None:
+        """init, database is connected lazily
+
+        Args:
+            db_path (str): SQLite database file path
+            on_connect (Callable[[sqlite3.Connection], None]): called with
+            each new connection, e.g. to create tables
+        """
+
+        self._db_path = db_path
+        self._on_connect = on_connect
+        self._local = threading.local()
+
+    def get(self) -> sqlite3.Connection:
+        """return connection of the current thread, connect if none"""
+
+        pid = os.getpid()
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == pid:
+            return conn
+
+        conn = sqlite3.connect(self._db_path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        self._on_connect(conn)
+
+        self._local.conn = conn
+        self._local.pid = pid
+        return conn
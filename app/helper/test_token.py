@@ -0,0 +1,42 @@
+"""test token"""
+
+# pylint: disable=protected-access
+
+from . import token
+from .token import VocabTokenizer, num_tokens, num_tokens_many
+
+
+def test_num_tokens():
+    """test simulate token count with characters"""
+
+    assert num_tokens("建築基準法") == 5
+    assert num_tokens_many(["", "ab", "建築"]) == [0, 2, 2]
+
+
+def test_vocab_tokenizer(tmp_path, mocker):
+    """test greedy longest match tokenizer and token count cache"""
+
+    vocab_path = tmp_path / "vocab.txt"
+    vocab_path.write_text("建築\n建築基準\n法\nab\n", encoding="utf-8")
+
+    tokenizer = VocabTokenizer(str(vocab_path))
+    # 建築基準 / 法 / 施 / 行 / 令
+    assert tokenizer.count("建築基準法施行令") == 5
+    assert tokenizer.count("abc") == 2
+    assert tokenizer.count("") == 0
+
+    counter = token._TokenCounter(str(vocab_path), cache_size=2)
+    mocker.patch.object(token, "_counter", counter)
+    assert num_tokens_many(["建築基準法", "ab", "建築基準法"]) == [2, 1, 2]
+
+    count = mocker.spy(VocabTokenizer, "count")
+    assert num_tokens("建築基準法") == 2
+    count.assert_not_called()
+    # a text repeated in the batch is counted once
+    assert num_tokens_many(["abab", "abab"]) == [2, 2]
+    count.assert_called_once()
+    count.reset_mock()
+
+    # cache is keyed by text itself, least recently used is evicted
+    assert num_tokens("ab") == 1
+    assert list(counter._cache) == ["abab", "ab"]
@@ -1,16 +1,149 @@
 """token operation"""
 
+# pylint: disable=too-few-public-methods
+
+import os
+import threading
+from collections import OrderedDict
+from loguru import logger
+
+TOKENIZER_VOCAB = os.getenv("TOKENIZER_VOCAB", "")
+"""
+Local vocab file of tokenizer, one token per line.
+If empty, simulate token count 1 to 1 with characters.
+"""
+
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "4096"))
+"""max texts in token count cache"""
+
+
+class CharTokenizer:
+    """simulate token count 1 to 1 with characters
+
+    On average, a token in Japanese can be roughly equivalent to 1-3 characters
+    """
+
+    def count(self, text: str) -> int:
+        """Return the number of tokens in a string."""
+
+        return len(text)
+
+
+class VocabTokenizer:
+    """Greedy longest-match tokenizer with a local vocab file
+
+    Characters not in vocab count as one token each. The provider
+    tokenizer is BPE, so counts are an approximation of it, not exact,
+    keep a margin in token budgets.
+    """
+
+    def __init__(self, vocab_path: str) -> None:
+        """load vocab
+
+        Args:
+            vocab_path (str): vocab file, one token per line
+        """
+
+        with open(vocab_path, "r", encoding="utf-8") as f:
+            self._vocab = {line.rstrip("\n") for line in f}
+        self._vocab.discard("")
+        self._max_len = max((len(t) for t in self._vocab), default=1)
+        logger.info(
+            f"load vocab success, vocab_path: {vocab_path}"
+            f", vocab len: {len(self._vocab)}, max_len: {self._max_len}"
+        )
+
+    def count(self, text: str) -> int:
+        """Return the number of tokens in a string."""
+
+        count = 0
+        i = 0
+        text_len = len(text)
+        while i < text_len:
+            length = min(self._max_len, text_len - i)
+            while length > 1 and text[i : i + length] not in self._vocab:
+                length -= 1
+            i += length
+            count += 1
+        return count
+
+
+class _TokenCounter:
+    """load tokenizer lazily, and cache token count of texts"""
+
+    def __init__(self, vocab_path: str, cache_size: int) -> None:
+        self._vocab_path = vocab_path
+        self._cache_size = cache_size
+        self._tokenizer: CharTokenizer | VocabTokenizer | None = None
+        # text -> token count, keyed by text itself so that texts of the
+        # same hash never share count
+        self._cache: OrderedDict[str, int] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_tokenizer(self) -> CharTokenizer | VocabTokenizer:
+        if self._tokenizer is None:
+            with self._lock:
+                if self._tokenizer is None:
+                    if self._vocab_path:
+                        self._tokenizer = VocabTokenizer(self._vocab_path)
+                    else:
+                        self._tokenizer = CharTokenizer()
+        return self._tokenizer
+
+    def count_many(self, texts: list[str]) -> list[int]:
+        """Return the number of tokens of each string."""
+
+        tokenizer = self._get_tokenizer()
+        if isinstance(tokenizer, CharTokenizer):
+            # cheaper than cache lookup
+            return [tokenizer.count(text) for text in texts]
+
+        # lock once for lookups of the batch, and once for inserts
+        with self._lock:
+            counts = [self._cache.get(text) for text in texts]
+            for text, count in zip(texts, counts):
+                if count is not None:
+                    self._cache.move_to_end(text)
+
+        missed: dict[str, int] = {}
+        for text, count in zip(texts, counts):
+            if count is None and text not in missed:
+                missed[text] = tokenizer.count(text)
+        if len(missed) > 0:
+            with self._lock:
+                for text, count in missed.items():
+                    self._cache[text] = count
+                    self._cache.move_to_end(text)
+                while len(self._cache) > self._cache_size:
+                    self._cache.popitem(last=False)
+
+        return [
+            missed[text] if count is None else count
+            for text, count in zip(texts, counts)
+        ]
+
+
+_counter = _TokenCounter(TOKENIZER_VOCAB, TOKEN_CACHE_SIZE)
+
 
 def num_tokens(text: str) -> int:
     """
     Return the number of tokens in a string.
 
-    **NOTE** simulate it 1 to 1
+    Use the tokenizer with TOKENIZER_VOCAB, or simulate it 1 to 1
+    if TOKENIZER_VOCAB is empty.
 
-    On average, a token in Japanese can be roughly equivalent to 1-3 characters,
-
-    or use api to calculate it such as
+    Use api to calculate it such as
     [Token calculator](https://console.cloud.tencent.com/hunyuan/tokenizer)
+    to check the result
+    """
+
+    return _counter.count_many([text])[0]
+
+
+def num_tokens_many(texts: list[str]) -> list[int]:
+    """
+    Return the number of tokens of each string, see num_tokens
     """
 
-    return len(text)
+    return _counter.count_many(texts)
@@ -0,0 +1,382 @@
+"""persistent ocr job queue"""
+
+import os
+import time
+import uuid
+import sqlite3
+from loguru import logger
+from app.helper.sqlite import LocalConnection
+from app.model.file_info import FileInfo
+from app.model.job import (
+    OcrJob,
+    JOB_PENDING,
+    JOB_PROCESSING,
+    JOB_COMPLETED,
+    JOB_FAILED,
+)
+
+
+class JobLeaseLost(Exception):
+    """job has been claimed again by another worker"""
+
+
+class JobQueue:
+    """Persistent ocr job queue with SQLite in WAL mode
+
+    Job state is shared by api processes and worker processes,
+    and survives server restart. A processing job without progress update
+    over OCR_JOB_TIMEOUT seconds is treated as lost and can be claimed again,
+    until it has been claimed OCR_JOB_MAX_ATTEMPTS times. Each claim gets a
+    new lease, the worker of an earlier claim can not checkpoint, complete
+    or fail the job any more.
+    """
+
+    OCR_JOB_DB = os.getenv("OCR_JOB_DB", "ocr_job.db")
+    """SQLite database file path"""
+
+    OCR_JOB_TIMEOUT = float(os.getenv("OCR_JOB_TIMEOUT", "600"))
+    """seconds a processing job can go without progress update"""
+
+    OCR_JOB_MAX_ATTEMPTS = int(os.getenv("OCR_JOB_MAX_ATTEMPTS", "3"))
+    """max times a job can be claimed"""
+
+    def __init__(self, db_path: str = OCR_JOB_DB) -> None:
+        """init job queue, database is connected lazily
+
+        Args:
+            db_path (str, optional): SQLite database file path.
+            Defaults to OCR_JOB_DB.
+        """
+
+        self._db = LocalConnection(db_path, self._init_db)
+
+    def _conn(self) -> sqlite3.Connection:
+        return self._db.get()
+
+    def _init_db(self, conn: sqlite3.Connection) -> None:
+        conn.row_factory = sqlite3.Row
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS ocr_job (
+                file_id TEXT PRIMARY KEY,
+                file_info TEXT NOT NULL,
+                signed_url TEXT NOT NULL,
+                status TEXT NOT NULL,
+                progress REAL NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT NOT NULL DEFAULT '',
+                updated_at REAL NOT NULL,
+                lease TEXT NOT NULL DEFAULT ''
+            )
+            """)
+        columns = {
+            row["name"] for row in conn.execute("PRAGMA table_info(ocr_job)")
+        }
+        if "lease" not in columns:
+            conn.execute(
+                "ALTER TABLE ocr_job ADD COLUMN lease TEXT NOT NULL DEFAULT ''"
+            )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS ocr_job_status"
+            " ON ocr_job (status, updated_at)"
+        )
+        # chunk index written into vector db of each job
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS ocr_checkpoint ("
+            " file_id TEXT NOT NULL, chunk_index INTEGER NOT NULL,"
+            " PRIMARY KEY (file_id, chunk_index))"
+        )
+
+    def enqueue(self, file_info: FileInfo, signed_url: str) -> bool:
+        """add a pending job, replace the completed or failed job of the same
+        file_id and its checkpoint, keep the pending or processing one
+
+        Args:
+            file_info (FileInfo): file info
+            signed_url (str): signed url for downloaded file
+
+        Returns:
+            bool: True if enqueued, False if a pending or processing job of
+            the same file_id existed
+        """
+
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT status FROM ocr_job WHERE file_id = ?",
+                (file_info.file_id,),
+            ).fetchone()
+            if row is not None and row["status"] in (
+                JOB_PENDING,
+                JOB_PROCESSING,
+            ):
+                conn.execute("COMMIT")
+                logger.info(
+                    f"job existed, file_id: {file_info.file_id}"
+                    f", status: {row['status']}"
+                )
+                return False
+
+            # checkpoint of the replaced job may belong to another document
+            conn.execute(
+                "DELETE FROM ocr_checkpoint WHERE file_id = ?",
+                (file_info.file_id,),
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO ocr_job"
+                " (file_id, file_info, signed_url, status, progress"
+                ", updated_at) VALUES (?, ?, ?, ?, 0, ?)",
+                (
+                    file_info.file_id,
+                    file_info.model_dump_json(),
+                    signed_url,
+                    JOB_PENDING,
+                    time.time(),
+                ),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        logger.info(f"enqueue job success, file_id: {file_info.file_id}")
+        return True
+
+    def claim(self) -> OcrJob | None:
+        """claim the oldest pending or lost job
+
+        Returns:
+            OcrJob | None: claimed job, None if no job to claim
+        """
+
+        conn = self._conn()
+        now = time.time()
+
+        # BEGIN IMMEDIATE take the write lock,
+        # so only one worker can claim the job
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # lost job over max attempts
+            conn.execute(
+                "UPDATE ocr_job SET status = ?, error = ?, updated_at = ?"
+                " WHERE status = ? AND updated_at < ? AND attempts >= ?",
+                (
+                    JOB_FAILED,
+                    "job timeout",
+                    now,
+                    JOB_PROCESSING,
+                    now - JobQueue.OCR_JOB_TIMEOUT,
+                    JobQueue.OCR_JOB_MAX_ATTEMPTS,
+                ),
+            )
+
+            row = conn.execute(
+                "SELECT * FROM ocr_job"
+                " WHERE status = ? OR (status = ? AND updated_at < ?)"
+                " ORDER BY updated_at LIMIT 1",
+                (
+                    JOB_PENDING,
+                    JOB_PROCESSING,
+                    now - JobQueue.OCR_JOB_TIMEOUT,
+                ),
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+
+            lease = uuid.uuid4().hex
+            conn.execute(
+                "UPDATE ocr_job SET status = ?, attempts = attempts + 1"
+                ", lease = ?, updated_at = ? WHERE file_id = ?",
+                (JOB_PROCESSING, lease, now, row["file_id"]),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        job = self._to_job(row)
+        job.status = JOB_PROCESSING
+        job.attempts += 1
+        job.lease = lease
+        logger.info(f"claim job success, job: {job}")
+        return job
+
+    def complete(self, file_id: str, lease: str) -> bool:
+        """mark job completed, clear its checkpoint
+
+        Returns:
+            bool: False if lease is not the latest claim of the job
+        """
+
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if not self._update_owned(
+                conn, file_id, lease, status=JOB_COMPLETED, progress=1
+            ):
+                conn.execute("ROLLBACK")
+                logger.warning(f"job lease lost, file_id: {file_id}")
+                return False
+
+            conn.execute(
+                "DELETE FROM ocr_checkpoint WHERE file_id = ?", (file_id,)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return True
+
+    def fail(
+        self, file_id: str, lease: str, error: str, retry: bool = False
+    ) -> bool:
+        """mark job failed
+
+        Args:
+            file_id (str): file id
+            lease (str): lease of the claim
+            error (str): error message
+            retry (bool, optional): mark job pending to be claimed again
+            if it has not been claimed OCR_JOB_MAX_ATTEMPTS times.
+            Defaults to False.
+
+        Returns:
+            bool: False if lease is not the latest claim of the job
+        """
+
+        cursor = self._conn().execute(
+            "UPDATE ocr_job SET status = CASE WHEN ? AND attempts < ?"
+            " THEN ? ELSE ? END, error = ?, updated_at = ?"
+            " WHERE file_id = ? AND lease = ? AND status = ?",
+            (
+                retry,
+                JobQueue.OCR_JOB_MAX_ATTEMPTS,
+                JOB_PENDING,
+                JOB_FAILED,
+                error,
+                time.time(),
+                file_id,
+                lease,
+                JOB_PROCESSING,
+            ),
+        )
+        if cursor.rowcount == 0:
+            logger.warning(f"job lease lost, file_id: {file_id}")
+            return False
+        return True
+
+    def add_checkpoint(
+        self, file_id: str, lease: str, chunk_index_list: list[int]
+    ) -> None:
+        """record chunk index list written into vector db
+
+        Raises:
+            JobLeaseLost: lease is not the latest claim of the job
+        """
+
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # refresh update time as well, written chunks are progress
+            if not self._update_owned(conn, file_id, lease):
+                raise JobLeaseLost(f"job lease lost, file_id: {file_id}")
+
+            conn.executemany(
+                "INSERT OR IGNORE INTO ocr_checkpoint (file_id, chunk_index)"
+                " VALUES (?, ?)",
+                [(file_id, index) for index in chunk_index_list],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get_checkpoint(self, file_id: str) -> set[int]:
+        """return chunk index set written into vector db"""
+
+        rows = (
+            self._conn()
+            .execute(
+                "SELECT chunk_index FROM ocr_checkpoint WHERE file_id = ?",
+                (file_id,),
+            )
+            .fetchall()
+        )
+        return {row[0] for row in rows}
+
+    def get_job(self, file_id: str) -> OcrJob | None:
+        """get job of file_id
+
+        Returns:
+            OcrJob | None: job, None if not existed
+        """
+
+        row = (
+            self._conn()
+            .execute("SELECT * FROM ocr_job WHERE file_id = ?", (file_id,))
+            .fetchone()
+        )
+        if row is None:
+            return None
+
+        return self._to_job(row)
+
+    def get(self, file_id: str, default=None) -> float | None:
+        """Return the progress of file_id, else default."""
+
+        row = (
+            self._conn()
+            .execute(
+                "SELECT progress FROM ocr_job WHERE file_id = ?", (file_id,)
+            )
+            .fetchone()
+        )
+        if row is None:
+            return default
+
+        return row["progress"]
+
+    def set(self, file_id: str, progress: float) -> None:
+        """Set progress of file_id, also refresh job update time"""
+
+        self._update(file_id, progress=progress)
+
+    def delete(self, file_id: str) -> None:
+        """Delete job of file_id."""
+
+        self._conn().execute(
+            "DELETE FROM ocr_job WHERE file_id = ?", (file_id,)
+        )
+
+    def _update(self, file_id: str, **kwargs) -> None:
+        columns = ", ".join(f"{k} = ?" for k in kwargs)
+        self._conn().execute(
+            f"UPDATE ocr_job SET {columns}, updated_at = ? WHERE file_id = ?",
+            (*kwargs.values(), time.time(), file_id),
+        )
+
+    def _update_owned(
+        self, conn: sqlite3.Connection, file_id: str, lease: str, **kwargs
+    ) -> bool:
+        """update processing job claimed with lease, return False if lease
+        is not the latest claim of the job"""
+
+        columns = "".join(f"{k} = ?, " for k in kwargs)
+        cursor = conn.execute(
+            f"UPDATE ocr_job SET {columns}updated_at = ?"
+            " WHERE file_id = ? AND lease = ? AND status = ?",
+            (*kwargs.values(), time.time(), file_id, lease, JOB_PROCESSING),
+        )
+        return cursor.rowcount > 0
+
+    def _to_job(self, row: sqlite3.Row) -> OcrJob:
+        return OcrJob(
+            file_info=FileInfo.model_validate_json(row["file_info"]),
+            signed_url=row["signed_url"],
+            status=row["status"],
+            progress=row["progress"],
+            attempts=row["attempts"],
+            error=row["error"],
+            lease=row["lease"],
+        )
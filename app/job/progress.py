@@ -0,0 +1,166 @@
+"""push ocr progress to subscribers"""
+
+# pylint: disable=too-few-public-methods
+
+import os
+import asyncio
+from typing import AsyncIterator
+from loguru import logger
+from app.job.job_queue import JobQueue
+from app.model.job import OcrJob, JOB_COMPLETED, JOB_FAILED
+
+OCR_PROGRESS_POLL_INTERVAL = float(
+    os.getenv("OCR_PROGRESS_POLL_INTERVAL", "0.5")
+)
+"""seconds between reading progress of a subscribed job"""
+
+
+def get_job_progress(job: OcrJob) -> dict:
+    """return progress of job in response format
+
+    Returns:
+        dict: status completed once finished,
+        status failed with error if ocr failed,
+        otherwise status processing with progress
+    """
+
+    if job.status == JOB_FAILED:
+        return {"status": "failed", "error": job.error}
+
+    if job.status == JOB_COMPLETED:
+        return {"status": "completed"}
+
+    return {"status": "processing", "progress": job.progress}
+
+
+def is_final(progress: dict) -> bool:
+    """return True if no more progress will be published after progress"""
+
+    return progress["status"] in ("completed", "failed")
+
+
+class _Subscriber:
+    """keep only the latest progress not consumed yet,
+    so that a slow subscriber skips intermediate progress"""
+
+    def __init__(self) -> None:
+        self._event = asyncio.Event()
+        self._latest: dict = {}
+
+    def publish(self, progress: dict) -> None:
+        """replace progress not consumed yet"""
+
+        self._latest = progress
+        self._event.set()
+
+    async def next(self) -> dict:
+        """wait and return the latest progress"""
+
+        await self._event.wait()
+        self._event.clear()
+        return self._latest
+
+
+class ProgressBroadcaster:
+    """Fan out ocr progress of a job to its subscribers
+
+    Progress is written by worker processes into JobQueue, each subscribed job
+    is read once every OCR_PROGRESS_POLL_INTERVAL seconds in the api process
+    no matter how many subscribers it has, and changed progress is published
+    to all of them.
+    """
+
+    def __init__(
+        self,
+        job_queue: JobQueue,
+        poll_interval: float = OCR_PROGRESS_POLL_INTERVAL,
+    ) -> None:
+        """init broadcaster
+
+        Args:
+            job_queue (JobQueue): job queue to read progress from
+            poll_interval (float, optional): seconds between reading progress.
+            Defaults to OCR_PROGRESS_POLL_INTERVAL.
+        """
+
+        self._job_queue = job_queue
+        self._poll_interval = poll_interval
+        self._subscribers: dict[str, set[_Subscriber]] = {}
+        self._watchers: dict[str, asyncio.Task] = {}
+        # last progress published of each job, for new subscribers
+        self._latest: dict[str, dict] = {}
+
+    def subscriber_count(self, file_id: str) -> int:
+        """return subscriber count of file_id"""
+
+        return len(self._subscribers.get(file_id, ()))
+
+    async def subscribe(self, file_id: str) -> AsyncIterator[dict]:
+        """yield progress of file_id when changed, until completed or failed
+
+        Args:
+            file_id (str): file id of job
+
+        Yields:
+            dict: progress, see get_job_progress,
+            progress changed faster than consumed is coalesced to the latest
+        """
+
+        subscriber = _Subscriber()
+        self._subscribers.setdefault(file_id, set()).add(subscriber)
+        if file_id in self._latest:
+            subscriber.publish(self._latest[file_id])
+        if file_id not in self._watchers:
+            self._watchers[file_id] = asyncio.create_task(self._watch(file_id))
+
+        try:
+            while True:
+                progress = await subscriber.next()
+                yield progress
+                if is_final(progress):
+                    return
+        finally:
+            subscribers = self._subscribers[file_id]
+            subscribers.discard(subscriber)
+            if len(subscribers) == 0:
+                del self._subscribers[file_id]
+                self._latest.pop(file_id, None)
+                watcher = self._watchers.pop(file_id, None)
+                if watcher is not None:
+                    watcher.cancel()
+
+    async def _watch(self, file_id: str) -> None:
+        """read progress of file_id in loop, publish it if changed"""
+
+        try:
+            while True:
+                try:
+                    job = await asyncio.to_thread(
+                        self._job_queue.get_job, file_id
+                    )
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    logger.error(f"get job failed, file_id: {file_id}, e: {e}")
+                    await asyncio.sleep(self._poll_interval)
+                    continue
+
+                if job is None:
+                    progress = {
+                        "status": "failed",
+                        "error": f"{file_id} file_id not found",
+                    }
+                else:
+                    progress = get_job_progress(job)
+
+                if progress != self._latest.get(file_id):
+                    self._latest[file_id] = progress
+                    for subscriber in self._subscribers.get(file_id, ()):
+                        subscriber.publish(progress)
+
+                if is_final(progress):
+                    return
+                await asyncio.sleep(self._poll_interval)
+        finally:
+            # let subscribers come after final progress start a new watcher
+            if self._watchers.get(file_id) is asyncio.current_task():
+                del self._watchers[file_id]
+                self._latest.pop(file_id, None)
@@ -0,0 +1,206 @@
+"""test job queue"""
+
+import asyncio
+import pytest
+from app.model.file_info import FileInfo
+from app.storage.file_index import FileIndex
+from app.model.job import (
+    JOB_COMPLETED,
+    JOB_FAILED,
+    JOB_PENDING,
+    JOB_PROCESSING,
+)
+from .job_queue import JobQueue, JobLeaseLost
+from .worker import process_job
+from .progress import ProgressBroadcaster, get_job_progress
+
+
+def _file_info(file_id: str) -> FileInfo:
+    return FileInfo(
+        file_id=file_id,
+        file_name="test.pdf",
+        file_unique_name=f"{file_id}___test.pdf",
+    )
+
+
+def test_job_queue_claim(tmp_path):
+    """test job is claimed once, and survive queue recreated"""
+
+    db_path = str(tmp_path / "job.db")
+    q = JobQueue(db_path)
+    q.enqueue(_file_info("a-job-1"), "http://test/1")
+    q.enqueue(_file_info("a-job-2"), "http://test/2")
+    assert q.get("a-job-1") == 0
+    assert q.get("a-job-3") is None
+
+    # another process open the same database
+    q2 = JobQueue(db_path)
+    job = q2.claim()
+    assert job.file_info.file_id == "a-job-1"
+    assert job.status == JOB_PROCESSING
+    assert job.attempts == 1
+    assert q.claim().file_info.file_id == "a-job-2"
+    assert q.claim() is None
+
+    q2.set("a-job-1", 0.5)
+    assert q.get_job("a-job-1").progress == 0.5
+    assert q2.complete("a-job-1", job.lease)
+    assert q.get_job("a-job-1").status == JOB_COMPLETED
+
+
+def test_job_queue_enqueue_existed(tmp_path):
+    """test pending or processing job is kept, finished one is replaced"""
+
+    q = JobQueue(str(tmp_path / "job.db"))
+    assert q.enqueue(_file_info("a-job-1"), "http://test/1")
+    assert not q.enqueue(_file_info("a-job-1"), "http://test/2")
+    job = q.claim()
+    q.set("a-job-1", 0.5)
+    assert not q.enqueue(_file_info("a-job-1"), "http://test/2")
+    assert q.get_job("a-job-1").progress == 0.5
+    assert q.get_job("a-job-1").signed_url == "http://test/1"
+
+    q.complete("a-job-1", job.lease)
+    assert q.enqueue(_file_info("a-job-1"), "http://test/2")
+    assert q.get_job("a-job-1").signed_url == "http://test/2"
+    assert q.get_job("a-job-1").status == JOB_PENDING
+
+
+def test_job_queue_lease_lost(tmp_path, mocker):
+    """test worker of an earlier claim can not update the job"""
+
+    q = JobQueue(str(tmp_path / "job.db"))
+    q.enqueue(_file_info("a-job-1"), "http://test/1")
+    lost = q.claim()
+    mocker.patch.object(JobQueue, "OCR_JOB_TIMEOUT", -1)
+    job = q.claim()
+    assert job.attempts == 2
+    assert job.lease != lost.lease
+
+    with pytest.raises(JobLeaseLost):
+        q.add_checkpoint("a-job-1", lost.lease, [0])
+    assert not q.fail("a-job-1", lost.lease, "lost", retry=True)
+    assert not q.complete("a-job-1", lost.lease)
+    assert q.get_job("a-job-1").status == JOB_PROCESSING
+
+    q.add_checkpoint("a-job-1", job.lease, [1])
+    assert q.get_checkpoint("a-job-1") == {1}
+    assert q.complete("a-job-1", job.lease)
+
+
+def test_job_queue_claim_lost_job(tmp_path, mocker):
+    """test processing job without update over timeout is claimed again"""
+
+    mocker.patch.object(JobQueue, "OCR_JOB_TIMEOUT", -1)
+    mocker.patch.object(JobQueue, "OCR_JOB_MAX_ATTEMPTS", 2)
+
+    q = JobQueue(str(tmp_path / "job.db"))
+    q.enqueue(_file_info("a-job-1"), "http://test/1")
+    assert q.claim().attempts == 1
+    assert q.claim().attempts == 2
+
+    # over max attempts
+    assert q.claim() is None
+    job = q.get_job("a-job-1")
+    assert job.status == JOB_FAILED
+    assert job.error == "job timeout"
+
+
+def test_process_job(tmp_path, mocker):
+    """test worker mark job completed or failed"""
+
+    q = JobQueue(str(tmp_path / "job.db"))
+    file_index = FileIndex(str(tmp_path / "file_index.db"))
+    mocker.patch("app.ocr.ocr.Ocr.ocr_progress", q)
+    mocker.patch("app.storage.storage.Storage.file_index", file_index)
+    perform_ocr = mocker.patch("app.ocr.ocr.Ocr.perform_ocr")
+
+    q.enqueue(_file_info("a-job-1"), "http://test/1")
+    process_job(q.claim())
+    assert q.get_job("a-job-1").status == JOB_COMPLETED
+    assert file_index.get_ready_at("a-job-1") is not None
+
+    perform_ocr.side_effect = ValueError("ocr failed")
+    mocker.patch.object(JobQueue, "OCR_JOB_MAX_ATTEMPTS", 2)
+    q.enqueue(_file_info("a-job-2"), "http://test/2")
+
+    # retry until max attempts
+    process_job(q.claim())
+    assert q.get_job("a-job-2").status == JOB_PENDING
+    process_job(q.claim())
+    job = q.get_job("a-job-2")
+    assert job.status == JOB_FAILED
+    assert job.error == "ocr failed"
+    assert file_index.get_ready_at("a-job-2") is None
+
+
+def test_job_queue_checkpoint(tmp_path):
+    """test checkpoint is kept until job completed"""
+
+    q = JobQueue(str(tmp_path / "job.db"))
+    q.enqueue(_file_info("a-job-1"), "http://test/1")
+    lease = q.claim().lease
+    q.add_checkpoint("a-job-1", lease, [0, 1, 2])
+    q.add_checkpoint("a-job-1", lease, [2, 5])
+    assert q.get_checkpoint("a-job-1") == {0, 1, 2, 5}
+    assert not q.get_checkpoint("a-job-2")
+
+    q.complete("a-job-1", lease)
+    assert not q.get_checkpoint("a-job-1")
+
+
+def test_get_job_progress(tmp_path):
+    """test job is completed only after the worker marked it"""
+
+    q = JobQueue(str(tmp_path / "job.db"))
+    q.enqueue(_file_info("a-job-1"), "http://test/1")
+    lease = q.claim().lease
+    q.set("a-job-1", 1)
+    assert get_job_progress(q.get_job("a-job-1")) == {
+        "status": "processing",
+        "progress": 1,
+    }
+
+    q.complete("a-job-1", lease)
+    assert get_job_progress(q.get_job("a-job-1")) == {"status": "completed"}
+
+
+def test_progress_broadcaster(tmp_path):
+    """test progress is fanned out to subscribers until completed"""
+
+    q = JobQueue(str(tmp_path / "job.db"))
+    q.enqueue(_file_info("a-job-1"), "http://test/1")
+    lease = q.claim().lease
+    broadcaster = ProgressBroadcaster(q, poll_interval=0.01)
+
+    async def consume(delay: float) -> list[dict]:
+        progress_list = []
+        async for progress in broadcaster.subscribe("a-job-1"):
+            progress_list.append(progress)
+            await asyncio.sleep(delay)
+        return progress_list
+
+    async def produce() -> None:
+        await asyncio.sleep(0.05)
+        assert broadcaster.subscriber_count("a-job-1") == 2
+        for i in range(1, 10):
+            q.set("a-job-1", i / 10)
+            await asyncio.sleep(0.02)
+        q.complete("a-job-1", lease)
+
+    async def run() -> tuple[list[dict], list[dict]]:
+        fast, slow, _ = await asyncio.gather(
+            consume(0), consume(0.1), produce()
+        )
+        return fast, slow
+
+    fast, slow = asyncio.run(run())
+    assert fast[0] == {"status": "processing", "progress": 0}
+    assert fast[-1] == {"status": "completed"}
+    assert slow[-1] == {"status": "completed"}
+    # slow subscriber skips intermediate progress
+    assert len(slow) < len(fast)
+    assert broadcaster.subscriber_count("a-job-1") == 0
+
+    # subscribe after completed
+    assert asyncio.run(consume(0)) == [{"status": "completed"}]
@@ -0,0 +1,100 @@
+"""ocr worker processes
+
+Run worker pool with `python -m app.job.worker`
+"""
+
+import os
+import time
+import traceback
+import multiprocessing
+from loguru import logger
+from app.ocr.ocr import Ocr
+from app.storage.storage import Storage
+from app.model.job import OcrJob
+
+OCR_WORKER_NUM = int(os.getenv("OCR_WORKER_NUM", str(os.cpu_count() or 1)))
+"""worker process count"""
+
+OCR_WORKER_POLL_INTERVAL = float(os.getenv("OCR_WORKER_POLL_INTERVAL", "1"))
+"""seconds to wait before claim again when no job"""
+
+
+# pylint: disable=broad-exception-caught
+def process_job(job: OcrJob) -> None:
+    """perform ocr of job, mark job completed or failed
+
+    Args:
+        job (OcrJob): claimed job
+    """
+
+    file_info = job.file_info
+    if not file_info.is_valid():
+        msg = f"file_info invalid, file_info: {file_info}"
+        logger.error(msg)
+        Ocr.ocr_progress.fail(file_info.file_id, job.lease, msg)
+        return
+
+    try:
+        Ocr(job.signed_url, file_info, job.lease).perform_ocr()
+    except Exception as e:
+        logger.error(
+            f"perform_ocr failed, file_info: {file_info}, e: {e}"
+            f", {traceback.format_exc()}"
+        )
+        # job will resume from checkpoint when claimed again
+        Ocr.ocr_progress.fail(file_info.file_id, job.lease, str(e), retry=True)
+        return
+
+    # documents are written before the readiness marker, and the marker
+    # before the job, completed job always has the marker
+    Storage.file_index.set_ready(file_info.file_id)
+    Ocr.ocr_progress.complete(file_info.file_id, job.lease)
+
+
+def run_worker(worker_id: int) -> None:
+    """claim and process job in loop
+
+    Args:
+        worker_id (int): worker id for log
+    """
+
+    logger.info(f"worker {worker_id} started, pid: {os.getpid()}")
+    while True:
+        try:
+            job = Ocr.ocr_progress.claim()
+        except Exception as e:
+            logger.error(f"worker {worker_id} claim job failed, e: {e}")
+            job = None
+
+        if job is None:
+            time.sleep(OCR_WORKER_POLL_INTERVAL)
+            continue
+
+        logger.info(
+            f"worker {worker_id} process job, file_id: {job.file_info.file_id}"
+        )
+        process_job(job)
+
+
+def run_workers(worker_num: int = OCR_WORKER_NUM) -> None:
+    """start worker processes and wait for them
+
+    Args:
+        worker_num (int, optional): worker process count.
+        Defaults to OCR_WORKER_NUM.
+    """
+
+    processes: list[multiprocessing.Process] = []
+    for worker_id in range(worker_num):
+        p = multiprocessing.Process(
+            target=run_worker, args=(worker_id,), name=f"ocr-worker-{worker_id}"
+        )
+        p.start()
+        processes.append(p)
+
+    for p in processes:
+        p.join()
+
+
+if __name__ == "__main__":
+    run_workers()
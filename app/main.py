@@ -2,27 +2,38 @@
 
 import os
 import sys
+import json
+from typing import AsyncIterator
 from loguru import logger
 from fastapi import (
     FastAPI,
     HTTPException,
     UploadFile,
     status,
-    BackgroundTasks,
     Path,
 )
-
-from .model.payload import OcrPayload, ExtractPayload
+from fastapi.responses import StreamingResponse
+
+from .model.payload import OcrPayload, ExtractPayload, ExtractBatchPayload
+from .model.job import (
+    JOB_PENDING,
+    JOB_PROCESSING,
+    JOB_COMPLETED,
+    JOB_FAILED,
+)
+from .model.file_info import FileInfo
+from .job.progress import get_job_progress
 from .valid.valid import validate_files
 from .storage.storage import Storage
 from .ocr.ocr import Ocr
 from .extract.extract import Extract
+from .extract import postprocess
+from .embedding.embedding import Embedding
 from .helper.file import get_file_info_from_signed_url
 from .exceptions.exceptions import (
     ExceptionHandlingMiddleware,
 )
 
-
 LOG_FORMAT = (
     "{time:YYYY-MM-DD HH:mm:ss:SSS} | {level} | {file}:{line} | {message}"
 )
@@ -42,6 +53,9 @@ logger.add(
 )
 
 
+# fail at startup rather than on each query
+postprocess.check_reranker()
+
 app = FastAPI()
 
 # handle endpoints exception in ExceptionHandlingMiddleware
@@ -111,21 +125,28 @@ async def upload(files: list[UploadFile]) -> dict:
 
 
 @app.post("/ocr")
-async def ocr(payload: OcrPayload, background_tasks: BackgroundTasks) -> dict:
+async def ocr(payload: OcrPayload) -> dict:
     """
-    In background perform OCR  on the document specified by the signed URL.
+    Add a job to perform OCR on the document specified by the signed URL,
+    job will be processed by worker processes, see app/job/worker.py
 
     Args:
         payload (OcrPayload): A payload containing the signed URL of
-        the document to process.
+        the document to process, and optional existed file_id to re-ingest
+        with the document, e.g. a revised edition, only changed content
+        of file_id is embedded and written again.
 
     Returns:
-        dict: the result of the OCR process.
+        dict: the result of the OCR process,
+        status completed will return if the same file content
+        has been performed OCR
 
     Raises:
         - code 422, If payload is invalid
         - code 400, If signed_url is not a valid download url,
             should container file_id and file_name
+        - code 404, If file_id to re-ingest not found
+        - code 409, If file_id to re-ingest is processing
         - code 500, If internal error happened.
     """
 
@@ -133,15 +154,82 @@ async def ocr(payload: OcrPayload, background_tasks: BackgroundTasks) -> dict:
     file_info = get_file_info_from_signed_url(payload.signed_url)
     logger.info(f"file_info: {file_info}")
 
-    o = Ocr(str(payload.signed_url), file_info)
-    background_tasks.add_task(o.perform_ocr_in_background)
-    Ocr.ocr_progress.set(file_info.file_id, 0)
+    if payload.file_id is not None:
+        return _reingest(payload.file_id, file_info, str(payload.signed_url))
+
+    # same content has been performed ocr, alias to its vector collection
+    ocr_file_id = Storage.file_index.get_ocr_file_id(file_info.file_id)
+    if ocr_file_id is not None:
+        job = Ocr.ocr_progress.get_job(ocr_file_id)
+        if job is not None and job.status != JOB_FAILED:
+            Storage.file_index.set_alias(file_info.file_id, ocr_file_id)
+            return {
+                "status": (
+                    "completed" if job.status == JOB_COMPLETED else "processing"
+                ),
+                "file_id": file_info.file_id,
+            }
+
+    Storage.file_index.set_ocr_file_id(file_info.file_id)
+    Ocr.ocr_progress.enqueue(file_info, str(payload.signed_url))
     return {
         "status": "processing",
         "file_id": file_info.file_id,
     }
 
 
+def _reingest(file_id: str, file_info: FileInfo, signed_url: str) -> dict:
+    """add a job to re-ingest file_id with the document of file_info,
+    the uploaded file of file_info alias to file_id, other files alias to
+    file_id are ingested again with the previous document"""
+
+    job = Ocr.ocr_progress.get_job(file_id)
+    if job is None:
+        msg = f"{file_id} file_id not found"
+        logger.error(msg)
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=msg,
+        )
+
+    if job.status in (JOB_PENDING, JOB_PROCESSING):
+        msg = f"{file_id} file_id is processing"
+        logger.error(msg)
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=msg,
+        )
+
+    heir = Storage.file_index.replace_content(file_id, file_info.file_id)
+    if heir is not None:
+        Ocr.ocr_progress.enqueue(
+            FileInfo(
+                file_id=heir,
+                file_name=job.file_info.file_name,
+                file_unique_name=job.file_info.file_unique_name,
+            ),
+            job.signed_url,
+        )
+    if not Ocr.ocr_progress.enqueue(
+        FileInfo(
+            file_id=file_id,
+            file_name=file_info.file_name,
+            file_unique_name=file_info.file_unique_name,
+        ),
+        signed_url,
+    ):
+        msg = f"{file_id} file_id is processing"
+        logger.error(msg)
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=msg,
+        )
+    return {
+        "status": "processing",
+        "file_id": file_id,
+    }
+
+
 @app.get("/ocr_progress/{file_id}")
 async def get_ocr_progress(file_id: str = Path(..., min_length=10)) -> dict:
     """get ocr progress of file_id
@@ -151,7 +239,8 @@ async def get_ocr_progress(file_id: str = Path(..., min_length=10)) -> dict:
 
     Returns:
         dict: ocr progress of file_id,
-        status completed will return once finished
+        status completed will return once finished,
+        status failed with error will return if ocr failed
 
     Raises:
         - code 422, If file_id is not valid, min length >= 10
@@ -159,8 +248,8 @@ async def get_ocr_progress(file_id: str = Path(..., min_length=10)) -> dict:
         check whether the file has been process in ocr endpoint or not
     """
 
-    progress = Ocr.ocr_progress.get(file_id)
-    if progress is None:
+    job = Ocr.ocr_progress.get_job(Storage.file_index.resolve(file_id))
+    if job is None:
         msg = f"{file_id} file_id not found"
         logger.error(msg)
         raise HTTPException(
@@ -168,10 +257,87 @@ async def get_ocr_progress(file_id: str = Path(..., min_length=10)) -> dict:
             detail=msg,
         )
 
-    if progress >= 1.0:
-        return {"status": "completed"}
+    return get_job_progress(job)
+
+
+async def _ocr_progress_events(file_id: str) -> AsyncIterator[str]:
+    async for progress in Ocr.progress_broadcaster.subscribe(file_id):
+        yield f"event: {progress['status']}\ndata: {json.dumps(progress)}\n\n"
+
 
-    return {"status": "processing", "progress": progress}
+@app.get("/ocr_progress/{file_id}/stream")
+async def stream_ocr_progress(
+    file_id: str = Path(..., min_length=10)
+) -> StreamingResponse:
+    """stream ocr progress of file_id with Server-Sent Events,
+    instead of polling ocr_progress endpoint
+
+    Event name is the status of progress, event data is the same as
+    ocr_progress endpoint. Progress events are sent when progress changed,
+    and the stream ends after a completed or failed event.
+    Progress changed faster than the client consumes is coalesced
+    to the latest.
+
+    Args:
+        file_id (str): file id
+
+    Returns:
+        StreamingResponse: text/event-stream of progress
+
+    Raises:
+        - code 422, If file_id is not valid, min length >= 10
+        - code 404, If the progress of file_id not found,
+        check whether the file has been process in ocr endpoint or not
+    """
+
+    ocr_file_id = Storage.file_index.resolve(file_id)
+    if Ocr.ocr_progress.get_job(ocr_file_id) is None:
+        msg = f"{file_id} file_id not found"
+        logger.error(msg)
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=msg,
+        )
+
+    return StreamingResponse(
+        _ocr_progress_events(ocr_file_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/embedding_cache_stats")
+async def get_embedding_cache_stats() -> dict:
+    """get hits, misses and size of embedding cache, for sizing the cache
+
+    Returns:
+        dict: embedding cache stats, status disabled will return
+        if embedding cache is disabled
+    """
+
+    if Embedding.cache is None:
+        return {"status": "disabled"}
+
+    return Embedding.cache.stats()
+
+
+def _check_ready(file_id: str) -> None:
+    """raise 409 if the first ingestion of file_id has not completed,
+    a re-ingested file is searchable with its previous content"""
+
+    ocr_file_id = Storage.file_index.resolve(file_id)
+    if Storage.file_index.get_ready_at(ocr_file_id) is not None:
+        return
+
+    # not marked ready, ingested before readiness is marked or processing
+    job = Ocr.ocr_progress.get_job(ocr_file_id)
+    if job is not None and job.status in (JOB_PENDING, JOB_PROCESSING):
+        msg = f"{file_id} file_id is processing"
+        logger.error(msg)
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=msg,
+        )
 
 
 @app.post("/extract")
@@ -188,10 +354,45 @@ async def extract(payload: ExtractPayload) -> dict:
 
     Raises:
         - code 422, If payload is invalid
+        - code 409, If file_id is processing
         - code 500, If internal error happened.
     """
 
+    _check_ready(payload.file_id)
     ex = Extract()
-    answer = ex.generate_answer(payload.query, payload.file_id, payload.api)
+    answer = ex.generate_answer(
+        payload.query,
+        payload.file_id,
+        payload.api,
+        top_k=payload.top_k or 0,
+        ef=payload.ef or 0,
+    )
 
     return {"answer": answer}
+
+
+@app.post("/extract_batch")
+async def extract_batch(payload: ExtractBatchPayload) -> dict:
+    """generate answers of many queries on the same file, queries are
+        searched together and answered concurrently
+
+    Args:
+        payload (ExtractBatchPayload): A payload containing the queries and
+        file_id which related to the queries
+
+    Returns:
+        dict: answers in the same order as queries
+
+    Raises:
+        - code 422, If payload is invalid
+        - code 409, If file_id is processing
+        - code 500, If internal error happened.
+    """
+
+    _check_ready(payload.file_id)
+    ex = Extract()
+    answers = await ex.generate_answer_batch(
+        payload.queries, payload.file_id, payload.api
+    )
+
+    return {"answers": answers}
@@ -0,0 +1,31 @@
+"""ocr job models"""
+
+from pydantic import BaseModel
+from app.model.file_info import FileInfo
+
+JOB_PENDING = "pending"
+"""job is waiting for worker"""
+
+JOB_PROCESSING = "processing"
+"""job is claimed by worker"""
+
+JOB_COMPLETED = "completed"
+"""job is completed"""
+
+JOB_FAILED = "failed"
+"""job is failed after max attempts"""
+
+
+class OcrJob(BaseModel):
+    """ocr job model"""
+
+    file_info: FileInfo
+    signed_url: str
+    status: str = JOB_PENDING
+    progress: float = 0
+    attempts: int = 0
+    """times the job has been claimed by worker"""
+    error: str = ""
+    lease: str = ""
+    """token of the latest claim, only the worker holding it can
+    checkpoint, complete or fail the job"""
@@ -1,5 +1,6 @@
 """model class"""
 
+from typing import Annotated
 from loguru import logger
 from pydantic import BaseModel, Field, HttpUrl, field_validator
 
@@ -9,6 +10,29 @@ API_OPENAI = "OpenAI"
 API_HUNYUAN = "hunyuan"
 """api for Tencent hunyuan model"""
 
+EXTRACT_BATCH_MAX_QUERIES = 100
+"""max queries of a extract batch request"""
+
+EXTRACT_MAX_TOP_K = 100
+"""max relevant texts of a extract request"""
+
+EXTRACT_MAX_EF = 1000
+"""max candidates examined by vector search of a extract request"""
+
+
+def _validate_api(value: str) -> str:
+    """check api value is valid or not"""
+
+    allowed_values = {API_OPENAI, API_HUNYUAN}
+    if value not in allowed_values:
+        msg = (
+            f"api must be either {API_OPENAI} or {API_HUNYUAN}"
+            f", or empty to default {API_OPENAI}"
+        )
+        logger.error(msg)
+        raise ValueError(msg)
+    return value
+
 
 class OcrPayload(BaseModel):
     """ocr endpoint payload"""
@@ -17,6 +41,16 @@ class OcrPayload(BaseModel):
     """signed url
     """
 
+    file_id: str | None = Field(
+        None,
+        min_length=10,
+        description="existed file_id to re-ingest with the document of "
+        "signed_url, only changed content is embedded again.",
+    )
+    """existed file_id to re-ingest with the document of signed_url,
+    only changed content is embedded again.
+    """
+
 
 class ExtractPayload(BaseModel):
     """extract endpoint paylod"""
@@ -37,17 +71,59 @@ class ExtractPayload(BaseModel):
     """LLM provider api, could be OpenAI or hunyuan, default to OpenAI.
     """
 
+    top_k: int | None = Field(
+        None,
+        ge=1,
+        le=EXTRACT_MAX_TOP_K,
+        description="relevant texts to search and send to LLM, "
+        "default to EXTRACT_TOP_K.",
+    )
+    """relevant texts to search and send to LLM, default to EXTRACT_TOP_K.
+    """
+
+    ef: int | None = Field(
+        None,
+        ge=1,
+        le=EXTRACT_MAX_EF,
+        description="candidates examined by vector search, larger is better "
+        "recall and slower, default to VDB_SEARCH_EF.",
+    )
+    """candidates examined by vector search, larger is better recall and
+    slower, default to VDB_SEARCH_EF.
+    """
+
+    @field_validator("api")
+    @classmethod
+    def validate_api(cls, value):
+        """check api value is valid or not"""
+
+        return _validate_api(value)
+
+
+class ExtractBatchPayload(BaseModel):
+    """extract batch endpoint payload"""
+
+    queries: list[Annotated[str, Field(min_length=3)]] = Field(
+        ..., min_length=1, max_length=EXTRACT_BATCH_MAX_QUERIES
+    )
+    """queries of the same file
+    """
+
+    file_id: str = Field(..., min_length=10)
+    """file id
+    """
+
+    api: str = Field(
+        API_OPENAI,
+        description="LLM provider api, could be OpenAI or hunyuan, "
+        "default to OpenAI.",
+    )
+    """LLM provider api, could be OpenAI or hunyuan, default to OpenAI.
+    """
+
     @field_validator("api")
     @classmethod
     def validate_api(cls, value):
         """check api value is valid or not"""
 
-        allowed_values = {API_OPENAI, API_HUNYUAN}
-        if value not in allowed_values:
-            msg = (
-                f"api must be either {API_OPENAI} or {API_HUNYUAN}"
-                f", or empty to default {API_OPENAI}"
-            )
-            logger.error(msg)
-            raise ValueError(msg)
-        return value
+        return _validate_api(value)
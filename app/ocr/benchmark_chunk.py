@@ -0,0 +1,107 @@
+"""benchmark chunking ocr paragraphs into embedding content list
+
+Compare with the previous chunker which re-count tokens of the accumulated
+string for every paragraph, and check the output is identical.
+
+Run from repo root: `python -m app.ocr.benchmark_chunk`
+"""
+
+# pylint: disable=protected-access
+
+import json
+import time
+import textwrap
+from loguru import logger
+from app.embedding.embedding import Embedding
+from app.helper.file import FileInfo
+from app.helper.token import num_tokens
+from app.ocr.ocr import Ocr
+
+OCR_JSON = "app/ocr-json/建築基準法施行令_all_content.json"
+MAX_PARAGRAPH_LEN = 512
+
+
+def load_paragraphs(file_path: str = OCR_JSON) -> list[dict]:
+    """split ocr result text of file_path into sentence paragraphs,
+    long sentence (table of contents) is split into MAX_PARAGRAPH_LEN pieces
+
+    Returns:
+        list[dict]: paragraphs like analyzeResult.paragraphs
+    """
+
+    with open(file_path, "r", encoding="utf-8") as f:
+        text: str = json.load(f)["ocr_result"]
+
+    paragraphs: list[dict] = []
+    for sentence in text.split("。"):
+        sentence += "。"
+        for i in range(0, len(sentence), MAX_PARAGRAPH_LEN):
+            paragraphs.append({"content": sentence[i : i + MAX_PARAGRAPH_LEN]})
+    return paragraphs
+
+
+def quadratic_chunk(paragraphs: list[dict], max_token: int) -> list[str]:
+    """the previous chunker, for comparison"""
+
+    embedding_content = ""
+    embedding_content_list: list[str] = []
+    for p in paragraphs:
+        if "content" not in p:
+            continue
+
+        content = p["content"]
+        if num_tokens(embedding_content + content) <= max_token:
+            embedding_content += content
+            continue
+
+        if len(embedding_content) != 0:
+            embedding_content_list.append(embedding_content)
+            embedding_content = ""
+
+        if num_tokens(content) > max_token:
+            embedding_content_list.extend(textwrap.wrap(content, max_token))
+        else:
+            embedding_content = content
+
+    if len(embedding_content) > 0:
+        embedding_content_list.append(embedding_content)
+    return embedding_content_list
+
+
+def _best_of(func, *args, repeat: int = 5) -> tuple[float, list[str]]:
+    best = float("inf")
+    result: list[str] = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main() -> None:
+    """run benchmark and print result"""
+
+    logger.disable("app")
+    paragraphs = load_paragraphs()
+    ocr = Ocr(
+        "",
+        FileInfo(file_id="a-benchmark", file_name="", file_unique_name=""),
+    )
+    default_max_token = Embedding.EMBEDDING_MAX_TOKEN
+
+    print(f"paragraphs: {len(paragraphs)}")
+    print("max_token | chunks | quadratic (ms) | linear (ms) | identical")
+    for max_token in (1024, 4096, 16384, 65536):
+        Embedding.EMBEDDING_MAX_TOKEN = max_token
+        old_time, old = _best_of(quadratic_chunk, paragraphs, max_token)
+        new_time, new = _best_of(ocr._get_embedding_content_list, paragraphs)
+        print(
+            f"{max_token:9} | {len(new):6} | {old_time * 1000:14.2f}"
+            f" | {new_time * 1000:11.2f} | {old == new}"
+        )
+
+    Embedding.EMBEDDING_MAX_TOKEN = default_max_token
+
+
+if __name__ == "__main__":
+    main()
@@ -1,65 +1,104 @@
 """OCR operations"""
 
+import io
 import os
 import json
+import sys
 import random
-import asyncio
+import hashlib
+import shutil
 import tempfile
 import textwrap
-import traceback
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import BinaryIO, Iterable, Iterator
 import requests
+from tcvectordb.model.document import Document
 from loguru import logger
 from app.embedding.embedding import Embedding
+from app.embedding.worker_pool import EmbeddingWorkerPool
 from app.vectordb.vectordb import VDB
-from app.helper.safe_dict import ThreadSafeDict
-from app.helper.uuid import get_uuid
+from app.vectordb.write_buffer import VDBWriteBuffer
+from app.job.job_queue import JobQueue
+from app.job.progress import ProgressBroadcaster
+from app.ocr.stream import iter_paragraphs
+from app.ocr.page import (
+    is_multi_page,
+    is_pdf,
+    count_pages,
+    extract_text_layer,
+    split_page_ranges,
+    get_page_number,
+)
 from app.helper.token import num_tokens
 from app.helper.file import FileInfo
-from app.helper.retry import retry
+from app.storage.storage import Storage
 from app.exceptions.exceptions import (
     InvalidResponseFromUpStream,
     InternalProcessError,
 )
 
 
+# pylint: disable=too-few-public-methods
 class Ocr:
     """OCR operations"""
 
-    # FIXME: It's better to save status into database,
-    # in memory dict will clear after server stop
-    ocr_progress: ThreadSafeDict = ThreadSafeDict()
-    """ocr progress dict, key is file_id, value is progress"""
-
-    def __init__(self, singed_url: str, file_info: FileInfo) -> None:
+    OCR_STREAM_PARSE = int(os.getenv("OCR_STREAM_PARSE", "1"))
+    """
+    Parse ocr result json in streaming mode, paragraphs are yielded to
+    chunker one by one instead of loading the whole ocr result,
+    set to 0 to disable
+    """
+
+    OCR_PAGE_PARALLEL = int(os.getenv("OCR_PAGE_PARALLEL", "0"))
+    """
+    Split multi-page pdf and tiff into page ranges and ocr them in parallel
+    with a process pool, set to 1 to enable
+    """
+
+    OCR_TEXT_LAYER = int(os.getenv("OCR_TEXT_LAYER", "0"))
+    """
+    Extract embedded text layer of pdf pages as paragraphs,
+    only pages without text layer need ocr, set to 1 to enable.
+    Pages are read from a temporary file, so every pdf is saved to disk
+    first instead of streamed to ocr
+    """
+
+    OCR_PAGE_WORKER_NUM = int(
+        os.getenv("OCR_PAGE_WORKER_NUM", str(os.cpu_count() or 1))
+    )
+    """process count of page ocr pool in each worker process"""
+
+    _page_pool: ProcessPoolExecutor | None = None
+    """page ocr pool, created lazily once per process"""
+
+    READ_BUFFER_SIZE = 1024 * 1024
+    """buffer size when reading file stream"""
+
+    ocr_progress: JobQueue = JobQueue()
+    """ocr job queue, also keep ocr progress of file_id,
+    shared by api and worker processes"""
+
+    progress_broadcaster: ProgressBroadcaster = ProgressBroadcaster(
+        ocr_progress
+    )
+    """push ocr progress to subscribers in api process"""
+
+    def __init__(
+        self, singed_url: str, file_info: FileInfo, lease: str = ""
+    ) -> None:
         """init ocr instance
 
         Args:
             singed_url (str): singed url for downloaded file
             file_info (FileInfo): file info
+            lease (str, optional): lease of the claimed job, to checkpoint
+            the job. Defaults to "".
         """
 
         self.singed_url = singed_url
         self.file_info = file_info
-
-    # pylint: disable=broad-exception-caught
-    async def perform_ocr_in_background(self) -> None:
-        """ocr may take long time, perform ocr operation in background"""
-
-        if not self.file_info.is_valid():
-            logger.error(f"file_info invalid, file_info: {self.file_info}")
-            return
-
-        await asyncio.to_thread(self._sync_perform_ocr)
-
-    def _sync_perform_ocr(self) -> None:
-        try:
-            self.perform_ocr()
-        except Exception as e:
-            Ocr.ocr_progress.delete(self.file_info.file_name)
-            logger.error(
-                f"perform_ocr failed, file_info: {self.file_info}, e: {e}"
-                f", {traceback.format_exc()}"
-            )
+        self.lease = lease
 
     def perform_ocr(self) -> None:
         """Simulates running an OCR service on a file for a given a signed url
@@ -72,60 +111,73 @@ class Ocr:
         file_id = self.file_info.file_id
         Ocr.ocr_progress.set(file_id, 0.01)
 
-        # download file first
-        tmp_file_path = self._download_file(self.singed_url)
-        Ocr.ocr_progress.set(file_id, 0.1)
+        # open file as a stream, ocr consume it in place,
+        # the stream is closed on both success and failure
+        with self._open_file() as file_stream:
+            Ocr.ocr_progress.set(file_id, 0.1)
 
-        try:
             # simulate ocr
             logger.info("start ocr")
-            paragraphs = self._simulate_ocr_paragraphs(
-                tmp_file_path, self.file_info.file_name
-            )
-            logger.info("ocr success")
+            if self._is_by_page(self.file_info.file_name):
+                # parsed while chunking, in page order
+                paragraphs = self._iter_paragraphs_by_page(
+                    file_stream, self.file_info.file_name
+                )
+            elif Ocr.OCR_STREAM_PARSE:
+                # parsed while chunking
+                paragraphs = self._simulate_iter_ocr_paragraphs(
+                    file_stream, self.file_info.file_name
+                )
+            else:
+                paragraphs = self._simulate_ocr_paragraphs(
+                    file_stream, self.file_info.file_name
+                )
+                logger.info("ocr success")
 
             embedding_content_list = self._get_embedding_content_list(
                 paragraphs
             )
-            if len(embedding_content_list) == 0:
-                msg = "embedding_content_list is empty"
-                logger.error(msg)
-                raise InvalidResponseFromUpStream(msg)
 
-            Ocr.ocr_progress.set(file_id, 0.11)
+        if len(embedding_content_list) == 0:
+            msg = "embedding_content_list is empty"
+            logger.error(msg)
+            raise InvalidResponseFromUpStream(msg)
+
+        Ocr.ocr_progress.set(file_id, 0.11)
 
-            # embedding ocr result
-            logger.info("start embedding")
-            self._embedding_and_save_vector(embedding_content_list, file_id)
-            logger.info(
-                "_embedding success"
-                f", embedding_content_list len: {len(embedding_content_list)}"
-            )
-        except Exception as e:
-            logger.error(
-                f"failed after download file, remove downloaded file, e: {e}"
-            )
-            os.remove(tmp_file_path)
-            raise e
+        # embedding ocr result
+        logger.info("start embedding")
+        self._embedding_and_save_vector(embedding_content_list, file_id)
+        logger.info(
+            "_embedding success"
+            f", embedding_content_list len: {len(embedding_content_list)}"
+        )
 
-        # Delete the temporary file
-        os.remove(tmp_file_path)
-        Ocr.ocr_progress.set(file_id, 1)
+        # progress becomes 1 once the worker marks the job completed,
+        # after the file is marked ready
         logger.info("all completed")
 
+    def _is_by_page(self, filename: str) -> bool:
+        """return True if file should be processed page by page"""
+
+        if Ocr.OCR_TEXT_LAYER and is_pdf(filename):
+            return True
+
+        return bool(Ocr.OCR_PAGE_PARALLEL) and is_multi_page(filename)
+
     def _simulate_ocr_paragraphs(
-        self, file_path: str, filename: str
+        self, file_stream: BinaryIO, filename: str
     ) -> list[str]:
         """Simulate ocr
 
         Args:
-            file_path (str): The path of file which need ocr
+            file_stream (BinaryIO): The stream of file which need ocr
 
         Returns:
             list: ocr paragraphs content list
         """
 
-        logger.info(f"simulate ocr with file_path: {file_path}")
+        self._simulate_send_file(file_stream)
         ocr_result = self._simulate_get_ocr_result(filename)
         err_msg = ""
         if "analyzeResult" not in ocr_result:
@@ -143,6 +195,167 @@ class Ocr:
         logger.info(f"paragraphs: {paragraphs[0]}, len: {len(paragraphs)}")
         return paragraphs
 
+    def _simulate_iter_ocr_paragraphs(
+        self, file_stream: BinaryIO, filename: str
+    ) -> Iterator[dict]:
+        """Simulate ocr, parse ocr result in streaming mode
+
+        Args:
+            file_stream (BinaryIO): The stream of file which need ocr
+
+        Yields:
+            dict: ocr paragraph
+        """
+
+        self._simulate_send_file(file_stream)
+        ocr_result_path = self._simulate_get_ocr_result_path(filename)
+        count = 0
+        with open(ocr_result_path, "r", encoding="utf-8") as f:
+            for p in iter_paragraphs(f):
+                if count == 0:
+                    logger.info(f"paragraphs: {p}")
+                count += 1
+                yield p
+        logger.info(f"ocr success, paragraphs len: {count}")
+
+    def _iter_paragraphs_by_page(
+        self, file_stream: BinaryIO, filename: str
+    ) -> Iterator[dict]:
+        """Get paragraphs page by page, from text layer of pdf pages,
+        and simulate ocr of other pages by page ranges
+
+        Pages need random access, so file stream is saved to
+        a temporary file in this mode.
+
+        Args:
+            file_stream (BinaryIO): The stream of file which need ocr
+
+        Raises:
+            InvalidResponseFromUpStream: if no paragraphs found
+
+        Yields:
+            dict: paragraph, in the same order of
+            analyzeResult.paragraphs of whole file ocr result
+        """
+
+        suffix = os.path.splitext(filename)[1]
+        with tempfile.NamedTemporaryFile(suffix=suffix) as f:
+            shutil.copyfileobj(file_stream, f, Ocr.READ_BUFFER_SIZE)
+            f.flush()
+
+            text_pages: dict[int, list[dict]] = {}
+            if Ocr.OCR_TEXT_LAYER and is_pdf(filename):
+                page_count, text_pages = extract_text_layer(f.name)
+            else:
+                page_count = count_pages(f.name)
+            page_ranges = split_page_ranges(
+                [p for p in range(1, page_count + 1) if p not in text_pages]
+            )
+            logger.info(
+                f"ocr by page, page_count: {page_count}"
+                f", text layer pages: {len(text_pages)}"
+                f", ocr page_ranges len: {len(page_ranges)}"
+            )
+
+            count = 0
+            next_page = 1
+            for paragraphs in self._simulate_ocr_page_ranges(
+                f.name, filename, page_count, page_ranges
+            ):
+                for p in paragraphs:
+                    # text layer pages before this ocr page
+                    page = get_page_number(p)
+                    while next_page < page:
+                        text_paragraphs = text_pages.pop(next_page, [])
+                        count += len(text_paragraphs)
+                        yield from text_paragraphs
+                        next_page += 1
+                    count += 1
+                    yield p
+
+            for page in sorted(text_pages):
+                count += len(text_pages[page])
+                yield from text_pages[page]
+
+        if count == 0:
+            msg = "ocr_result paragraphs is empty"
+            logger.error(msg)
+            raise InvalidResponseFromUpStream(msg)
+        logger.info(f"ocr success, paragraphs len: {count}")
+
+    def _simulate_ocr_page_ranges(
+        self,
+        file_path: str,
+        filename: str,
+        page_count: int,
+        page_ranges: list[tuple[int, int]],
+    ) -> Iterator[list[dict]]:
+        """Simulate ocr page ranges of file,
+        in parallel with page ocr pool if OCR_PAGE_PARALLEL enabled
+
+        Yields:
+            list[dict]: ocr paragraphs of each page range, in page order
+        """
+
+        if len(page_ranges) == 0:
+            return
+
+        # choose once, all page ranges share the same ocr result
+        ocr_result_path = self._simulate_get_ocr_result_path(filename)
+        task_args = [
+            (file_path, ocr_result_path, first, last)
+            for first, last in page_ranges
+        ]
+        if page_ranges[-1][1] == page_count:
+            # simulated ocr result may have more pages than the file
+            task_args[-1] = (
+                file_path,
+                ocr_result_path,
+                page_ranges[-1][0],
+                sys.maxsize,
+            )
+
+        if not Ocr.OCR_PAGE_PARALLEL or len(task_args) == 1:
+            for args in task_args:
+                yield Ocr._simulate_ocr_page_range(*args)
+            return
+
+        # map yields results in submitted order, which is page order
+        yield from Ocr._get_page_pool().map(
+            Ocr._simulate_ocr_page_range, *zip(*task_args)
+        )
+
+    @staticmethod
+    def _simulate_ocr_page_range(
+        file_path: str, ocr_result_path: str, first_page: int, last_page: int
+    ) -> list[dict]:
+        """Simulate ocr of a page range, run in page ocr pool
+
+        Returns:
+            list[dict]: ocr paragraphs of pages from first_page to last_page
+        """
+
+        logger.info(
+            f"simulate ocr page range, file_path: {file_path}"
+            f", first_page: {first_page}, last_page: {last_page}"
+        )
+        with open(ocr_result_path, "r", encoding="utf-8") as f:
+            return [
+                p
+                for p in iter_paragraphs(f)
+                if first_page <= get_page_number(p) <= last_page
+            ]
+
+    @classmethod
+    def _get_page_pool(cls) -> ProcessPoolExecutor:
+        """return page ocr pool of current process"""
+
+        if cls._page_pool is None:
+            cls._page_pool = ProcessPoolExecutor(
+                max_workers=max(1, Ocr.OCR_PAGE_WORKER_NUM)
+            )
+        return cls._page_pool
+
     def _simulate_get_ocr_result(self, filename: str) -> dict:
         """
         Simulates get OCR json result
@@ -151,6 +364,18 @@ class Ocr:
             dict: The parsed data from the randomly chosen JSON file.
         """
 
+        file_path = self._simulate_get_ocr_result_path(filename)
+        with open(file_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _simulate_get_ocr_result_path(self, filename: str) -> str:
+        """
+        Simulates get OCR json result file path
+
+        Returns:
+            str: The randomly chosen JSON file path.
+        """
+
         json_dir = "app/ocr-json"
         if filename.startswith("建築基準法施行令"):
             chosen_file = "建築基準法施行令.json"
@@ -162,31 +387,57 @@ class Ocr:
 
         file_path = os.path.join(json_dir, chosen_file)
         logger.debug(f"filename: {filename}, chosen_file: {chosen_file}")
+        return file_path
 
-        with open(file_path, "r", encoding="utf-8") as f:
-            return json.load(f)
+    def _simulate_send_file(self, file_stream: BinaryIO) -> None:
+        """Simulate sending file stream to ocr service"""
+
+        size = 0
+        while True:
+            chunk = file_stream.read(Ocr.READ_BUFFER_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+        logger.info(f"simulate ocr with file size: {size}")
+
+    @contextmanager
+    def _open_file(self) -> Iterator[BinaryIO]:
+        """open file to ocr as a stream
+
+        Read from storage directly if singed url is a valid signed url of
+        the object uploaded for the file, otherwise download from singed url
+        with a large buffer
+
+        Yields:
+            BinaryIO: file stream
+        """
+
+        if Storage.is_issued_url(self.singed_url, self.file_info):
+            object_name = self.file_info.file_unique_name
+            logger.info(f"open file from storage, object_name: {object_name}")
+            storage = Storage(Storage.RAG_Bucket)
+            with storage.open_object(object_name) as file_stream:
+                yield file_stream
+            return
 
-    def _download_file(self, singed_url: str) -> str:
         timeout = 10 * 60  # 10 minutes in seconds
         logger.info(
-            f"start download, singed_url: {singed_url}, timeout: {timeout}"
+            f"start download, singed_url: {self.singed_url}, timeout: {timeout}"
         )
 
         # Download the file from the signed URL with streaming
-        response = requests.get(singed_url, stream=True, timeout=timeout)
-        response.raise_for_status()
-
-        # Create a temporary file
-        with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
-            # Write the response content to the temporary file
-            for chunk in response.iter_content(chunk_size=8192):
-                tmp_file.write(chunk)
-            tmp_file_path = tmp_file.name
-
-        logger.info(f"write to tmp_file_path: {tmp_file_path} success")
-        return tmp_file_path
+        with requests.get(
+            self.singed_url, stream=True, timeout=timeout
+        ) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            yield io.BufferedReader(
+                response.raw, buffer_size=Ocr.READ_BUFFER_SIZE
+            )
 
-    def _get_embedding_content_list(self, paragraphs: list) -> list[str]:
+    def _get_embedding_content_list(
+        self, paragraphs: Iterable[dict]
+    ) -> list[str]:
         # Seems the oce result has divided the content
         # based on its structure and hierarchy, which is the paragraphs,
         # resulting in more semantically coherent chunks,
@@ -194,7 +445,13 @@ class Ocr:
         # read more: [Chunking Strategies for LLM Applications | Pinecone]
         # (https://www.pinecone.io/learn/chunking-strategies/)
 
-        embedding_content = ""
+        # Keep the paragraphs of current chunk and its running token count,
+        # count tokens once per paragraph and join each chunk once,
+        # instead of re-counting and copying the accumulated string.
+        # Token count of a chunk is the sum of its paragraphs token count.
+        chunk_parts: list[str] = []
+        chunk_tokens = 0
+        chunk_len = 0
         embedding_content_list: list[str] = []
         max_token = Embedding.EMBEDDING_MAX_TOKEN
         total_content_len = 0
@@ -204,31 +461,38 @@ class Ocr:
                 continue
 
             content = p["content"]
+            content_tokens = num_tokens(content)
 
             total_content_len += len(content)
-            if num_tokens(embedding_content + content) <= max_token:
+            if chunk_tokens + content_tokens <= max_token:
                 # combine
-                embedding_content += content
+                chunk_parts.append(content)
+                chunk_tokens += content_tokens
+                chunk_len += len(content)
                 continue
 
             # oversize, add to list, and reset to content
-            if len(embedding_content) != 0:
+            if chunk_len != 0:
                 # add to list and reset
-                embedding_content_list.append(embedding_content)
-                embedding_content = ""
+                embedding_content_list.append("".join(chunk_parts))
+            chunk_parts = []
+            chunk_tokens = 0
+            chunk_len = 0
 
-            if num_tokens(content) > max_token:
+            if content_tokens > max_token:
                 # content in paragraphs oversize, split it with len,
                 # here we use max_token as len for convenient
                 split_list = textwrap.wrap(content, max_token)
                 for s in split_list:
                     embedding_content_list.append(s)
             else:
-                embedding_content = content
+                chunk_parts.append(content)
+                chunk_tokens = content_tokens
+                chunk_len = len(content)
 
         # add last one
-        if len(embedding_content) > 0:
-            embedding_content_list.append(embedding_content)
+        if chunk_len > 0:
+            embedding_content_list.append("".join(chunk_parts))
 
         self._check_embedding_content_list(
             embedding_content_list, total_content_len
@@ -263,6 +527,7 @@ class Ocr:
         else:
             logger.info(f"embedding_content_list: {embedding_content_list}")
 
+    # pylint: disable=too-many-locals
     def _embedding_and_save_vector(
         self, embedding_content_list: list[str], collection: str
     ) -> None:
@@ -270,25 +535,194 @@ class Ocr:
         if list_len == 0:
             logger.warning("embedding_content_list is empty")
 
-        em = Embedding()
+        file_id = self.file_info.file_id
+        pool = EmbeddingWorkerPool()
+        start = Ocr.ocr_progress.get(file_id)
         # 0.1 for other task
-        remaining = (1 - Ocr.ocr_progress.get(self.file_info.file_id)) - 0.1
+        remaining = (1 - start) - 0.1
 
         vdb = VDB.default_vdb(collection)
 
-        for index, content in enumerate(embedding_content_list):
-            vec = retry(em.embedding, content)
-
-            doc_id = get_uuid()
-            doc = vdb.new_document(str(doc_id), vec, content)
-            retry(vdb.upsert_data, [doc])
-            logger.info(f"embedding and upsert_data success, doc_id: {doc_id}")
+        # chunks unchanged since last ingestion of file_id keep their
+        # documents, only new or changed chunks need embedding
+        doc_id_list, write_index_list, vanished_doc_id_list = self._diff_chunks(
+            embedding_content_list
+        )
+        if self._is_legacy(vdb, file_id):
+            # ingested before chunk hashes are kept, documents have random
+            # ids, rebuild all and delete documents not of the new chunks
+            doc_id_set = set(doc_id_list)
+            vanished_doc_id_list = [
+                doc_id
+                for doc_id in vdb.list_document_ids()
+                if doc_id not in doc_id_set
+            ]
+
+        # resume from checkpoint of previous attempt, only embedding
+        # contents not written, content_list[i] is embedding_content_list[
+        # index_list[i]]
+        done_index_set = Ocr.ocr_progress.get_checkpoint(file_id)
+        index_list = [
+            i
+            for i in write_index_list
+            if Ocr.get_doc_index(doc_id_list[i]) not in done_index_set
+        ]
+        content_list = [embedding_content_list[i] for i in index_list]
+        logger.info(
+            f"unchanged: {list_len - len(write_index_list)}"
+            f", done in checkpoint: {len(write_index_list) - len(index_list)}"
+            f", remaining: {len(index_list)}"
+            f", vanished: {len(vanished_doc_id_list)}"
+        )
 
+        # progress advance once documents are written into vector db
+        written = list_len - len(index_list)
+
+        def _on_flush(document_list: list[Document]) -> None:
+            nonlocal written
+            Ocr.ocr_progress.add_checkpoint(
+                file_id,
+                self.lease,
+                [
+                    Ocr.get_doc_index(VDB.get_document_id(doc))
+                    for doc in document_list
+                ],
+            )
+            written += len(document_list)
             Ocr.ocr_progress.set(
-                self.file_info.file_id, (index / list_len) * remaining
+                file_id, start + (written / list_len) * remaining
+            )
+
+        def _new_document(i: int, vec: list[float]) -> Document:
+            # document id is deterministic, upsert again will overwrite
+            index = index_list[i]
+            return vdb.new_document(
+                doc_id_list[index], vec, embedding_content_list[index]
             )
 
-            if index % 10 == 0:
+        # embedding stage and upsert stage run concurrently,
+        # upsert stage is a write-behind buffer flushed by its own thread
+        with VDBWriteBuffer(vdb, on_flush=_on_flush) as buffer:
+            for i, vec_list in pool.iter_embedding(content_list):
+                doc_list = []
+                for offset, vec in enumerate(vec_list):
+                    if vec is not None:
+                        doc_list.append(_new_document(i + offset, vec))
+                buffer.add(doc_list)
+
                 logger.info(
-                    f"embedding_content_list len: {list_len}, index: {index}"
+                    f"embedding success, embedding_content_list len: {list_len}"
+                    f", index: {index_list[i]}"
+                    f", embedding queue_depth: {pool.queue_depth}"
+                    f", upsert queue_depth: {buffer.queue_depth}"
                 )
+
+            if len(pool.failed_index_list) > 0:
+                logger.info(f"retry failed index: {pool.failed_index_list}")
+                vec_dict = pool.retry_failed(content_list)
+                doc_list = []
+                for i, vec in vec_dict.items():
+                    doc_list.append(_new_document(i, vec))
+                buffer.add(doc_list)
+
+        if len(pool.failed_index_list) > 0:
+            failed = [index_list[i] for i in pool.failed_index_list]
+            msg = f"embedding failed, index: {failed}"
+            logger.error(msg)
+            raise InvalidResponseFromUpStream(msg)
+
+        # delete after new chunks written, search always has content
+        vdb.delete_data(vanished_doc_id_list)
+        Storage.file_index.set_chunks(
+            file_id,
+            {
+                doc_id: Ocr.get_chunk_hash(content)
+                for doc_id, content in zip(doc_id_list, embedding_content_list)
+            },
+        )
+        Storage.keyword_index.set_chunks(
+            file_id, dict(zip(doc_id_list, embedding_content_list))
+        )
+
+        logger.info(f"embedding and upsert_data success, written: {written}")
+
+    def _is_legacy(self, vdb, file_id: str) -> bool:
+        """return whether vector collection of file_id was ingested before
+        chunk hashes are kept
+
+        file_id is marked chunked before its collection is created, a legacy
+        one is marked once rebuilt, with its chunks. Local backend always
+        keeps chunk hashes.
+        """
+
+        if Storage.file_index.is_chunked(file_id):
+            return False
+        if isinstance(vdb, VDB) and vdb.is_collection_existed() is not None:
+            return True
+        Storage.file_index.set_chunked(file_id)
+        return False
+
+    def _diff_chunks(
+        self, embedding_content_list: list[str]
+    ) -> tuple[list[str], list[int], list[str]]:
+        """diff embedding content list with chunks of last ingestion
+
+        Documents of chunks with the same content are reused,
+        new documents get ids after the largest index of last ingestion,
+        which are the same as before for the first ingestion.
+
+        Returns:
+            tuple[list[str], list[int], list[str]]: document id of each
+            content, index of contents need to write,
+            document id of vanished chunks need to delete
+        """
+
+        file_id = self.file_info.file_id
+        stored = Storage.file_index.get_chunks(file_id)
+
+        # content hash -> document ids can be reused, in index order
+        reusable: dict[str, list[str]] = {}
+        for doc_id in sorted(stored, key=Ocr.get_doc_index):
+            reusable.setdefault(stored[doc_id], []).append(doc_id)
+        next_index = (
+            max((Ocr.get_doc_index(doc_id) for doc_id in stored), default=-1)
+            + 1
+        )
+
+        doc_id_list: list[str] = []
+        write_index_list: list[int] = []
+        for i, content in enumerate(embedding_content_list):
+            doc_ids = reusable.get(Ocr.get_chunk_hash(content))
+            if doc_ids:
+                doc_id_list.append(doc_ids.pop(0))
+                continue
+
+            doc_id_list.append(Ocr.get_doc_id(file_id, next_index))
+            next_index += 1
+            write_index_list.append(i)
+
+        vanished_doc_id_list = [
+            doc_id for doc_ids in reusable.values() for doc_id in doc_ids
+        ]
+        return doc_id_list, write_index_list, vanished_doc_id_list
+
+    @classmethod
+    def get_doc_id(cls, file_id: str, index: int) -> str:
+        """return vector document id of chunk index of file_id"""
+
+        return f"{file_id}-{index}"
+
+    @classmethod
+    def get_chunk_hash(cls, content: str) -> str:
+        """return hash of chunk content and embedding model,
+        chunk with the same hash need not embedding again"""
+
+        return hashlib.sha256(
+            f"{Embedding.EMBEDDING_MODEL}\0{content}".encode("utf-8")
+        ).hexdigest()
+
+    @classmethod
+    def get_doc_index(cls, doc_id: str) -> int:
+        """return chunk index of vector document id"""
+
+        return int(doc_id.rsplit("-", 1)[1])
@@ -0,0 +1,170 @@
+"""split multi-page document into page ranges, extract pdf text layer"""
+
+import os
+import struct
+from typing import BinaryIO
+from loguru import logger
+from pypdf import PdfReader
+
+OCR_PAGES_PER_TASK = int(os.getenv("OCR_PAGES_PER_TASK", "10"))
+"""pages of a page range processed by one ocr task"""
+
+OCR_TEXT_LAYER_MIN_CHARS = int(os.getenv("OCR_TEXT_LAYER_MIN_CHARS", "10"))
+"""min non-whitespace characters in text layer of a pdf page to skip ocr"""
+
+MULTI_PAGE_EXTENSIONS = (".pdf", ".tif", ".tiff")
+"""file extensions of document which may have multiple pages"""
+
+
+def is_multi_page(filename: str) -> bool:
+    """return True if file may have multiple pages"""
+
+    return filename.lower().endswith(MULTI_PAGE_EXTENSIONS)
+
+
+def is_pdf(filename: str) -> bool:
+    """return True if file is pdf"""
+
+    return filename.lower().endswith(".pdf")
+
+
+def count_pages(file_path: str) -> int:
+    """return page count of pdf or tiff file, 1 for other images
+
+    Raises:
+        ValueError: if the file is broken
+    """
+
+    if file_path.lower().endswith(".pdf"):
+        return len(PdfReader(file_path).pages)
+
+    if file_path.lower().endswith((".tif", ".tiff")):
+        with open(file_path, "rb") as f:
+            return _count_tiff_pages(f)
+
+    return 1
+
+
+def _count_tiff_pages(f: BinaryIO) -> int:
+    """count image file directories of tiff, without decoding images"""
+
+    header = f.read(16)
+    if header[:2] == b"II":
+        order = "<"
+    elif header[:2] == b"MM":
+        order = ">"
+    else:
+        raise ValueError("invalid tiff header")
+
+    (version,) = struct.unpack(f"{order}H", header[2:4])
+    if version == 42:
+        # offset, entry count and entry size of classic tiff
+        offset_fmt, count_fmt, entry_size = "I", "H", 12
+        (offset,) = struct.unpack(f"{order}I", header[4:8])
+    elif version == 43:
+        # BigTIFF
+        offset_fmt, count_fmt, entry_size = "Q", "Q", 20
+        (offset,) = struct.unpack(f"{order}Q", header[8:16])
+    else:
+        raise ValueError(f"invalid tiff version: {version}")
+
+    offset_size = struct.calcsize(offset_fmt)
+    count_size = struct.calcsize(count_fmt)
+    visited: set[int] = set()
+    while offset != 0:
+        if offset in visited:
+            raise ValueError("invalid tiff, image file directory loop")
+        visited.add(offset)
+
+        f.seek(offset)
+        data = f.read(count_size)
+        if len(data) != count_size:
+            raise ValueError("invalid tiff, image file directory truncated")
+        (entry_count,) = struct.unpack(f"{order}{count_fmt}", data)
+
+        f.seek(entry_count * entry_size, os.SEEK_CUR)
+        data = f.read(offset_size)
+        if len(data) != offset_size:
+            raise ValueError("invalid tiff, image file directory truncated")
+        (offset,) = struct.unpack(f"{order}{offset_fmt}", data)
+
+    return len(visited)
+
+
+def split_page_ranges(
+    page_list: list[int], pages_per_task: int = OCR_PAGES_PER_TASK
+) -> list[tuple[int, int]]:
+    """split consecutive pages into ranges
+
+    Args:
+        page_list (list[int]): sorted page numbers, starts from 1
+        pages_per_task (int, optional): max pages of a range.
+        Defaults to OCR_PAGES_PER_TASK.
+
+    Returns:
+        list[tuple[int, int]]: first and last page number of each range,
+        in page order
+    """
+
+    pages_per_task = max(1, pages_per_task)
+    page_ranges: list[tuple[int, int]] = []
+    for page in page_list:
+        if len(page_ranges) > 0:
+            first, last = page_ranges[-1]
+            if page == last + 1 and page - first < pages_per_task:
+                page_ranges[-1] = (first, page)
+                continue
+        page_ranges.append((page, page))
+    return page_ranges
+
+
+def extract_text_layer(
+    file_path: str, min_chars: int = OCR_TEXT_LAYER_MIN_CHARS
+) -> tuple[int, dict[int, list[dict]]]:
+    """extract embedded text layer of pdf pages into ocr paragraphs,
+    each non-empty line of text is a paragraph
+
+    Args:
+        file_path (str): pdf file path
+        min_chars (int, optional): min non-whitespace characters of a page
+        to be treated as having text layer.
+        Defaults to OCR_TEXT_LAYER_MIN_CHARS.
+
+    Returns:
+        tuple[int, dict[int, list[dict]]]: page count, and paragraphs of
+        each page number with text layer, pages without text layer
+        are not included and need ocr
+    """
+
+    reader = PdfReader(file_path)
+    text_pages: dict[int, list[dict]] = {}
+    for page_number, page in enumerate(reader.pages, 1):
+        try:
+            text = page.extract_text() or ""
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            # fallback to ocr for the page
+            logger.warning(
+                f"extract text failed, page_number: {page_number}, e: {e}"
+            )
+            continue
+
+        if len("".join(text.split())) < min_chars:
+            continue
+
+        text_pages[page_number] = [
+            {
+                "content": line.strip(),
+                "boundingRegions": [{"pageNumber": page_number}],
+            }
+            for line in text.splitlines()
+            if len(line.strip()) > 0
+        ]
+
+    return len(reader.pages), text_pages
+
+
+def get_page_number(paragraph: dict) -> int:
+    """return page number of ocr paragraph, 1 if not existed"""
+
+    regions = paragraph.get("boundingRegions") or [{}]
+    return regions[0].get("pageNumber", 1)
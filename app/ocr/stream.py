@@ -0,0 +1,194 @@
+"""streaming parse ocr result json"""
+
+import re
+import json
+from typing import Any, Iterator, TextIO
+from app.exceptions.exceptions import InvalidResponseFromUpStream
+
+READ_CHUNK_SIZE = 64 * 1024
+"""characters read from file each time"""
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_STRUCTURE = re.compile(r'["\[\]{}]')
+_STRING_BODY = re.compile(r'(?:[^"\\]|\\.)*', re.DOTALL)
+_DELIMITERS = " \t\n\r,:]}"
+"""characters may follow a json value"""
+
+
+class _Reader:
+    """buffered reader of json text, only keep unparsed text in memory"""
+
+    def __init__(self, f: TextIO, chunk_size: int) -> None:
+        self._f = f
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self) -> bool:
+        """read next chunk, return False if eof"""
+
+        if self.eof:
+            return False
+
+        chunk = self._f.read(self._chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+
+        # drop parsed text
+        self.buf = self.buf[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """skip whitespace, return next character, empty if eof"""
+
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.read_more():
+                return ""
+
+    def expect(self, char: str) -> None:
+        """consume char, raise error if next character is not char"""
+
+        if self.peek() != char:
+            raise InvalidResponseFromUpStream(
+                f"ocr_result expect {char} at {self.pos}"
+            )
+        self.pos += 1
+
+    def decode(self) -> Any:
+        """decode next json value"""
+
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buf, self.pos)
+                # number may be truncated by the end of buffer, e.g. "-2."
+                # of "-2.5e10", it is complete once followed by a delimiter
+                if self.eof or (
+                    end < len(self.buf) and self.buf[end] in _DELIMITERS
+                ):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError as e:
+                if self.eof:
+                    raise InvalidResponseFromUpStream(
+                        f"ocr_result invalid json, {e}"
+                    ) from e
+            self.read_more()
+
+    def skip(self) -> None:
+        """skip next json value without decoding it"""
+
+        char = self.peek()
+        if char == '"':
+            self._skip_string()
+            return
+
+        if char not in "{[":
+            self.decode()
+            return
+
+        depth = 0
+        while True:
+            m = _STRUCTURE.search(self.buf, self.pos)
+            if m is None:
+                self.pos = len(self.buf)
+                self._read_more_or_raise()
+                continue
+
+            if m.group() == '"':
+                self.pos = m.start()
+                self._skip_string()
+                continue
+
+            self.pos = m.end()
+            depth += 1 if m.group() in "{[" else -1
+            if depth == 0:
+                return
+
+    def _skip_string(self) -> None:
+        """skip the string at pos, scanned text is dropped as reading,
+        so that a huge string is never kept whole in buffer"""
+
+        self.pos += 1
+        while True:
+            self.pos = _STRING_BODY.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) and self.buf[self.pos] == '"':
+                self.pos += 1
+                return
+
+            # end of buffer, or an escape split by the end of buffer
+            self._read_more_or_raise()
+
+    def _read_more_or_raise(self) -> None:
+        if not self.read_more():
+            raise InvalidResponseFromUpStream(
+                "ocr_result unexpected end of json"
+            )
+
+
+def _find_key(reader: _Reader, key: str) -> bool:
+    """move reader to the value of key in next object
+
+    Returns:
+        bool: True if key found
+    """
+
+    reader.expect("{")
+    if reader.peek() == "}":
+        return False
+
+    while True:
+        k = reader.decode()
+        reader.expect(":")
+        if k == key:
+            return True
+
+        reader.skip()
+        if reader.peek() == "}":
+            return False
+        reader.expect(",")
+
+
+def iter_paragraphs(
+    f: TextIO, chunk_size: int = READ_CHUNK_SIZE
+) -> Iterator[dict]:
+    """yield analyzeResult.paragraphs of ocr result json one by one,
+    memory used is independent of ocr result size
+
+    Args:
+        f (TextIO): ocr result json file
+        chunk_size (int, optional): Defaults to READ_CHUNK_SIZE.
+
+    Raises:
+        InvalidResponseFromUpStream: if ocr result is invalid
+
+    Yields:
+        dict: paragraph
+    """
+
+    reader = _Reader(f, chunk_size)
+    err_msg = ""
+    if not _find_key(reader, "analyzeResult"):
+        err_msg = "ocr_result analyzeResult not existed"
+    elif not _find_key(reader, "paragraphs"):
+        err_msg = "ocr_result paragraphs not existed"
+
+    if len(err_msg) > 0:
+        raise InvalidResponseFromUpStream(err_msg)
+
+    reader.expect("[")
+    if reader.peek() == "]":
+        raise InvalidResponseFromUpStream("ocr_result paragraphs is empty")
+
+    while True:
+        yield reader.decode()
+        if reader.peek() == "]":
+            return
+        reader.expect(",")
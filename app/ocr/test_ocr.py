@@ -0,0 +1,510 @@
+"""test ocr"""
+
+# pylint: disable=protected-access
+
+import io
+import json
+import sys
+import struct
+from concurrent.futures import ProcessPoolExecutor
+import pytest
+from pypdf import PdfWriter
+from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject
+from tcvectordb.model.document import Document
+from app.exceptions.exceptions import InvalidResponseFromUpStream
+from app.job.job_queue import JobQueue
+from app.storage.file_index import FileIndex
+from app.storage.keyword_index import KeywordIndex
+from app.storage.storage import Storage
+from app.vectordb.vectordb import VDB
+
+from app.embedding.embedding import Embedding
+from app.helper.file import FileInfo
+from .ocr import Ocr
+from .benchmark_chunk import load_paragraphs, quadratic_chunk
+from .stream import iter_paragraphs, _Reader
+from .page import count_pages, split_page_ranges
+
+
+def _ocr() -> Ocr:
+    return Ocr(
+        "http://test",
+        FileInfo(
+            file_id="a-test-file-id",
+            file_name="test.pdf",
+            file_unique_name="a-test-file-id___test.pdf",
+        ),
+    )
+
+
+def test_get_embedding_content_list(mocker):
+    """test chunk paragraphs by max token"""
+
+    mocker.patch("app.embedding.embedding.Embedding.EMBEDDING_MAX_TOKEN", 5)
+    paragraphs = [
+        {"content": "ab"},
+        {"content": "cd"},
+        {"no_content": "skip"},
+        {"content": "e"},
+        {"content": "fg"},
+        {"content": "hijklmn"},
+        {"content": "o"},
+    ]
+
+    assert _ocr()._get_embedding_content_list(paragraphs) == [
+        "abcde",
+        "fg",
+        "hijkl",
+        "mn",
+        "o",
+    ]
+
+
+def test_get_embedding_content_list_same_as_before():
+    """test chunk output is identical to the previous chunker"""
+
+    paragraphs = load_paragraphs("ocr-json/建築基準法施行令_all_content.json")
+    assert _ocr()._get_embedding_content_list(paragraphs) == quadratic_chunk(
+        paragraphs, Embedding.EMBEDDING_MAX_TOKEN
+    )
+
+
+def test_iter_paragraphs():
+    """test streaming parse paragraphs same as json.load"""
+
+    ocr_result = {
+        "status": "succeeded",
+        "analyzeResult": {
+            "content": 'paragraphs: [{"content": "fake"}] \\"',
+            "pages": [{"lines": [{"content": "}]", "polygon": [1.5, 2]}]}],
+            "paragraphs": [
+                {"content": "第一条 建築基準法", "role": None},
+                {"content": 'with "quote" and [bracket]'},
+                {"content": "x" * 100, "spans": [{"offset": 12345}]},
+            ],
+            "tables": [],
+        },
+    }
+    text = json.dumps(ocr_result, ensure_ascii=False, indent=2)
+    expected = ocr_result["analyzeResult"]["paragraphs"]
+
+    for chunk_size in (1, 2, 7, 8, 64, 1 << 16):
+        f = io.StringIO(text)
+        assert list(iter_paragraphs(f, chunk_size)) == expected
+
+
+@pytest.mark.parametrize(
+    "ocr_result, msg",
+    [
+        ({"status": "failed"}, "analyzeResult not existed"),
+        ({"analyzeResult": {"pages": []}}, "paragraphs not existed"),
+        ({"analyzeResult": {"paragraphs": []}}, "paragraphs is empty"),
+    ],
+)
+def test_iter_paragraphs_bad_case(ocr_result: dict, msg: str):
+    """test streaming parse invalid ocr result"""
+
+    f = io.StringIO(json.dumps(ocr_result))
+    with pytest.raises(InvalidResponseFromUpStream, match=msg):
+        list(iter_paragraphs(f))
+
+
+def test_iter_paragraphs_split_number():
+    """test number split by read boundary after "." or "e" """
+
+    text = (
+        '{"analyzeResult": {"pages": [-2.5e10, 1E+3],'
+        ' "paragraphs": [{"content": "a", "confidence": -2.5e10}, 0.125]}}'
+    )
+    for chunk_size in (1, 2, 3, 8, 64):
+        assert list(iter_paragraphs(io.StringIO(text), chunk_size)) == [
+            {"content": "a", "confidence": -2.5e10},
+            0.125,
+        ]
+
+
+def test_iter_paragraphs_bad_json():
+    """test streaming parse truncated or malformed ocr result"""
+
+    for text in (
+        '{"analyzeResult": {"content": "abc',
+        '{"analyzeResult": {"paragraphs": [{"content": 1.}]}}',
+        '{"analyzeResult": {"paragraphs": [{"content": "a"} {}]}}',
+    ):
+        with pytest.raises(InvalidResponseFromUpStream):
+            list(iter_paragraphs(io.StringIO(text), 4))
+
+
+def test_iter_paragraphs_skip_large_string(mocker):
+    """test skipped string is not kept whole in buffer"""
+
+    max_buf_len = 0
+    read_more = _Reader.read_more
+
+    def _read_more(reader: _Reader) -> bool:
+        nonlocal max_buf_len
+        more = read_more(reader)
+        max_buf_len = max(max_buf_len, len(reader.buf))
+        return more
+
+    mocker.patch.object(_Reader, "read_more", _read_more)
+    ocr_result = {
+        "analyzeResult": {
+            "content": "x\\y" * 100_000,
+            "pages": [{"content": "z" * 100_000}],
+            "paragraphs": [{"content": "a"}],
+        }
+    }
+    f = io.StringIO(json.dumps(ocr_result))
+    assert list(iter_paragraphs(f, 1024)) == [{"content": "a"}]
+    assert max_buf_len < 2 * 1024
+
+
+def test_open_file(mocker, monkeypatch):
+    """test open file from storage or download stream"""
+
+    monkeypatch.setenv("MINIO_ENDPOINT", "localhost:9000")
+    get_object = mocker.patch(
+        "minio.Minio.get_object", return_value=mocker.MagicMock()
+    )
+    get_object.return_value.read.return_value = b"from storage"
+    requests_get = mocker.patch("requests.get")
+    response = requests_get.return_value.__enter__.return_value
+    response.raw = io.BytesIO(b"from url")
+    response.status_code = 206
+    Storage.file_index.add_file("a-test-file-id", "hash")
+
+    ocr = _ocr()
+    ocr.singed_url = "http://localhost:9000/rag/a-test-file-id___test.pdf?X=1"
+    with ocr._open_file() as f:
+        assert f.read() == b"from storage"
+    get_object.assert_called_once_with(
+        bucket_name="rag", object_name="a-test-file-id___test.pdf"
+    )
+    get_object.return_value.release_conn.assert_called_once()
+    # signature checked by a ranged request
+    requests_get.assert_called_once()
+    assert requests_get.call_args.kwargs["headers"] == {"Range": "bytes=0-0"}
+
+    ocr.singed_url = "http://example.com/rag/a-test-file-id___test.pdf"
+    with ocr._open_file() as f:
+        assert f.read() == b"from url"
+    assert requests_get.call_count == 2
+
+
+def test_open_file_not_issued(mocker, monkeypatch):
+    """test storage url not valid for the file is downloaded"""
+
+    monkeypatch.setenv("MINIO_ENDPOINT", "localhost:9000")
+    get_object = mocker.patch("minio.Minio.get_object")
+    requests_get = mocker.patch("requests.get")
+    response = requests_get.return_value.__enter__.return_value
+    response.status_code = 403
+
+    ocr = _ocr()
+    ocr.singed_url = "http://localhost:9000/rag/a-test-file-id___test.pdf?X=1"
+    # not uploaded
+    assert not Storage.is_issued_url(ocr.singed_url, ocr.file_info)
+    requests_get.assert_not_called()
+
+    # object of another file
+    Storage.file_index.add_file("a-test-file-id", "hash")
+    ocr.singed_url = "http://localhost:9000/rag/a-other-id___test.pdf?X=1"
+    assert not Storage.is_issued_url(ocr.singed_url, ocr.file_info)
+    requests_get.assert_not_called()
+
+    # expired or forged signature
+    ocr.singed_url = "http://localhost:9000/rag/a-test-file-id___test.pdf?X=1"
+    assert not Storage.is_issued_url(ocr.singed_url, ocr.file_info)
+    requests_get.assert_called_once()
+    get_object.assert_not_called()
+
+
+def _mock_embedding_and_vdb(mocker, tmp_path):
+    q = JobQueue(str(tmp_path / "job.db"))
+    mocker.patch("app.ocr.ocr.Ocr.ocr_progress", q)
+    file_index = FileIndex(str(tmp_path / "file_index.db"))
+    mocker.patch("app.storage.storage.Storage.file_index", file_index)
+    keyword_index = KeywordIndex(str(tmp_path / "keyword_index.db"))
+    mocker.patch("app.storage.storage.Storage.keyword_index", keyword_index)
+    mocker.patch("app.embedding.embedding.Embedding.cache", None)
+    mocker.patch(
+        "app.embedding.embedding.Embedding.__init__", return_value=None
+    )
+    embedding_list = mocker.patch(
+        "app.embedding.embedding.Embedding.embedding_list",
+        side_effect=lambda content_list: [[1.0] for _ in content_list],
+    )
+    vdb = mocker.MagicMock(spec=VDB)
+    vdb.is_collection_existed.return_value = None
+    vdb.new_document.side_effect = lambda doc_id, vector, content: Document(
+        id=doc_id, vector=vector, content=content
+    )
+    mocker.patch("app.vectordb.vectordb.VDB.default_vdb", return_value=vdb)
+    return q, file_index, embedding_list, vdb
+
+
+def _upserted_doc_ids(vdb) -> list[str]:
+    return [
+        VDB.get_document_id(doc)
+        for call in vdb.upsert_data.call_args_list
+        for doc in call.args[0]
+    ]
+
+
+def test_embedding_and_save_vector_resume(mocker, tmp_path):
+    """test resume from checkpoint with deterministic document id"""
+
+    q, _, embedding_list, vdb = _mock_embedding_and_vdb(mocker, tmp_path)
+
+    ocr = _ocr()
+    file_id = ocr.file_info.file_id
+    q.enqueue(ocr.file_info, ocr.singed_url)
+    ocr.lease = q.claim().lease
+    q.set(file_id, 0.11)
+    q.add_checkpoint(file_id, ocr.lease, [0, 1])
+
+    ocr._embedding_and_save_vector(["c0", "c1", "c2", "c3"], file_id)
+
+    embedding_list.assert_called_once_with(["c2", "c3"])
+    assert _upserted_doc_ids(vdb) == [f"{file_id}-2", f"{file_id}-3"]
+    assert q.get_checkpoint(file_id) == {0, 1, 2, 3}
+    assert q.get(file_id) == pytest.approx(0.9)
+
+
+def test_embedding_and_save_vector_reingest(mocker, tmp_path):
+    """test re-ingest only writes changed chunks and deletes vanished ones"""
+
+    q, file_index, embedding_list, vdb = _mock_embedding_and_vdb(
+        mocker, tmp_path
+    )
+
+    ocr = _ocr()
+    file_id = ocr.file_info.file_id
+    q.enqueue(ocr.file_info, ocr.singed_url)
+    ocr.lease = q.claim().lease
+    ocr._embedding_and_save_vector(["c0", "c1", "c2", "c3"], file_id)
+    assert _upserted_doc_ids(vdb) == [f"{file_id}-{i}" for i in range(4)]
+    vdb.delete_data.assert_called_once_with([])
+    q.complete(file_id, ocr.lease)
+
+    embedding_list.reset_mock()
+    vdb.reset_mock()
+    q.enqueue(ocr.file_info, ocr.singed_url)
+    ocr.lease = q.claim().lease
+    ocr._embedding_and_save_vector(["c0", "c2", "c2b", "c3", "c0"], file_id)
+
+    embedding_list.assert_called_once_with(["c2b", "c0"])
+    assert _upserted_doc_ids(vdb) == [f"{file_id}-4", f"{file_id}-5"]
+    vdb.delete_data.assert_called_once_with([f"{file_id}-1"])
+    assert file_index.get_chunks(file_id) == {
+        f"{file_id}-0": Ocr.get_chunk_hash("c0"),
+        f"{file_id}-2": Ocr.get_chunk_hash("c2"),
+        f"{file_id}-4": Ocr.get_chunk_hash("c2b"),
+        f"{file_id}-3": Ocr.get_chunk_hash("c3"),
+        f"{file_id}-5": Ocr.get_chunk_hash("c0"),
+    }
+    assert [
+        doc["id"] for doc in Storage.keyword_index.search(file_id, "c2b")
+    ] == [
+        f"{file_id}-4",
+        f"{file_id}-2",
+    ]
+
+
+def test_embedding_and_save_vector_legacy(mocker, tmp_path):
+    """test re-ingest a file ingested before chunk hashes are kept"""
+
+    q, file_index, _, vdb = _mock_embedding_and_vdb(mocker, tmp_path)
+    vdb.is_collection_existed.return_value = mocker.MagicMock()
+    vdb.list_document_ids.return_value = ["uuid-0", "uuid-1"]
+
+    ocr = _ocr()
+    file_id = ocr.file_info.file_id
+    q.enqueue(ocr.file_info, ocr.singed_url)
+    ocr.lease = q.claim().lease
+    ocr._embedding_and_save_vector(["c0", "c1"], file_id)
+
+    assert _upserted_doc_ids(vdb) == [f"{file_id}-0", f"{file_id}-1"]
+    vdb.delete_data.assert_called_once_with(["uuid-0", "uuid-1"])
+    assert len(file_index.get_chunks(file_id)) == 2
+    assert file_index.is_chunked(file_id)
+
+
+def test_embedding_and_save_vector_not_legacy(mocker, tmp_path):
+    """test first ingestion and its retry do not list documents"""
+
+    q, file_index, _, vdb = _mock_embedding_and_vdb(mocker, tmp_path)
+
+    ocr = _ocr()
+    file_id = ocr.file_info.file_id
+    q.enqueue(ocr.file_info, ocr.singed_url)
+    ocr.lease = q.claim().lease
+    vdb.upsert_data.side_effect = ValueError("upsert failed")
+    with pytest.raises(ValueError):
+        ocr._embedding_and_save_vector(["c0", "c1"], file_id)
+    assert file_index.is_chunked(file_id)
+    assert not file_index.get_chunks(file_id)
+
+    # the collection is created by the failed attempt
+    vdb.upsert_data.side_effect = None
+    vdb.is_collection_existed.return_value = mocker.MagicMock()
+    ocr._embedding_and_save_vector(["c0", "c1"], file_id)
+    vdb.list_document_ids.assert_not_called()
+    assert len(file_index.get_chunks(file_id)) == 2
+
+
+def _write_pdf(path: str, page_count: int, text_pages: dict = None) -> None:
+    """write pdf, text_pages is text lines of page number with text layer"""
+
+    writer = PdfWriter()
+    font = writer._add_object(
+        DictionaryObject(
+            {
+                NameObject("/Type"): NameObject("/Font"),
+                NameObject("/Subtype"): NameObject("/Type1"),
+                NameObject("/BaseFont"): NameObject("/Helvetica"),
+            }
+        )
+    )
+    for page_number in range(1, page_count + 1):
+        page = writer.add_blank_page(width=200, height=200)
+        lines = (text_pages or {}).get(page_number)
+        if lines is None:
+            continue
+
+        content = DecodedStreamObject()
+        content.set_data(
+            (
+                "BT /F1 12 Tf 10 150 Td "
+                + " ".join(f"({line}) Tj 0 -14 Td" for line in lines)
+                + " ET"
+            ).encode()
+        )
+        page[NameObject("/Contents")] = writer._add_object(content)
+        page[NameObject("/Resources")] = DictionaryObject(
+            {NameObject("/Font"): DictionaryObject({NameObject("/F1"): font})}
+        )
+    with open(path, "wb") as f:
+        writer.write(f)
+
+
+def test_count_pages(tmp_path):
+    """test count pages of pdf and tiff"""
+
+    pdf_path = str(tmp_path / "test.pdf")
+    _write_pdf(pdf_path, 3)
+    assert count_pages(pdf_path) == 3
+
+    # tiff with 3 empty image file directories
+    tiff_path = str(tmp_path / "test.tiff")
+    with open(tiff_path, "wb") as f:
+        f.write(b"II*\x00" + struct.pack("<I", 8))
+        for next_offset in (14, 20, 0):
+            f.write(struct.pack("<HI", 0, next_offset))
+    assert count_pages(tiff_path) == 3
+
+    assert count_pages(str(tmp_path / "test.png")) == 1
+
+    with open(tiff_path, "r+b") as f:
+        f.seek(16)
+        f.write(struct.pack("<I", 8))
+    with pytest.raises(ValueError):
+        count_pages(tiff_path)
+
+
+def test_split_page_ranges():
+    """test split page ranges"""
+
+    assert split_page_ranges([1], 10) == [(1, 1)]
+    assert split_page_ranges(list(range(1, 26)), 10) == [
+        (1, 10),
+        (11, 20),
+        (21, 25),
+    ]
+    assert split_page_ranges([1, 2, 4, 5, 6, 9], 2) == [
+        (1, 2),
+        (4, 5),
+        (6, 6),
+        (9, 9),
+    ]
+    assert not split_page_ranges([], 10)
+
+
+def test_iter_ocr_paragraphs_by_page(mocker, tmp_path):
+    """test paragraphs of page ranges are merged in page order"""
+
+    paragraphs = [
+        {"content": f"page {i} {j}", "boundingRegions": [{"pageNumber": i}]}
+        for i in range(1, 28)
+        for j in range(2)
+    ]
+    ocr_result_path = str(tmp_path / "ocr_result.json")
+    with open(ocr_result_path, "w", encoding="utf-8") as f:
+        json.dump({"analyzeResult": {"paragraphs": paragraphs}}, f)
+    mocker.patch.object(
+        Ocr, "_simulate_get_ocr_result_path", return_value=ocr_result_path
+    )
+
+    pdf_path = str(tmp_path / "test.pdf")
+    _write_pdf(pdf_path, 25)
+    mocker.patch.object(Ocr, "OCR_PAGE_PARALLEL", 1)
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        mocker.patch.object(Ocr, "_page_pool", pool)
+        with open(pdf_path, "rb") as f:
+            result = list(_ocr()._iter_paragraphs_by_page(f, "test.pdf"))
+    # pages of ocr result beyond the file are kept in the last range
+    assert result == paragraphs
+
+
+def test_iter_paragraphs_by_page_text_layer(mocker, tmp_path):
+    """test text layer pages skip ocr, merged with ocr pages in page order"""
+
+    ocr_paragraphs = [
+        {"content": f"ocr page {i}", "boundingRegions": [{"pageNumber": i}]}
+        for i in range(1, 5)
+    ]
+    ocr_result_path = str(tmp_path / "ocr_result.json")
+    with open(ocr_result_path, "w", encoding="utf-8") as f:
+        json.dump({"analyzeResult": {"paragraphs": ocr_paragraphs}}, f)
+    get_ocr_result_path = mocker.patch.object(
+        Ocr, "_simulate_get_ocr_result_path", return_value=ocr_result_path
+    )
+    ocr_page_range = mocker.spy(Ocr, "_simulate_ocr_page_range")
+    mocker.patch.object(Ocr, "OCR_TEXT_LAYER", 1)
+    logger = mocker.patch("app.ocr.ocr.logger")
+
+    pdf_path = str(tmp_path / "test.pdf")
+    _write_pdf(
+        pdf_path,
+        4,
+        {1: ["text layer page 1", "second line"], 3: ["text layer page 3"]},
+    )
+    with open(pdf_path, "rb") as f:
+        result = list(_ocr()._iter_paragraphs_by_page(f, "test.pdf"))
+    assert [p["content"] for p in result] == [
+        "text layer page 1",
+        "second line",
+        "ocr page 2",
+        "text layer page 3",
+        "ocr page 4",
+    ]
+    assert [c.args[2:] for c in ocr_page_range.call_args_list] == [
+        (2, 2),
+        (4, sys.maxsize),
+    ]
+    # text layer pages yielded before ocr pages are counted
+    logger.info.assert_called_with("ocr success, paragraphs len: 5")
+
+    # all pages have text layer, skip ocr entirely
+    get_ocr_result_path.reset_mock()
+    _write_pdf(
+        pdf_path, 2, {1: ["text layer page 1"], 2: ["text layer page 2"]}
+    )
+    with open(pdf_path, "rb") as f:
+        result = list(_ocr()._iter_paragraphs_by_page(f, "test.pdf"))
+    assert [p["content"] for p in result] == [
+        "text layer page 1",
+        "text layer page 2",
+    ]
+    get_ocr_result_path.assert_not_called()
@@ -0,0 +1,354 @@
+"""file content hash index"""
+
+import os
+import time
+import sqlite3
+from loguru import logger
+from app.helper.sqlite import LocalConnection
+
+
+class FileIndex:
+    """Index of uploaded file content hash
+
+    Files with the same content hash share the vector collection
+    of the first file performed OCR, later files are alias of it.
+    Content hash of chunks written into the vector collection of each file
+    is also kept, so that a revised file only writes changed chunks.
+    Time ingestion of each file completed is the readiness marker of
+    the file, queries know the file is searchable.
+    """
+
+    FILE_INDEX_DB = os.getenv("FILE_INDEX_DB", "file_index.db")
+    """SQLite database file path"""
+
+    def __init__(self, db_path: str = FILE_INDEX_DB) -> None:
+        """init file index, database is connected lazily
+
+        Args:
+            db_path (str, optional): SQLite database file path.
+            Defaults to FILE_INDEX_DB.
+        """
+
+        self._db = LocalConnection(db_path, self._init_db)
+
+    def _conn(self) -> sqlite3.Connection:
+        return self._db.get()
+
+    def _init_db(self, conn: sqlite3.Connection) -> None:
+        # file_id -> content hash, the file_id it alias to and its object
+        # in storage, object is None for files uploaded before it is kept
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS file ("
+            " file_id TEXT PRIMARY KEY, content_hash TEXT NOT NULL,"
+            " alias_of TEXT, object_name TEXT)"
+        )
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(file)")}
+        if "object_name" not in columns:
+            conn.execute("ALTER TABLE file ADD COLUMN object_name TEXT")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS file_content_hash"
+            " ON file (content_hash)"
+        )
+        # content hash -> file_id performed ocr
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS ocr_file ("
+            " content_hash TEXT PRIMARY KEY, file_id TEXT NOT NULL)"
+        )
+        # file_id -> vector document id and content hash of its chunks
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunk ("
+            " file_id TEXT NOT NULL, doc_id TEXT NOT NULL,"
+            " content_hash TEXT NOT NULL, PRIMARY KEY (file_id, doc_id))"
+        )
+        # file_id -> time its latest ingestion completed
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS ready ("
+            " file_id TEXT PRIMARY KEY, ready_at REAL NOT NULL)"
+        )
+        # file_id whose chunks are kept since before its vector collection
+        # is created, a collection without it is of a legacy ingestion
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunked (file_id TEXT PRIMARY KEY)"
+        )
+
+    def add_file(self, file_id: str, content_hash: str) -> None:
+        """add uploaded file content hash"""
+
+        self._conn().execute(
+            "INSERT OR REPLACE INTO file (file_id, content_hash)"
+            " VALUES (?, ?)",
+            (file_id, content_hash),
+        )
+
+    def add_upload(
+        self, file_id: str, content_hash: str, object_name: str
+    ) -> tuple[str, str] | None:
+        """add uploaded file content hash and its object in storage,
+        unless an object of the same content hash has been uploaded
+
+        Returns:
+            tuple[str, str] | None: file_id and object name of the upload
+            of the same content hash, None if added
+        """
+
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT file_id, object_name FROM file"
+                " WHERE content_hash = ? AND object_name IS NOT NULL"
+                " ORDER BY rowid LIMIT 1",
+                (content_hash,),
+            ).fetchone()
+            if row is None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO file"
+                    " (file_id, content_hash, object_name) VALUES (?, ?, ?)",
+                    (file_id, content_hash, object_name),
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        if row is None:
+            return None
+        return row[0], row[1]
+
+    def is_uploaded(self, file_id: str) -> bool:
+        """return whether file_id is issued by upload"""
+
+        row = (
+            self._conn()
+            .execute("SELECT 1 FROM file WHERE file_id = ?", (file_id,))
+            .fetchone()
+        )
+        return row is not None
+
+    def get_ocr_file_id(self, file_id: str) -> str | None:
+        """get the other file_id with the same content performed ocr
+
+        Returns:
+            str | None: file_id, None if not existed
+        """
+
+        row = (
+            self._conn()
+            .execute(
+                "SELECT o.file_id FROM file f JOIN ocr_file o"
+                " ON f.content_hash = o.content_hash"
+                " WHERE f.file_id = ? AND o.file_id != ?",
+                (file_id, file_id),
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+
+        return row[0]
+
+    def set_ocr_file_id(self, file_id: str) -> None:
+        """set file_id as the file performed ocr of its content hash"""
+
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO ocr_file (content_hash, file_id)"
+            " SELECT content_hash, file_id FROM file WHERE file_id = ?",
+            (file_id,),
+        )
+        conn.execute(
+            "UPDATE file SET alias_of = NULL WHERE file_id = ?", (file_id,)
+        )
+
+    def set_alias(self, file_id: str, alias_of: str) -> None:
+        """set file_id alias to another file_id with the same content"""
+
+        self._conn().execute(
+            "UPDATE file SET alias_of = ? WHERE file_id = ?",
+            (alias_of, file_id),
+        )
+        logger.info(f"{file_id} alias of {alias_of}")
+
+    def resolve(self, file_id: str) -> str:
+        """return the file_id which file_id alias to,
+        or file_id itself if not alias"""
+
+        row = (
+            self._conn()
+            .execute("SELECT alias_of FROM file WHERE file_id = ?", (file_id,))
+            .fetchone()
+        )
+        if row is None or row[0] is None:
+            return file_id
+
+        return row[0]
+
+    def replace_content(self, file_id: str, new_file_id: str) -> str | None:
+        """file_id is re-ingested with the content of new_file_id,
+        new_file_id alias to file_id
+
+        Other files alias to file_id have the previous content, the first
+        of them is detached as the file of the previous content, and the
+        rest alias to it.
+
+        Returns:
+            str | None: file_id detached which needs ingestion of the
+            previous content, None if no other alias or content unchanged
+        """
+
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            hashes = dict(
+                conn.execute(
+                    "SELECT file_id, content_hash FROM file"
+                    " WHERE file_id IN (?, ?)",
+                    (file_id, new_file_id),
+                ).fetchall()
+            )
+            heir = None
+            if hashes.get(file_id) != hashes.get(new_file_id):
+                heir = self._detach_aliases(conn, file_id, new_file_id)
+            if heir is None:
+                conn.execute(
+                    "DELETE FROM ocr_file WHERE file_id = ?", (file_id,)
+                )
+
+            conn.execute(
+                "UPDATE file SET content_hash = (SELECT content_hash"
+                " FROM file WHERE file_id = ?), alias_of = NULL"
+                " WHERE file_id = ? AND EXISTS (SELECT 1"
+                " FROM file WHERE file_id = ?)",
+                (new_file_id, file_id, new_file_id),
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO ocr_file (content_hash, file_id)"
+                " SELECT content_hash, file_id FROM file WHERE file_id = ?",
+                (file_id,),
+            )
+            conn.execute(
+                "UPDATE file SET alias_of = ? WHERE file_id = ?",
+                (file_id, new_file_id),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        logger.info(f"{file_id} replace content with {new_file_id}")
+        if heir is not None:
+            logger.info(f"{heir} detached with the previous content")
+        return heir
+
+    def _detach_aliases(
+        self, conn: sqlite3.Connection, file_id: str, new_file_id: str
+    ) -> str | None:
+        """detach aliases of file_id except new_file_id in transaction,
+        return the file performs ocr of the previous content"""
+
+        aliases = [
+            row[0]
+            for row in conn.execute(
+                "SELECT file_id FROM file WHERE alias_of = ? AND file_id != ?"
+                " ORDER BY file_id",
+                (file_id, new_file_id),
+            ).fetchall()
+        ]
+        if len(aliases) == 0:
+            return None
+
+        heir = aliases[0]
+        conn.execute(
+            "UPDATE file SET alias_of = CASE WHEN file_id = ? THEN NULL"
+            " ELSE ? END WHERE alias_of = ? AND file_id != ?",
+            (heir, heir, file_id, new_file_id),
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO ocr_file (content_hash, file_id)"
+            " SELECT content_hash, file_id FROM file WHERE file_id = ?",
+            (heir,),
+        )
+        return heir
+
+    def set_chunked(self, file_id: str) -> None:
+        """mark chunks of file_id are kept, see is_chunked"""
+
+        self._conn().execute(
+            "INSERT OR IGNORE INTO chunked (file_id) VALUES (?)", (file_id,)
+        )
+
+    def is_chunked(self, file_id: str) -> bool:
+        """return whether chunks of file_id are kept since before its
+        vector collection is created, or since its collection is rebuilt"""
+
+        row = (
+            self._conn()
+            .execute("SELECT 1 FROM chunked WHERE file_id = ?", (file_id,))
+            .fetchone()
+        )
+        return row is not None
+
+    def get_chunks(self, file_id: str) -> dict[str, str]:
+        """get chunks written into vector collection of file_id
+
+        Returns:
+            dict[str, str]: content hash of each vector document id
+        """
+
+        return dict(
+            self._conn()
+            .execute(
+                "SELECT doc_id, content_hash FROM chunk WHERE file_id = ?",
+                (file_id,),
+            )
+            .fetchall()
+        )
+
+    def set_chunks(self, file_id: str, chunks: dict[str, str]) -> None:
+        """replace chunks of file_id, also mark it chunked
+
+        Args:
+            file_id (str): file id
+            chunks (dict[str, str]): content hash of each vector document id
+        """
+
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM chunk WHERE file_id = ?", (file_id,))
+            conn.executemany(
+                "INSERT INTO chunk (file_id, doc_id, content_hash)"
+                " VALUES (?, ?, ?)",
+                [(file_id, doc_id, h) for doc_id, h in chunks.items()],
+            )
+            conn.execute(
+                "INSERT OR IGNORE INTO chunked (file_id) VALUES (?)",
+                (file_id,),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def set_ready(self, file_id: str) -> None:
+        """mark ingestion of file_id completed now"""
+
+        self._conn().execute(
+            "INSERT OR REPLACE INTO ready (file_id, ready_at) VALUES (?, ?)",
+            (file_id, time.time()),
+        )
+        logger.info(f"{file_id} ready")
+
+    def get_ready_at(self, file_id: str) -> float | None:
+        """return time the latest ingestion of file_id completed,
+        None if never completed, or ingested before readiness is marked"""
+
+        row = (
+            self._conn()
+            .execute("SELECT ready_at FROM ready WHERE file_id = ?", (file_id,))
+            .fetchone()
+        )
+        if row is None:
+            return None
+
+        return row[0]
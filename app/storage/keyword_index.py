@@ -0,0 +1,225 @@
+"""character n-gram keyword index of chunks"""
+
+import os
+import re
+import math
+import sqlite3
+import unicodedata
+from collections import Counter
+from loguru import logger
+from app.helper.sqlite import LocalConnection
+
+KEYWORD_NGRAM = int(os.getenv("KEYWORD_NGRAM", "2"))
+"""
+Characters of a gram, Japanese text has no spaces between words,
+so text is indexed by overlapping character n-grams instead of words
+"""
+
+_WORD_RUN = re.compile(r"\w+")
+
+# BM25 parameters
+_K1 = 1.2
+_B = 0.75
+
+
+def get_grams(text: str, n: int = KEYWORD_NGRAM) -> list[str]:
+    """split text into overlapping character n-grams
+
+    Text is NFKC normalized and lower cased, so that full width digits
+    and letters match half width ones. Grams do not cross whitespace
+    and punctuation, runs shorter than n are a gram as a whole.
+
+    Args:
+        text (str): text
+        n (int, optional): characters of a gram. Defaults to KEYWORD_NGRAM.
+
+    Returns:
+        list[str]: grams in text order, with duplicates
+    """
+
+    grams: list[str] = []
+    normalized = unicodedata.normalize("NFKC", text).lower()
+    for run in _WORD_RUN.findall(normalized):
+        if len(run) <= n:
+            grams.append(run)
+            continue
+
+        grams.extend(run[i : i + n] for i in range(len(run) - n + 1))
+    return grams
+
+
+class KeywordIndex:
+    """Inverted index of chunk n-grams of each file, ranked by BM25
+
+    Exact terms such as article numbers and defined terms are ranked
+    poorly by vector search, keyword search results are fused with
+    vector search results.
+    """
+
+    KEYWORD_INDEX_DB = os.getenv("KEYWORD_INDEX_DB", "keyword_index.db")
+    """SQLite database file path"""
+
+    def __init__(
+        self, db_path: str = KEYWORD_INDEX_DB, ngram: int = KEYWORD_NGRAM
+    ) -> None:
+        """init keyword index, database is connected lazily
+
+        Args:
+            db_path (str, optional): SQLite database file path.
+            Defaults to KEYWORD_INDEX_DB.
+            ngram (int, optional): characters of a gram, the index must be
+            rebuilt once changed. Defaults to KEYWORD_NGRAM.
+        """
+
+        self._ngram = ngram
+        self._db = LocalConnection(db_path, self._init_db)
+
+    def _conn(self) -> sqlite3.Connection:
+        return self._db.get()
+
+    def _init_db(self, conn: sqlite3.Connection) -> None:
+        # file_id -> chunk content and its gram count
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunk ("
+            " file_id TEXT NOT NULL, doc_id TEXT NOT NULL,"
+            " content TEXT NOT NULL, length INTEGER NOT NULL,"
+            " PRIMARY KEY (file_id, doc_id))"
+        )
+        # file_id and gram -> chunks containing the gram and its frequency
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS posting ("
+            " file_id TEXT NOT NULL, gram TEXT NOT NULL,"
+            " doc_id TEXT NOT NULL, tf INTEGER NOT NULL,"
+            " PRIMARY KEY (file_id, gram, doc_id)) WITHOUT ROWID"
+        )
+
+    def set_chunks(self, file_id: str, chunks: dict[str, str]) -> None:
+        """replace chunks of file_id, only changed chunks are re-indexed
+
+        Args:
+            file_id (str): file id
+            chunks (dict[str, str]): content of each vector document id
+        """
+
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            stored = dict(
+                conn.execute(
+                    "SELECT doc_id, content FROM chunk WHERE file_id = ?",
+                    (file_id,),
+                ).fetchall()
+            )
+            deleted = [
+                (file_id, doc_id)
+                for doc_id, content in stored.items()
+                if chunks.get(doc_id) != content
+            ]
+            conn.executemany(
+                "DELETE FROM chunk WHERE file_id = ? AND doc_id = ?", deleted
+            )
+            # postings of old content are found by primary key
+            conn.executemany(
+                "DELETE FROM posting"
+                " WHERE file_id = ? AND gram = ? AND doc_id = ?",
+                [
+                    (file_id, gram, doc_id)
+                    for _, doc_id in deleted
+                    for gram in set(get_grams(stored[doc_id], self._ngram))
+                ],
+            )
+
+            added = 0
+            for doc_id, content in chunks.items():
+                if stored.get(doc_id) == content:
+                    continue
+
+                grams = Counter(get_grams(content, self._ngram))
+                conn.execute(
+                    "INSERT INTO chunk (file_id, doc_id, content, length)"
+                    " VALUES (?, ?, ?, ?)",
+                    (file_id, doc_id, content, sum(grams.values())),
+                )
+                conn.executemany(
+                    "INSERT INTO posting (file_id, gram, doc_id, tf)"
+                    " VALUES (?, ?, ?, ?)",
+                    [(file_id, g, doc_id, tf) for g, tf in grams.items()],
+                )
+                added += 1
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        logger.info(
+            f"{file_id} keyword index, deleted: {len(deleted)}, added: {added}"
+        )
+
+    def search(self, file_id: str, query: str, top_k: int = 10) -> list[dict]:
+        """search chunks of file_id containing grams of query, by BM25
+
+        Args:
+            file_id (str): file id
+            query (str): query text
+            top_k (int, optional): max chunks. Defaults to 10.
+
+        Returns:
+            list[dict]: chunks with id, score and content, best first,
+            the same as vector search result
+        """
+
+        query_grams = Counter(get_grams(query, self._ngram))
+        if len(query_grams) == 0:
+            return []
+
+        conn = self._conn()
+        scores = self._score(conn, file_id, query_grams)
+        best = sorted(scores, key=lambda d: (-scores[d], d))[:top_k]
+        if len(best) == 0:
+            return []
+
+        placeholders = ", ".join("?" * len(best))
+        contents = dict(
+            conn.execute(
+                "SELECT doc_id, content FROM chunk"
+                f" WHERE file_id = ? AND doc_id IN ({placeholders})",
+                (file_id, *best),
+            ).fetchall()
+        )
+        return [
+            {"id": doc_id, "score": scores[doc_id], "content": contents[doc_id]}
+            for doc_id in best
+        ]
+
+    def _score(
+        self, conn: sqlite3.Connection, file_id: str, query_grams: Counter
+    ) -> dict[str, float]:
+        """BM25 score of chunks of file_id containing any gram of query"""
+
+        count, avg_length = conn.execute(
+            "SELECT COUNT(*), AVG(length) FROM chunk WHERE file_id = ?",
+            (file_id,),
+        ).fetchone()
+        if count == 0:
+            return {}
+
+        placeholders = ", ".join("?" * len(query_grams))
+        rows = conn.execute(
+            "SELECT p.gram, p.doc_id, p.tf, c.length FROM posting p"
+            " JOIN chunk c ON c.file_id = p.file_id AND c.doc_id = p.doc_id"
+            f" WHERE p.file_id = ? AND p.gram IN ({placeholders})",
+            (file_id, *query_grams),
+        ).fetchall()
+
+        # document frequency of each gram -> inverse document frequency
+        idf = {
+            gram: math.log(1 + (count - df + 0.5) / (df + 0.5))
+            for gram, df in Counter(gram for gram, _, _, _ in rows).items()
+        }
+        scores: dict[str, float] = {}
+        for gram, doc_id, tf, length in rows:
+            norm = tf + _K1 * (1 - _B + _B * length / max(avg_length, 1))
+            scores[doc_id] = scores.get(doc_id, 0.0) + (
+                query_grams[gram] * idf[gram] * tf * (_K1 + 1) / norm
+            )
+        return scores
@@ -1,16 +1,39 @@
 """Handle Storage operations, such as upload file"""
 
 import os
-import io
-from typing import BinaryIO
+import hashlib
+import urllib.parse
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator
 from datetime import datetime, timedelta
 import pytz
+import requests
 from loguru import logger
 from minio import Minio
 from minio.error import S3Error
 from fastapi import UploadFile
 import starlette.datastructures
-from app.helper.file import get_unique_filename, FileInfo
+from app.helper.file import get_unique_filename, FileInfo, SEP_STR
+from app.storage.file_index import FileIndex
+from app.storage.keyword_index import KeywordIndex
+
+
+# pylint: disable=too-few-public-methods
+class _HashReader:
+    """stream reader computing sha256 and length of data read"""
+
+    def __init__(self, stream: BinaryIO) -> None:
+        self._stream = stream
+        self.hash = hashlib.sha256()
+        self.length = 0
+
+    def read(self, size: int = -1) -> bytes:
+        """read and hash at most size bytes"""
+
+        data = self._stream.read(size)
+        self.hash.update(data)
+        self.length += len(data)
+        return data
 
 
 class Storage:
@@ -18,6 +41,18 @@ class Storage:
 
     RAG_Bucket = "rag"
 
+    UPLOAD_PART_SIZE = 10 * 1024 * 1024
+    """part size of multipart upload when file size is unknown"""
+
+    CHECK_URL_TIMEOUT = 10
+    """timeout in seconds of checking a signed url"""
+
+    file_index: FileIndex = FileIndex()
+    """content hash index of uploaded files"""
+
+    keyword_index: KeywordIndex = KeywordIndex()
+    """keyword index of chunks of each file"""
+
     _client: Minio
     _bucket: str
 
@@ -115,13 +150,18 @@ class Storage:
         for file_dict in file_dict_list:
             file: UploadFile = file_dict["file"]
             file_info: FileInfo = file_dict["file_info"]
-            file_content = await file.read()
+            # content hash is computed while uploading, file is read once
+            reader = _HashReader(file.file)
             self.upload_file_data(
                 destination_file=file_info.file_unique_name,
-                data=io.BytesIO(file_content),
-                length=len(file_content),
+                data=reader,
+                length=-1 if file.size is None else file.size,
                 content_type=file.content_type,
+                part_size=(
+                    Storage.UPLOAD_PART_SIZE if file.size is None else 0
+                ),
             )
+            file_info = self._deduplicate(file_info, reader.hash.hexdigest())
 
             # get signed url and etag as file id
             expires = timedelta(days=7)
@@ -141,6 +181,117 @@ class Storage:
         logger.info(f"upload_result: {upload_result}")
         return upload_result
 
+    def _deduplicate(self, file_info: FileInfo, content_hash: str) -> FileInfo:
+        """add uploaded file content hash, if the same content has been
+        uploaded, remove the object of file_info and return file info of
+        the earlier upload instead"""
+
+        uploaded = Storage.file_index.add_upload(
+            file_info.file_id, content_hash, file_info.file_unique_name
+        )
+        if uploaded is None:
+            return file_info
+
+        file_id, object_name = uploaded
+        self._client.remove_object(
+            bucket_name=self._bucket, object_name=file_info.file_unique_name
+        )
+        logger.info(
+            f"remove duplicated object: {file_info.file_unique_name}"
+            f", same content as: {object_name}"
+        )
+        return FileInfo(
+            file_id=file_id,
+            file_name=object_name.split(SEP_STR, 1)[1],
+            file_unique_name=object_name,
+        )
+
+    @classmethod
+    def is_storage_url(cls, url: str, bucket: str) -> bool:
+        """check whether url is an object url in the bucket of storage
+
+        Args:
+            url (str): url such as signed url
+            bucket (str): Name of the bucket.
+
+        Returns:
+            bool: True if url host is MINIO_ENDPOINT and path is in bucket
+        """
+
+        endpoint = os.getenv("MINIO_ENDPOINT")
+        if not endpoint:
+            return False
+
+        parsed = urllib.parse.urlparse(url)
+        paths = parsed.path.split("/")
+        return (
+            parsed.netloc == endpoint and len(paths) > 2 and paths[1] == bucket
+        )
+
+    @classmethod
+    def is_issued_url(cls, url: str, file_info: FileInfo) -> bool:
+        """check whether url is a valid signed url of the object uploaded
+        for file_info, so that the object can be read from storage directly
+
+        The object must be issued by upload for file_info.file_id, and the
+        signature and expiry of url are checked by storage with a one byte
+        ranged request, as reading the object directly skips them.
+
+        Args:
+            url (str): signed url
+            file_info (FileInfo): file info parsed from url
+
+        Returns:
+            bool: True if url is valid for the object of file_info
+        """
+
+        if not cls.is_storage_url(url, cls.RAG_Bucket):
+            return False
+
+        object_name = urllib.parse.unquote(
+            urllib.parse.urlparse(url).path.split("/", 2)[2]
+        )
+        if object_name != file_info.file_unique_name:
+            return False
+        if not cls.file_index.is_uploaded(file_info.file_id):
+            return False
+
+        try:
+            with requests.get(
+                url,
+                headers={"Range": "bytes=0-0"},
+                stream=True,
+                timeout=Storage.CHECK_URL_TIMEOUT,
+            ) as response:
+                status_code = response.status_code
+        except requests.RequestException as e:
+            logger.warning(f"check signed url failed: {e}")
+            return False
+        if status_code not in (200, 206):
+            logger.warning(f"signed url is invalid, status: {status_code}")
+            return False
+        return True
+
+    @contextmanager
+    def open_object(self, object_name: str) -> Iterator[BinaryIO]:
+        """open object in bucket as a stream
+
+        Args:
+            object_name (str): object name, file_unique_name of FileInfo
+
+        Yields:
+            BinaryIO: object data stream, closed after exit
+        """
+
+        response = self._client.get_object(
+            bucket_name=self._bucket, object_name=object_name
+        )
+        try:
+            yield response
+        finally:
+            response.close()
+            response.release_conn()
+
     def check_or_make_bucket(self):
         """Make the bucket if it doesn't exist."""
 
@@ -157,6 +308,7 @@ class Storage:
         data: BinaryIO,
         length: int,
         content_type: str,
+        part_size: int = 0,
     ) -> None:
         """
         Uploads data from source_file to an destination bucket and filename.
@@ -168,6 +320,7 @@ class Storage:
             length (int): Data size; -1 for unknown size and
             set valid part_size.
             content_type (str): Content type of the object.
+            part_size (int, optional): Multipart part size. Defaults to 0.
 
         Raises:
             HTTPException: If upload failed.
@@ -183,6 +336,7 @@ class Storage:
                 data=data,
                 length=length,
                 content_type=content_type,
+                part_size=part_size,
             )
 
         except S3Error as e:
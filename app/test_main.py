@@ -7,6 +7,10 @@ from fastapi import status
 from fastapi.testclient import TestClient
 from minio import Minio
 from .main import app
+from .job.job_queue import JobQueue
+from .job.progress import ProgressBroadcaster
+from .storage.file_index import FileIndex
+from .model.file_info import FileInfo
 
 FILE_ID = "a-fa54ff56-7d03-4659-a993-42780a2d911f"
 SIGNED_URL = (
@@ -80,10 +84,18 @@ def test_upload_bad_case_file_name_duplicated():
             os.remove(file_name)
 
 
+def _read_upload_data(**kwargs) -> None:
+    while kwargs["data"].read(3):
+        pass
+
+
 def test_upload_ok(mocker):
     """test upload"""
 
-    mocker.patch("app.storage.storage.Storage.upload_file_data")
+    mocker.patch(
+        "app.storage.storage.Storage.upload_file_data",
+        side_effect=_read_upload_data,
+    )
     mocker.patch(
         "app.storage.storage.Storage._new_client",
         return_value=Minio(endpoint="www.example.com"),
@@ -131,6 +143,38 @@ def test_upload_ok(mocker):
             os.remove(file_name)
 
 
+def test_upload_duplicated_content(mocker):
+    """test upload of the same content returns the earlier upload"""
+
+    upload_file_data = mocker.patch(
+        "app.storage.storage.Storage.upload_file_data",
+        side_effect=_read_upload_data,
+    )
+    mocker.patch(
+        "app.storage.storage.Storage._new_client",
+        return_value=Minio(endpoint="www.example.com"),
+    )
+    mocker.patch("minio.Minio.presigned_get_object", return_value="http://test")
+    remove_object = mocker.patch("minio.Minio.remove_object")
+
+    with TestClient(app) as client:
+        upload_result = []
+        for file_name in ("a.pdf", "b.pdf"):
+            files = [("files", (file_name, b"same content", "application/pdf"))]
+            response = client.post("/upload", files=files)
+            upload_result.extend(response.json()["upload_result"])
+
+    first, second = [result["file_info"] for result in upload_result]
+    assert second == first
+    assert first["file_name"] == "a.pdf"
+    assert upload_file_data.call_args.kwargs["length"] == len(b"same content")
+    duplicated = upload_file_data.call_args.kwargs["destination_file"]
+    assert duplicated.endswith("___b.pdf")
+    remove_object.assert_called_once_with(
+        bucket_name="rag", object_name=duplicated
+    )
+
+
 def test_ocr_bad_case_invalid_url(mocker):
     """test ocr"""
 
@@ -201,6 +245,112 @@ def test_ocr_ok(mocker):
         }
 
 
+def test_ocr_duplicated_content(mocker, tmp_path):
+    """test ocr on file with the same content alias to the ocr file"""
+
+    file_index = FileIndex(str(tmp_path / "file_index.db"))
+    job_queue = JobQueue(str(tmp_path / "job.db"))
+    mocker.patch("app.storage.storage.Storage.file_index", file_index)
+    mocker.patch("app.ocr.ocr.Ocr.ocr_progress", job_queue)
+
+    dup_file_id = "a-0b7c3b0e-0c5c-4d6e-a0e6-2f7f6b3d9c11"
+    file_index.add_file(FILE_ID, "content_hash")
+    file_index.add_file(dup_file_id, "content_hash")
+
+    with TestClient(app) as client:
+        post_data = {"signed_url": SIGNED_URL}
+        response = client.post("/ocr", json=post_data)
+        assert response.json() == {"status": "processing", "file_id": FILE_ID}
+
+        job_queue.complete(FILE_ID, job_queue.claim().lease)
+        post_data = {"signed_url": SIGNED_URL.replace(FILE_ID, dup_file_id)}
+        response = client.post("/ocr", json=post_data)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json() == {
+            "status": "completed",
+            "file_id": dup_file_id,
+        }
+
+        # no job for duplicated file
+        assert job_queue.get_job(dup_file_id) is None
+        assert file_index.resolve(dup_file_id) == FILE_ID
+        response = client.get(f"/ocr_progress/{dup_file_id}")
+        assert response.json() == {"status": "completed"}
+
+
+def test_ocr_reingest(mocker, tmp_path):
+    """test re-ingest existed file_id with the document of signed_url"""
+
+    file_index = FileIndex(str(tmp_path / "file_index.db"))
+    job_queue = JobQueue(str(tmp_path / "job.db"))
+    mocker.patch("app.storage.storage.Storage.file_index", file_index)
+    mocker.patch("app.ocr.ocr.Ocr.ocr_progress", job_queue)
+
+    new_file_id = "a-0b7c3b0e-0c5c-4d6e-a0e6-2f7f6b3d9c11"
+    new_signed_url = SIGNED_URL.replace(FILE_ID, new_file_id)
+    file_index.add_file(FILE_ID, "content_hash")
+    file_index.add_file(new_file_id, "new_content_hash")
+
+    with TestClient(app) as client:
+        post_data = {"signed_url": new_signed_url, "file_id": FILE_ID}
+        response = client.post("/ocr", json=post_data)
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+        client.post("/ocr", json={"signed_url": SIGNED_URL})
+        response = client.post("/ocr", json=post_data)
+        assert response.status_code == status.HTTP_409_CONFLICT
+
+        job_queue.complete(FILE_ID, job_queue.claim().lease)
+        response = client.post("/ocr", json=post_data)
+        assert response.json() == {"status": "processing", "file_id": FILE_ID}
+
+    job = job_queue.get_job(FILE_ID)
+    assert job.file_info.file_unique_name.startswith(new_file_id)
+    assert job_queue.get_job(new_file_id) is None
+    assert file_index.resolve(new_file_id) == FILE_ID
+    # the old content is not alias to file_id anymore
+    file_index.add_file("a-old-content-file-id", "content_hash")
+    assert file_index.get_ocr_file_id("a-old-content-file-id") is None
+    file_index.add_file("a-new-content-file-id", "new_content_hash")
+    assert file_index.get_ocr_file_id("a-new-content-file-id") == FILE_ID
+
+
+def test_ocr_reingest_detach_aliases(mocker, tmp_path):
+    """test files alias to re-ingested file_id keep the previous content"""
+
+    file_index = FileIndex(str(tmp_path / "file_index.db"))
+    job_queue = JobQueue(str(tmp_path / "job.db"))
+    mocker.patch("app.storage.storage.Storage.file_index", file_index)
+    mocker.patch("app.ocr.ocr.Ocr.ocr_progress", job_queue)
+
+    new_file_id = "a-0b7c3b0e-0c5c-4d6e-a0e6-2f7f6b3d9c11"
+    file_index.add_file(FILE_ID, "content_hash")
+    file_index.add_file(new_file_id, "new_content_hash")
+    for dup_file_id in ("a-dup-1", "a-dup-2"):
+        file_index.add_file(dup_file_id, "content_hash")
+        file_index.set_alias(dup_file_id, FILE_ID)
+
+    with TestClient(app) as client:
+        client.post("/ocr", json={"signed_url": SIGNED_URL})
+        job_queue.complete(FILE_ID, job_queue.claim().lease)
+        post_data = {
+            "signed_url": SIGNED_URL.replace(FILE_ID, new_file_id),
+            "file_id": FILE_ID,
+        }
+        response = client.post("/ocr", json=post_data)
+        assert response.json() == {"status": "processing", "file_id": FILE_ID}
+
+    # the first alias performs ocr of the previous document
+    assert file_index.resolve("a-dup-1") == "a-dup-1"
+    assert file_index.resolve("a-dup-2") == "a-dup-1"
+    job = job_queue.get_job("a-dup-1")
+    assert job.signed_url == SIGNED_URL
+    assert job.file_info.file_unique_name.startswith(FILE_ID)
+    file_index.add_file("a-old-content-file-id", "content_hash")
+    assert file_index.get_ocr_file_id("a-old-content-file-id") == "a-dup-1"
+    assert file_index.resolve(new_file_id) == FILE_ID
+
+
 def test_ocr_progress_bad_case():
     """test ocr_progress"""
 
@@ -216,6 +366,30 @@ def test_ocr_progress_bad_case():
         assert response.json() == {"detail": f"{bad_file_id} file_id not found"}
 
 
+def test_stream_ocr_progress(mocker, tmp_path):
+    """test stream ocr progress"""
+
+    job_queue = JobQueue(str(tmp_path / "job.db"))
+    mocker.patch("app.ocr.ocr.Ocr.ocr_progress", job_queue)
+    mocker.patch(
+        "app.ocr.ocr.Ocr.progress_broadcaster", ProgressBroadcaster(job_queue)
+    )
+
+    with TestClient(app) as client:
+        response = client.get("/ocr_progress/1234567890/stream")
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+        client.post("/ocr", json={"signed_url": SIGNED_URL})
+        job_queue.fail(FILE_ID, job_queue.claim().lease, "ocr failed")
+        response = client.get(f"/ocr_progress/{FILE_ID}/stream")
+        assert response.status_code == status.HTTP_200_OK
+        assert response.headers["content-type"].startswith("text/event-stream")
+        assert response.text == (
+            "event: failed\n"
+            'data: {"status": "failed", "error": "ocr failed"}\n\n'
+        )
+
+
 def test_extract_bad_case_payload_invalid(mocker):
     """test extract"""
 
@@ -254,12 +428,28 @@ def test_extract_bad_case_payload_invalid(mocker):
         response = client.post("/extract", json=post_data)
         assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
 
+    # payload top_k and ef out of range
+    with TestClient(app) as client:
+        for post_data in (
+            {"query": "query ok", "file_id": FILE_ID, "top_k": 0},
+            {"query": "query ok", "file_id": FILE_ID, "ef": 100000},
+        ):
+            response = client.post("/extract", json=post_data)
+            assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
 
-def test_extract_ok(mocker):
+def test_extract_ok(mocker, tmp_path):
     """test extract"""
 
-    answer = "my_answer"
     mocker.patch(
+        "app.storage.storage.Storage.file_index",
+        FileIndex(str(tmp_path / "file_index.db")),
+    )
+    mocker.patch(
+        "app.ocr.ocr.Ocr.ocr_progress", JobQueue(str(tmp_path / "job.db"))
+    )
+    answer = "my_answer"
+    generate = mocker.patch(
         "app.extract.extract.Extract.generate_answer", return_value=answer
     )
 
@@ -268,6 +458,19 @@ def test_extract_ok(mocker):
         response = client.post("/extract", json=post_data)
         assert response.status_code == status.HTTP_200_OK
         assert response.json() == {"answer": answer}
+        generate.assert_called_once_with(
+            "my_query", FILE_ID, "OpenAI", top_k=0, ef=0
+        )
+
+    # per request search parameters
+    with TestClient(app) as client:
+        post_data = {"query": "my_query", "file_id": FILE_ID, "top_k": 3}
+        post_data["ef"] = 64
+        response = client.post("/extract", json=post_data)
+        assert response.status_code == status.HTTP_200_OK
+        generate.assert_called_with(
+            "my_query", FILE_ID, "OpenAI", top_k=3, ef=64
+        )
 
     with TestClient(app) as client:
         post_data = {"query": "my_query", "file_id": FILE_ID, "api": "OpenAI"}
@@ -280,3 +483,84 @@ def test_extract_ok(mocker):
         response = client.post("/extract", json=post_data)
         assert response.status_code == status.HTTP_200_OK
         assert response.json() == {"answer": answer}
+
+
+def test_extract_batch(mocker, tmp_path):
+    """test extract batch"""
+
+    mocker.patch(
+        "app.storage.storage.Storage.file_index",
+        FileIndex(str(tmp_path / "file_index.db")),
+    )
+    mocker.patch(
+        "app.ocr.ocr.Ocr.ocr_progress", JobQueue(str(tmp_path / "job.db"))
+    )
+    generate = mocker.patch(
+        "app.extract.extract.Extract.generate_answer_batch",
+        return_value=["answer 1", "answer 2"],
+    )
+
+    with TestClient(app) as client:
+        post_data = {"queries": ["query 1", "query 2"], "file_id": FILE_ID}
+        response = client.post("/extract_batch", json=post_data)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json() == {"answers": ["answer 1", "answer 2"]}
+        generate.assert_called_once_with(
+            ["query 1", "query 2"], FILE_ID, "OpenAI"
+        )
+
+        # payload invalid
+        for post_data in (
+            {"queries": [], "file_id": FILE_ID},
+            {"queries": ["query ok", "my"], "file_id": FILE_ID},
+            {"queries": ["query ok"] * 101, "file_id": FILE_ID},
+            {"queries": ["query ok"], "file_id": "bad"},
+            {"queries": ["query ok"], "file_id": FILE_ID, "api": "bad"},
+            {"query": "query ok", "file_id": FILE_ID},
+        ):
+            response = client.post("/extract_batch", json=post_data)
+            assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+def test_extract_not_ready(mocker, tmp_path):
+    """test extract on a file until its first ingestion completed"""
+
+    file_index = FileIndex(str(tmp_path / "file_index.db"))
+    job_queue = JobQueue(str(tmp_path / "job.db"))
+    mocker.patch("app.storage.storage.Storage.file_index", file_index)
+    mocker.patch("app.ocr.ocr.Ocr.ocr_progress", job_queue)
+    mocker.patch(
+        "app.extract.extract.Extract.generate_answer", return_value="answer"
+    )
+    mocker.patch(
+        "app.extract.extract.Extract.generate_answer_batch",
+        return_value=["answer"],
+    )
+    file_info = FileInfo(
+        file_id=FILE_ID, file_name="test.pdf", file_unique_name="test.pdf"
+    )
+
+    with TestClient(app) as client:
+        job_queue.enqueue(file_info, SIGNED_URL)
+        response = client.post(
+            "/extract", json={"query": "my_query", "file_id": FILE_ID}
+        )
+        assert response.status_code == status.HTTP_409_CONFLICT
+        response = client.post(
+            "/extract_batch", json={"queries": ["my_query"], "file_id": FILE_ID}
+        )
+        assert response.status_code == status.HTTP_409_CONFLICT
+
+        file_index.set_ready(FILE_ID)
+        job_queue.complete(FILE_ID, job_queue.claim().lease)
+        response = client.post(
+            "/extract", json={"query": "my_query", "file_id": FILE_ID}
+        )
+        assert response.status_code == status.HTTP_200_OK
+
+        # re-ingest keeps previous content searchable
+        job_queue.enqueue(file_info, SIGNED_URL)
+        response = client.post(
+            "/extract", json={"query": "my_query", "file_id": FILE_ID}
+        )
+        assert response.status_code == status.HTTP_200_OK
@@ -0,0 +1,153 @@
+"""benchmark recall and memory of quantized local collections
+
+Documents are clustered random vectors of DEFAULT_EMBEDDING_DIMENSION,
+queries are documents with noise. Recall@k is against exact float32
+search, scanned bytes are what search reads of every vector, disk bytes
+are all files of the collection, build is upsert of all documents
+in batches including segment merges, and a final merge of all segments,
+which trains pq codebook on all documents.
+
+Run from repo root: `python -m app.vectordb.benchmark_quantization`
+"""
+
+# pylint: disable=protected-access
+
+import os
+import time
+import tempfile
+import numpy as np
+from loguru import logger
+from tcvectordb.model.document import Document
+from app.vectordb import local
+from app.vectordb.local import LocalCollection
+from app.vectordb.vectordb import VDB
+
+DOCUMENT_COUNT = 20000
+QUERY_COUNT = 200
+CLUSTER_COUNT = 200
+TOP_K = 10
+UPSERT_SIZE = 1000
+
+# dtype, quantization, pq m, rerank factor
+CONFIGS = [
+    ("float32", "none", 0, 0),
+    ("float16", "none", 0, 0),
+    ("float16", "int8", 0, 1),
+    ("float16", "int8", 0, 4),
+    ("float16", "pq", 64, 1),
+    ("float16", "pq", 64, 4),
+    ("float16", "pq", 64, 10),
+    ("float16", "pq", 128, 4),
+]
+
+
+def make_dataset(
+    dimension: int = VDB.DEFAULT_EMBEDDING_DIMENSION, seed: int = 0
+) -> tuple[np.ndarray, np.ndarray]:
+    """return documents and queries, both normalized"""
+
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((CLUSTER_COUNT, dimension))
+    documents = centers[rng.integers(CLUSTER_COUNT, size=DOCUMENT_COUNT)]
+    documents = documents + 0.8 * rng.standard_normal(documents.shape)
+    queries = documents[rng.choice(DOCUMENT_COUNT, QUERY_COUNT)]
+    queries = queries + 0.5 * rng.standard_normal(queries.shape)
+    documents /= np.linalg.norm(documents, axis=1, keepdims=True)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return documents.astype(np.float32), queries.astype(np.float32)
+
+
+def build(
+    path: str, dtype: str, quantization: str, documents: np.ndarray
+) -> tuple[LocalCollection, float]:
+    """upsert documents into a new collection of path
+
+    Returns:
+        tuple[LocalCollection, float]: the collection and seconds to build
+    """
+
+    start = time.perf_counter()
+    os.makedirs(path)
+    coll = LocalCollection(path, documents.shape[1], dtype, quantization)
+    coll.save()
+    for first in range(0, len(documents), UPSERT_SIZE):
+        coll.upsert(
+            [
+                Document(id=f"doc-{i}", vector=documents[i], content="")
+                for i in range(first, first + UPSERT_SIZE)
+            ]
+        )
+    coll.compact()
+    return coll, time.perf_counter() - start
+
+
+def scanned_bytes(dtype: str, quantization: str, pq_m: int) -> int:
+    """bytes search reads of every vector"""
+
+    if quantization == "int8":
+        # codes and scale
+        return VDB.DEFAULT_EMBEDDING_DIMENSION + 4
+    if quantization == "pq":
+        return pq_m
+    return VDB.DEFAULT_EMBEDDING_DIMENSION * np.dtype(dtype).itemsize
+
+
+def disk_bytes(path: str) -> int:
+    """bytes of all files of path"""
+
+    return sum(
+        os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)
+    )
+
+
+def evaluate(
+    coll: LocalCollection, queries: np.ndarray, exact: np.ndarray
+) -> tuple[float, list[float]]:
+    """return recall@k of coll and search latencies"""
+
+    hits = 0
+    latencies: list[float] = []
+    for query, expected in zip(queries, exact):
+        start = time.perf_counter()
+        result = coll.search(query, TOP_K, False)
+        latencies.append(time.perf_counter() - start)
+        ids = {int(doc["id"].split("-")[1]) for doc in result}
+        hits += len(ids.intersection(expected))
+    return hits / exact.size, latencies
+
+
+def main() -> None:
+    """run benchmark and print result"""
+
+    logger.disable("app")
+    documents, queries = make_dataset()
+    exact = np.argsort(-(queries @ documents.T), axis=1)[:, :TOP_K]
+
+    print(f"documents: {DOCUMENT_COUNT}, top_k: {TOP_K}")
+    print(
+        "dtype   | quantization | rerank | scanned B/vec | disk MB"
+        " | build (s) | recall@k | p50 (ms) | p99 (ms)"
+    )
+    with tempfile.TemporaryDirectory() as root:
+        for i, (dtype, quantization, pq_m, factor) in enumerate(CONFIGS):
+            local.VDB_LOCAL_PQ_M = pq_m
+            local.VDB_LOCAL_RERANK_FACTOR = factor
+            path = os.path.join(root, str(i))
+            coll, build_time = build(path, dtype, quantization, documents)
+            recall, latencies = evaluate(coll, queries, exact)
+            coll.close()
+
+            name = f"{quantization} m={pq_m}" if pq_m else quantization
+            print(
+                f"{dtype:7} | {name:12} | {factor or '-':>6}"
+                f" | {scanned_bytes(dtype, quantization, pq_m):13}"
+                f" | {disk_bytes(path) / 2**20:7.1f}"
+                f" | {build_time:9.1f}"
+                f" | {recall:8.3f}"
+                f" | {np.percentile(latencies, 50) * 1000:8.2f}"
+                f" | {np.percentile(latencies, 99) * 1000:8.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
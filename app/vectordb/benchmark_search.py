@@ -0,0 +1,211 @@
+"""benchmark recall and latency of vector search parameters
+
+The corpus is chunks of the bundled OCR result, chunked the same as OCR.
+Queries are sentences of the OCR result. Both are embedded by a stub of
+hashed character n-grams, or by the embedding api with --embedding api.
+Recall@k is against exact search of the same vectors, latency is of a
+search call.
+
+- tencent backend: a collection is created for each HNSW m of the sweep
+  with VDB_HNSW_EF_CONSTRUCTION, searched with each ef and top_k,
+  and dropped after
+- local backend: ef is the min shortlist of VDB_LOCAL_QUANTIZATION codes
+  re-ranked by float vectors, m is not used. Search without quantization
+  is exact, recall is always 1, so the benchmark exits instead. pq codes
+  need merged segments of VDB_LOCAL_PQ_MIN_ROWS rows, smaller corpora are
+  measured with int8 codes
+
+Pick VDB_HNSW_M and VDB_SEARCH_EF of the lowest latency with enough
+recall, or override ef and top_k of a /extract request.
+
+Run from repo root:
+`python -m app.vectordb.benchmark_search [--backend tencent] [--embedding api]`
+"""
+
+# pylint: disable=protected-access
+
+import time
+import zlib
+import argparse
+import tempfile
+import numpy as np
+from loguru import logger
+from app.embedding.embedding import Embedding
+from app.helper.file import FileInfo
+from app.helper.retry import retry
+from app.ocr.benchmark_chunk import load_paragraphs
+from app.ocr.ocr import Ocr
+from app.storage.keyword_index import get_grams
+from app.vectordb import local
+from app.vectordb.local import LocalVDB
+from app.vectordb.vectordb import VDB
+
+QUERY_MIN_LEN = 20
+"""min characters of a sentence picked as query"""
+
+UPSERT_SIZE = 100
+
+
+def load_corpus(count: int, seed: int = 0) -> tuple[list[str], list[str]]:
+    """return chunks of the bundled OCR result and count queries"""
+
+    paragraphs = load_paragraphs()
+    ocr = Ocr(
+        "",
+        FileInfo(file_id="a-benchmark", file_name="", file_unique_name=""),
+    )
+    chunks = ocr._get_embedding_content_list(paragraphs)
+
+    sentences = [
+        p["content"] for p in paragraphs if len(p["content"]) >= QUERY_MIN_LEN
+    ]
+    rng = np.random.default_rng(seed)
+    picked = rng.choice(len(sentences), min(count, len(sentences)), False)
+    return chunks, [sentences[i] for i in picked]
+
+
+def stub_embedding(
+    texts: list[str], dimension: int = VDB.DEFAULT_EMBEDDING_DIMENSION
+) -> np.ndarray:
+    """embed texts by signed hashing of character n-grams, texts sharing
+    grams are similar, no embedding api is needed"""
+
+    vectors = np.zeros((len(texts), dimension), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for gram in get_grams(text):
+            h = zlib.crc32(gram.encode("utf-8"))
+            vectors[row, h % dimension] += 1.0 if h & 1 << 31 else -1.0
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def embed(texts: list[str], embedding: str) -> np.ndarray:
+    """embed texts by stub or api, normalized"""
+
+    if embedding == "stub":
+        return stub_embedding(texts)
+
+    em = Embedding()
+    vec_list: list[list[float]] = []
+    for i in range(0, len(texts), Embedding.EMBEDDING_BATCH_SIZE):
+        vec_list.extend(
+            em.embedding_list_cached(
+                texts[i : i + Embedding.EMBEDDING_BATCH_SIZE]
+            )
+        )
+    vectors = np.asarray(vec_list, dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def create_collection(backend: str, name: str, m: int, root: str):
+    """create a collection of name, with HNSW m for tencent backend
+
+    Returns:
+        VDB | LocalVDB: instance of the new collection
+    """
+
+    if backend == "local":
+        vdb = LocalVDB(database=VDB.DATABASE_RAG, collection=name, root=root)
+    else:
+        VDB.VDB_HNSW_M = m
+        vdb = VDB.default_vdb(layout="collection")
+        vdb.collection = name
+        if vdb.is_collection_existed(name) is not None:
+            # leftover of an interrupted run
+            vdb.drop_collection()
+    vdb._get_or_create_collection(dimension=VDB.DEFAULT_EMBEDDING_DIMENSION)
+    return vdb
+
+
+def ingest(vdb, chunks: list[str], vectors: np.ndarray) -> None:
+    """upsert chunks with id of their index, wait until searchable"""
+
+    for first in range(0, len(chunks), UPSERT_SIZE):
+        retry(
+            vdb.upsert_data,
+            [
+                vdb.new_document(f"doc-{i}", vectors[i].tolist(), chunks[i])
+                for i in range(first, min(first + UPSERT_SIZE, len(chunks)))
+            ],
+        )
+
+    if isinstance(vdb, VDB):
+        # upsert is visible with a delay
+        retry(_check_count, vdb, len(chunks), max_retries=30, delay=1.0)
+
+
+def _check_count(vdb: VDB, expected: int) -> None:
+    count = vdb.count()
+    if count != expected:
+        raise ValueError(f"count {count} not reach {expected}")
+
+
+def evaluate(
+    vdb, queries: np.ndarray, exact: np.ndarray, top_k: int, ef: int
+) -> tuple[float, list[float]]:
+    """return recall@k of search with ef and top_k, and search latencies"""
+
+    hits = 0
+    latencies: list[float] = []
+    for query, expected in zip(queries, exact[:, :top_k]):
+        start = time.perf_counter()
+        result = vdb.search(query.tolist(), top_k=top_k, ef=ef)
+        latencies.append(time.perf_counter() - start)
+        ids = {int(doc["id"].split("-")[1]) for doc in result}
+        hits += len(ids.intersection(expected))
+    return hits / (len(queries) * top_k), latencies
+
+
+def main() -> None:
+    """run benchmark and print result"""
+
+    parser = argparse.ArgumentParser(
+        description="benchmark recall and latency of vector search parameters"
+    )
+    parser.add_argument("--backend", choices=["local", "tencent"])
+    parser.add_argument("--embedding", choices=["stub", "api"], default="stub")
+    parser.add_argument("--m", type=int, nargs="+", default=[8, 16, 32])
+    parser.add_argument(
+        "--ef", type=int, nargs="+", default=[10, 20, 50, 100, 200, 400]
+    )
+    parser.add_argument("--top-k", type=int, nargs="+", default=[3, 5, 10])
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+    backend = args.backend or VDB.VDB_BACKEND
+    if backend == "local" and local.VDB_LOCAL_QUANTIZATION == "none":
+        parser.error(
+            "local search without quantization is exact, recall is always"
+            " 1.000 for any ef, set VDB_LOCAL_QUANTIZATION=int8 or pq,"
+            " or use --backend tencent"
+        )
+
+    logger.disable("app")
+    chunks, query_texts = load_corpus(args.queries)
+    documents = embed(chunks, args.embedding)
+    queries = embed(query_texts, args.embedding)
+    exact = np.argsort(-(queries @ documents.T), axis=1, kind="stable")
+
+    print(
+        f"backend: {backend}, embedding: {args.embedding}"
+        f", chunks: {len(chunks)}, queries: {len(queries)}"
+    )
+    print("m  | ef  | top_k | recall@k | p50 (ms) | p99 (ms)")
+    with tempfile.TemporaryDirectory() as root:
+        for m in args.m if backend == "tencent" else [0]:
+            vdb = create_collection(backend, f"benchmark-m{m}", m, root)
+            ingest(vdb, chunks, documents)
+            for top_k in args.top_k:
+                for ef in args.ef:
+                    recall, latencies = evaluate(vdb, queries, exact, top_k, ef)
+                    print(
+                        f"{m or '-':>2} | {ef:3} | {top_k:5}"
+                        f" | {recall:8.3f}"
+                        f" | {np.percentile(latencies, 50) * 1000:8.2f}"
+                        f" | {np.percentile(latencies, 99) * 1000:8.2f}"
+                    )
+            if backend == "tencent":
+                vdb.drop_collection()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""ttl cache of vector db handles"""
+
+import os
+import time
+import threading
+from typing import Any, Hashable
+
+VDB_HANDLE_TTL = float(os.getenv("VDB_HANDLE_TTL", "300"))
+"""seconds a database or collection handle is cached"""
+
+VDB_MISSING_TTL = float(os.getenv("VDB_MISSING_TTL", "5"))
+"""
+seconds a missing database or collection is cached,
+shorter since it may be created by worker process soon
+"""
+
+
+class HandleCache:
+    """Thread-safe TTL cache of database and collection handles
+
+    None is cached as negative entry for missing database or collection.
+    """
+
+    def __init__(
+        self,
+        ttl: float = VDB_HANDLE_TTL,
+        missing_ttl: float = VDB_MISSING_TTL,
+    ) -> None:
+        """init cache
+
+        Args:
+            ttl (float, optional): seconds a handle is cached.
+            Defaults to VDB_HANDLE_TTL.
+            missing_ttl (float, optional): seconds a missing handle is cached.
+            Defaults to VDB_MISSING_TTL.
+        """
+
+        self._ttl = ttl
+        self._missing_ttl = missing_ttl
+        # key -> (expire time, handle or None)
+        self._entries: dict[Hashable, tuple[float, Any]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> tuple[bool, Any]:
+        """get handle of key
+
+        Returns:
+            tuple[bool, Any]: whether key is cached, and the handle,
+            None if cached as missing
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+
+            expire, handle = entry
+            if expire <= time.monotonic():
+                del self._entries[key]
+                return False, None
+
+            return True, handle
+
+    def put(self, key: Hashable, handle: Any) -> None:
+        """cache handle of key, None for missing"""
+
+        ttl = self._missing_ttl if handle is None else self._ttl
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, handle)
+
+    def invalidate(self, key: Hashable) -> None:
+        """remove handle of key"""
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        """remove all handles"""
+
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,709 @@
+"""in-process vector index"""
+
+import os
+import json
+import fcntl
+import shutil
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterator
+import numpy as np
+from loguru import logger
+from tcvectordb.model.document import Document
+from app.vectordb.segment import Segment, write_segment
+from app.vectordb.quantize import Codes, write_codes
+
+VDB_LOCAL_DIR = os.getenv("VDB_LOCAL_DIR", "vdb_local")
+"""directory of local vector index files"""
+
+VDB_LOCAL_DTYPE = os.getenv("VDB_LOCAL_DTYPE", "float32")
+"""dtype of vectors in local segments, float32 or float16"""
+
+VDB_LOCAL_MAX_SEGMENTS = int(os.getenv("VDB_LOCAL_MAX_SEGMENTS", "8"))
+"""segments of a local collection to merge into one"""
+
+VDB_LOCAL_MAX_OPEN = int(os.getenv("VDB_LOCAL_MAX_OPEN", "256"))
+"""local collections kept open by a process, least recently used are closed"""
+
+VDB_LOCAL_QUANTIZATION = os.getenv("VDB_LOCAL_QUANTIZATION", "none")
+"""
+quantized codes of local segments scanned by search,
+none, int8 or pq, the shortlist is re-ranked by float vectors
+"""
+
+VDB_LOCAL_PQ_M = int(os.getenv("VDB_LOCAL_PQ_M", "64"))
+"""sub spaces of pq, bytes of a pq code, dimension must be a multiple of it"""
+
+VDB_LOCAL_PQ_MIN_ROWS = int(os.getenv("VDB_LOCAL_PQ_MIN_ROWS", "10000"))
+"""
+min rows of a merged segment to train pq codebook on,
+smaller segments and segments not merged yet have int8 codes
+"""
+
+VDB_LOCAL_RERANK_FACTOR = int(os.getenv("VDB_LOCAL_RERANK_FACTOR", "4"))
+"""shortlist of quantized search is top_k * VDB_LOCAL_RERANK_FACTOR rows"""
+
+VDB_LOCAL_SEARCH_BLOCK = 4096
+"""rows scored at a time"""
+
+
+# pylint: disable-next=too-many-instance-attributes
+class LocalCollection:
+    """Vectors of a collection in immutable memory-mapped segments
+
+    Vectors are normalized when written, so cosine similarity is a dot
+    product. Every upsert writes a new segment, replaced and deleted
+    documents are recorded as deleted rows of their segment in
+    manifest.json, and segments are merged into one when there are more
+    than VDB_LOCAL_MAX_SEGMENTS. Segments are opened with mmap, so a
+    collection costs little memory until searched, and search reads
+    vector pages on demand. The manifest is replaced atomically on every
+    write, and reloaded when written by another process. Processes
+    sharing the directory hold an exclusive flock of its lock file to
+    read, modify and write the manifest and to remove merged segments,
+    and a shared one to read.
+
+    With quantization, search scans int8 or pq codes of each segment,
+    written next to it, and reads float vectors of the shortlist only.
+    pq codebook is trained when segments are merged, on at least
+    VDB_LOCAL_PQ_MIN_ROWS rows, other segments have int8 codes.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        dimension: int,
+        dtype: str = VDB_LOCAL_DTYPE,
+        quantization: str = VDB_LOCAL_QUANTIZATION,
+    ) -> None:
+        """init collection
+
+        Args:
+            path (str): collection directory
+            dimension (int): vector dimension
+            dtype (str, optional): dtype of vector block of new segments,
+            float32 or float16. Defaults to VDB_LOCAL_DTYPE.
+            quantization (str, optional): none, int8 or pq.
+            Defaults to VDB_LOCAL_QUANTIZATION.
+        """
+
+        self.path = path
+        self.dimension = dimension
+        self.dtype = dtype
+        self.quantization = quantization
+        self._lock = threading.Lock()
+        self._manifest: dict = {"next_segment": 0, "segments": []}
+        self._segments: dict[str, Segment] = {}
+        # codes of segment name, opened on search
+        self._codes: dict[str, Codes] = {}
+        # doc id -> (segment name, row) of live documents, built on write
+        self._rows: dict[str, tuple[str, int]] | None = None
+        # manifest is replaced on write, its inode, mtime and size identify
+        # the version loaded
+        self._version: tuple[int, int, int] | None = None
+
+    @property
+    def size(self) -> int:
+        """document count"""
+
+        return sum(
+            self._segments[entry["name"]].count - len(entry["deleted"])
+            for entry in self._manifest["segments"]
+        )
+
+    def _get_manifest_path(self) -> str:
+        return os.path.join(self.path, "manifest.json")
+
+    @contextmanager
+    def _flock(self, operation: int) -> Iterator[None]:
+        """hold flock of the lock file of collection directory,
+        operation is fcntl.LOCK_SH or fcntl.LOCK_EX"""
+
+        fd = os.open(os.path.join(self.path, "lock"), os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, operation)
+            yield
+        finally:
+            # closing the file releases the lock
+            os.close(fd)
+
+    def create(self) -> None:
+        """save manifest of the empty collection,
+        load it instead if created by another process"""
+
+        with self._lock, self._flock(fcntl.LOCK_EX):
+            if os.path.exists(self._get_manifest_path()):
+                self._load()
+            else:
+                self.save()
+
+    def load(self) -> None:
+        """load manifest and open segments if written by another process"""
+
+        with self._lock, self._flock(fcntl.LOCK_SH):
+            self._load()
+
+    def _load(self) -> None:
+        version = self._get_version()
+        if version == self._version:
+            return
+
+        with open(self._get_manifest_path(), encoding="utf-8") as f:
+            manifest = json.load(f)
+
+        names = {entry["name"] for entry in manifest["segments"]}
+        for name in list(self._segments):
+            if name not in names:
+                self._close_segment(name)
+        for name in names - self._segments.keys():
+            self._segments[name] = Segment(os.path.join(self.path, name))
+
+        self.dimension = manifest["dimension"]
+        self._manifest = manifest
+        self._rows = None
+        self._version = version
+        logger.info(f"load local collection, path: {self.path}")
+
+    def save(self) -> None:
+        """write manifest atomically"""
+
+        self._manifest["dimension"] = self.dimension
+        manifest_path = self._get_manifest_path()
+        tmp_path = f"{manifest_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._manifest, f)
+        os.replace(tmp_path, manifest_path)
+        self._version = self._get_version()
+
+    def _get_version(self) -> tuple[int, int, int]:
+        stat = os.stat(self._get_manifest_path())
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def close(self) -> None:
+        """unmap all segments, reopened on next use"""
+
+        with self._lock:
+            for name in list(self._segments):
+                self._close_segment(name)
+            self._manifest = {"next_segment": 0, "segments": []}
+            self._rows = None
+            self._version = None
+
+    def _close_segment(self, name: str) -> None:
+        self._segments.pop(name).close()
+        codes = self._codes.pop(name, None)
+        if codes is not None:
+            codes.close()
+
+    def _get_codes_path(self, name: str) -> str:
+        return os.path.join(self.path, f"{name}.{self.quantization}")
+
+    def _get_codes(self, name: str) -> Codes:
+        """return codes of segment name,
+        written if missing, e.g. quantization is enabled later"""
+
+        codes = self._codes.get(name)
+        if codes is None:
+            path = self._get_codes_path(name)
+            if not os.path.exists(path):
+                self._write_codes(name, self._segments[name].vectors)
+                logger.info(f"write codes, path: {path}")
+            codes = self._codes[name] = Codes(path)
+        return codes
+
+    def _get_rows(self) -> dict[str, tuple[str, int]]:
+        if self._rows is None:
+            self._rows = {}
+            for entry in self._manifest["segments"]:
+                deleted = set(entry["deleted"])
+                ids = self._segments[entry["name"]].get_ids()
+                for row, doc_id in enumerate(ids):
+                    if row not in deleted:
+                        self._rows[doc_id] = (entry["name"], row)
+        return self._rows
+
+    def _mark_deleted(self, doc_id_list: list[str]) -> int:
+        """record rows of doc_id_list as deleted, return deleted count"""
+
+        rows = self._get_rows()
+        entries = {entry["name"]: entry for entry in self._manifest["segments"]}
+        count = 0
+        for doc_id in doc_id_list:
+            location = rows.pop(doc_id, None)
+            if location is not None:
+                name, row = location
+                entries[name]["deleted"].append(row)
+                count += 1
+        return count
+
+    def _write_codes(
+        self, name: str, vectors: np.ndarray, merged: bool = False
+    ) -> None:
+        """write codes of segment name, int8 instead of pq unless merged
+        of at least VDB_LOCAL_PQ_MIN_ROWS rows"""
+
+        quantization = self.quantization
+        if quantization == "pq" and (
+            not merged or len(vectors) < VDB_LOCAL_PQ_MIN_ROWS
+        ):
+            quantization = "int8"
+        write_codes(
+            self._get_codes_path(name), quantization, vectors, VDB_LOCAL_PQ_M
+        )
+
+    def _write_segment(
+        self,
+        ids: list[str],
+        contents: list[str],
+        vectors: np.ndarray,
+        merged: bool = False,
+    ) -> str:
+        """write a new segment, return its name"""
+
+        name = f"seg-{self._manifest['next_segment']:08d}.vseg"
+        self._manifest["next_segment"] += 1
+        path = os.path.join(self.path, name)
+        write_segment(path, ids, contents, vectors, self.dtype)
+        if self.quantization != "none":
+            self._write_codes(name, vectors, merged)
+        self._segments[name] = Segment(path)
+        return name
+
+    def upsert(self, document_list: list[Document]) -> None:
+        """update or insert documents, then save"""
+
+        # the last one wins if an id is repeated
+        documents: dict[str, tuple[np.ndarray, str]] = {}
+        for doc in document_list:
+            # Document keep fields in __dict__
+            fields = vars(doc)
+            vector = np.asarray(fields["vector"], dtype=np.float32)
+            if vector.shape != (self.dimension,):
+                raise ValueError(
+                    f"vector dimension {vector.shape} not match"
+                    f" {self.dimension}"
+                )
+            norm = np.linalg.norm(vector)
+            if norm > 0:
+                vector = vector / norm
+            documents[fields["id"]] = (vector, fields.get("content", ""))
+        if len(documents) == 0:
+            return
+
+        with self._lock, self._flock(fcntl.LOCK_EX):
+            self._load()
+            ids = list(documents)
+            self._mark_deleted(ids)
+            name = self._write_segment(
+                ids,
+                [content for _, content in documents.values()],
+                np.stack([vector for vector, _ in documents.values()]),
+            )
+            self._manifest["segments"].append({"name": name, "deleted": []})
+            rows = self._get_rows()
+            for row, doc_id in enumerate(ids):
+                rows[doc_id] = (name, row)
+
+            if len(self._manifest["segments"]) > VDB_LOCAL_MAX_SEGMENTS:
+                self._compact()
+            else:
+                self.save()
+
+    def _compact(self) -> None:
+        """merge live rows of all segments into one segment, then save"""
+
+        old_names = [entry["name"] for entry in self._manifest["segments"]]
+        ids: list[str] = []
+        contents: list[str] = []
+        vectors: list[np.ndarray] = []
+        for entry in self._manifest["segments"]:
+            segment = self._segments[entry["name"]]
+            live = np.setdiff1d(
+                np.arange(segment.count), entry["deleted"], assume_unique=True
+            )
+            ids.extend(segment.get_id(row) for row in live)
+            contents.extend(segment.get_content(row) for row in live)
+            vectors.append(np.asarray(segment.vectors[live], dtype=np.float32))
+
+        name = self._write_segment(
+            ids,
+            contents,
+            np.concatenate(vectors).reshape(-1, self.dimension),
+            merged=True,
+        )
+        self._manifest["segments"] = [{"name": name, "deleted": []}]
+        self._rows = {doc_id: (name, row) for row, doc_id in enumerate(ids)}
+        self.save()
+
+        # readers still mapping old segments keep them until reloaded
+        for old_name in old_names:
+            self._close_segment(old_name)
+            for file_name in os.listdir(self.path):
+                # segment and its codes of any quantization
+                if file_name.split(".")[0] == old_name.split(".")[0]:
+                    os.remove(os.path.join(self.path, file_name))
+        logger.info(
+            f"compact local collection, path: {self.path},"
+            f" segments: {len(old_names)}, count: {len(ids)}"
+        )
+
+    def compact(self) -> None:
+        """merge all segments into one now, e.g. after a bulk load,
+        so that pq codebook is trained on all rows"""
+
+        with self._lock, self._flock(fcntl.LOCK_EX):
+            self._load()
+            if len(self._manifest["segments"]) > 0:
+                self._compact()
+
+    def delete(self, doc_id_list: list[str]) -> None:
+        """delete documents of doc_id_list, then save"""
+
+        with self._lock, self._flock(fcntl.LOCK_EX):
+            self._load()
+            if self._mark_deleted(doc_id_list) > 0:
+                self.save()
+
+    def _score(self, segment: Segment, queries: np.ndarray) -> np.ndarray:
+        """cosine similarity of queries to every row of segment,
+        computed by blocks to bound float32 copies of float16 vectors,
+        every block is read once for all queries
+
+        Returns:
+            np.ndarray: queries x rows scores
+        """
+
+        scores = np.empty((len(queries), segment.count), dtype=np.float32)
+        for start in range(0, segment.count, VDB_LOCAL_SEARCH_BLOCK):
+            block = segment.vectors[start : start + VDB_LOCAL_SEARCH_BLOCK]
+            scores[:, start : start + len(block)] = (
+                queries @ np.asarray(block, dtype=np.float32).T
+            )
+        return scores
+
+    def _get_candidates(
+        self, queries: np.ndarray, top_k: int, ef: int
+    ) -> list[list[tuple[float, Segment, int]]]:
+        """return score, segment and row of top k live rows of each segment,
+        for each query, ef is the min shortlist of quantized search"""
+
+        candidates: list[list[tuple[float, Segment, int]]] = [
+            [] for _ in queries
+        ]
+        for entry in self._manifest["segments"]:
+            segment = self._segments[entry["name"]]
+            k = min(top_k, segment.count)
+            if k <= 0:
+                continue
+
+            if self.quantization == "none":
+                scores = self._score(segment, queries)
+                scores[:, entry["deleted"]] = -np.inf
+                # top k in any order, the k only are sorted when merged
+                rows = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, rows, axis=1)
+            else:
+                rows, scores = self._rerank(
+                    entry, queries, k, max(k * VDB_LOCAL_RERANK_FACTOR, ef)
+                )
+
+            for query_candidates, query_rows, query_scores in zip(
+                candidates, rows, scores
+            ):
+                query_candidates.extend(
+                    (float(score), segment, int(row))
+                    for row, score in zip(query_rows, query_scores)
+                    if score > -np.inf
+                )
+        return candidates
+
+    def _rerank(
+        self, entry: dict, queries: np.ndarray, k: int, shortlist_size: int
+    ) -> tuple[list[np.ndarray], list[np.ndarray]]:
+        """shortlist rows of segment entry by codes,
+        then re-rank by float vectors
+
+        Returns:
+            tuple[list[np.ndarray], list[np.ndarray]]: top k live rows and
+            their scores of each query
+        """
+
+        segment = self._segments[entry["name"]]
+        scores = self._get_codes(entry["name"]).score(queries)
+        scores[:, entry["deleted"]] = -np.inf
+        shortlist_size = min(max(k, shortlist_size), segment.count)
+        shortlists = np.argpartition(-scores, shortlist_size - 1, axis=1)[
+            :, :shortlist_size
+        ]
+
+        rows_list: list[np.ndarray] = []
+        exact_list: list[np.ndarray] = []
+        for query, query_scores, shortlist in zip(queries, scores, shortlists):
+            # ascending rows read vector pages in file order
+            shortlist = np.sort(shortlist[query_scores[shortlist] > -np.inf])
+            if len(shortlist) == 0:
+                rows_list.append(shortlist)
+                exact_list.append(query_scores[shortlist])
+                continue
+
+            exact = (
+                np.asarray(segment.vectors[shortlist], dtype=np.float32) @ query
+            )
+            top = np.argpartition(-exact, min(k, len(exact)) - 1)[:k]
+            rows_list.append(shortlist[top])
+            exact_list.append(exact[top])
+        return rows_list, exact_list
+
+    def search(
+        self,
+        vector: list[float],
+        top_k: int,
+        retrieve_vector: bool,
+        ef: int = 0,
+    ) -> list[dict]:
+        """return top_k documents with the highest cosine similarity,
+        search is exact without quantization, ef is the min shortlist
+        re-ranked by float vectors of each segment with quantization
+
+        Returns:
+            list[dict]: documents with id, score and content,
+            and vector if retrieve_vector, in score descending order
+        """
+
+        return self.search_batch([vector], top_k, retrieve_vector, ef)[0]
+
+    def search_batch(
+        self,
+        vectors: list[list[float]],
+        top_k: int,
+        retrieve_vector: bool,
+        ef: int = 0,
+    ) -> list[list[dict]]:
+        """search top_k documents of every vector in one pass of segments
+
+        Returns:
+            list[list[dict]]: documents of each vector, see search
+        """
+
+        if len(vectors) == 0:
+            return []
+
+        queries = np.asarray(vectors, dtype=np.float32).reshape(
+            len(vectors), -1
+        )
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries = queries / np.where(norms > 0, norms, 1)
+
+        with self._lock, self._flock(fcntl.LOCK_SH):
+            self._load()
+            doc_lists: list[list[dict]] = []
+            for candidates in self._get_candidates(queries, top_k, ef):
+                candidates.sort(key=lambda candidate: -candidate[0])
+                doc_list: list[dict] = []
+                for score, segment, row in candidates[:top_k]:
+                    doc = {
+                        "id": segment.get_id(row),
+                        "score": score,
+                        "content": segment.get_content(row),
+                    }
+                    if retrieve_vector:
+                        doc["vector"] = np.asarray(
+                            segment.vectors[row], dtype=np.float32
+                        ).tolist()
+                    doc_list.append(doc)
+                doc_lists.append(doc_list)
+            return doc_lists
+
+    def get_vectors(self, doc_id_list: list[str]) -> dict[str, list[float]]:
+        """return vectors of documents of doc_id_list,
+        documents not existed are missing"""
+
+        with self._lock, self._flock(fcntl.LOCK_SH):
+            self._load()
+            rows = self._get_rows()
+            vectors: dict[str, list[float]] = {}
+            for doc_id in doc_id_list:
+                location = rows.get(doc_id)
+                if location is not None:
+                    name, row = location
+                    vectors[doc_id] = np.asarray(
+                        self._segments[name].vectors[row], dtype=np.float32
+                    ).tolist()
+            return vectors
+
+
+class LocalVDB:
+    """Vector db operations on in-process vector index,
+    same interface as VDB, no remote vector db service is needed
+
+    Collections are shared by LocalVDB instances of the same process,
+    at most VDB_LOCAL_MAX_OPEN are kept open.
+    """
+
+    _collections: OrderedDict[str, LocalCollection] = OrderedDict()
+    """open collections of current process in least recently used order,
+    key is collection directory"""
+
+    _collections_lock = threading.Lock()
+
+    def __init__(
+        self, database: str, collection: str, root: str = VDB_LOCAL_DIR
+    ) -> None:
+        """init local vector db
+
+        Args:
+            database (str): database name, a sub directory of root
+            collection (str): collection name
+            root (str, optional): directory of index files.
+            Defaults to VDB_LOCAL_DIR.
+        """
+
+        self._database = database
+        self._db_dir = os.path.join(root, database)
+        self.collection = collection
+
+    def _get_path(self, collection: str) -> str:
+        if (
+            len(collection) == 0
+            or os.sep in collection
+            or collection.startswith(".")
+        ):
+            raise ValueError(f"invalid collection name: {collection}")
+
+        return os.path.join(self._db_dir, collection)
+
+    def drop_db(self):
+        """Drop database"""
+
+        shutil.rmtree(self._db_dir, ignore_errors=True)
+        with LocalVDB._collections_lock:
+            for coll in LocalVDB._collections.values():
+                coll.close()
+            LocalVDB._collections.clear()
+        logger.info(f"{self._database} drop database success")
+
+    def is_db_existed(self) -> str | None:
+        """check whether database existed or not
+
+        Returns:
+            str | None: database directory, None if not existed
+        """
+
+        if os.path.isdir(self._db_dir):
+            return self._db_dir
+
+        return None
+
+    def is_collection_existed(
+        self, collection: str = ""
+    ) -> LocalCollection | None:
+        """check whether collection existed or not"""
+
+        if len(collection) == 0:
+            collection = self.collection
+
+        path = self._get_path(collection)
+        with LocalVDB._collections_lock:
+            coll = LocalVDB._collections.get(path)
+            if coll is not None:
+                LocalVDB._collections.move_to_end(path)
+                return coll
+
+            if not os.path.exists(os.path.join(path, "manifest.json")):
+                return None
+
+            coll = LocalCollection(path, dimension=0)
+            coll.load()
+            LocalVDB._add_collection(coll)
+            return coll
+
+    @staticmethod
+    def _add_collection(coll: LocalCollection) -> None:
+        """keep coll open, close the least recently used over max open,
+        a closed collection still in use reopens itself"""
+
+        LocalVDB._collections[coll.path] = coll
+        while len(LocalVDB._collections) > VDB_LOCAL_MAX_OPEN:
+            _, evicted = LocalVDB._collections.popitem(last=False)
+            evicted.close()
+
+    def _get_or_create_collection(self, dimension: int) -> LocalCollection:
+        coll = self.is_collection_existed()
+        if coll is not None:
+            logger.info(f"{self.collection} Collection existed")
+            return coll
+
+        path = self._get_path(self.collection)
+        os.makedirs(path, exist_ok=True)
+        with LocalVDB._collections_lock:
+            coll = LocalVDB._collections.get(path)
+            if coll is None:
+                coll = LocalCollection(path, dimension)
+                coll.create()
+                LocalVDB._add_collection(coll)
+
+        logger.info(f"{self.collection} Create collection success")
+        return coll
+
+    def _get_collection(self) -> LocalCollection:
+        coll = self.is_collection_existed()
+        if coll is None:
+            raise ValueError(f"{self.collection} Collection not exist")
+        return coll
+
+    def new_document(
+        self, doc_id: str, vector: list[float], content: str
+    ) -> Document:
+        """return a new document instance"""
+
+        return Document(id=doc_id, vector=vector, content=content)
+
+    def upsert_data(self, document_list: list[Document]) -> None:
+        """update or insert document list data into collection"""
+
+        self._get_collection().upsert(document_list)
+        logger.info(f"upsert success, count: {len(document_list)}")
+
+    def delete_data(self, doc_id_list: list[str]) -> None:
+        """delete documents of doc_id_list from collection"""
+
+        if len(doc_id_list) == 0:
+            return
+
+        self._get_collection().delete(doc_id_list)
+        logger.info(f"delete success, count: {len(doc_id_list)}")
+
+    def search(
+        self,
+        vector: list[float],
+        top_k: int = 10,
+        retrieve_vector: bool = False,
+        ef: int = 0,
+    ) -> list[dict]:
+        """search using vector"""
+
+        return self.search_batch([vector], top_k, retrieve_vector, ef)[0]
+
+    def search_batch(
+        self,
+        vectors: list[list[float]],
+        top_k: int = 10,
+        retrieve_vector: bool = False,
+        ef: int = 0,
+    ) -> list[list[dict]]:
+        """search using vectors, documents of each vector in the same order,
+        ef is the min shortlist of quantized search"""
+
+        doc_lists = self._get_collection().search_batch(
+            vectors, top_k, retrieve_vector, ef
+        )
+        if any(len(doc_list) == 0 for doc_list in doc_lists):
+            logger.warning("doc_list is empty")
+        return doc_lists
+
+    def get_vectors(self, doc_id_list: list[str]) -> dict[str, list[float]]:
+        """return vectors of documents of doc_id_list,
+        documents not existed are missing"""
+
+        return self._get_collection().get_vectors(doc_id_list)
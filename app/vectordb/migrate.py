@@ -0,0 +1,108 @@
+"""move documents of per-file collections into shared collections
+
+Documents are copied with their ids, so that migration can run again
+after failure, and per-file collection is dropped only with --drop
+after the shared collection has the same document count of the file.
+Switch to VDB_LAYOUT=shared once all files are migrated.
+
+Run from repo root: `python -m app.vectordb.migrate [--drop] [file_id ...]`
+"""
+
+import os
+import argparse
+from loguru import logger
+from app.helper.retry import retry
+from app.vectordb.vectordb import VDB
+
+MIGRATE_PAGE_SIZE = int(os.getenv("MIGRATE_PAGE_SIZE", "100"))
+"""documents read and written a request"""
+
+
+def migrate_collection(
+    src: VDB, dst: VDB, page_size: int = MIGRATE_PAGE_SIZE
+) -> int:
+    """copy all documents of src collection into dst
+
+    Args:
+        src (VDB): per-file layout instance of the file
+        dst (VDB): shared layout instance of the same file
+        page_size (int, optional): documents a request.
+        Defaults to MIGRATE_PAGE_SIZE.
+
+    Raises:
+        ValueError: if document count of dst not match src after copied
+
+    Returns:
+        int: document count copied
+    """
+
+    offset = 0
+    while True:
+        doc_list = src.query_data(offset, page_size)
+        if len(doc_list) > 0:
+            retry(
+                dst.upsert_data,
+                [
+                    dst.new_document(
+                        doc["id"], doc["vector"], doc.get("content", "")
+                    )
+                    for doc in doc_list
+                ],
+            )
+        offset += len(doc_list)
+        if len(doc_list) < page_size:
+            break
+
+    # upsert is visible with a delay
+    retry(_check_count, dst, offset, max_retries=10, delay=1.0)
+    return offset
+
+
+def _check_count(dst: VDB, expected: int) -> None:
+    count = dst.count()
+    if count != expected:
+        msg = (
+            f"{dst.collection} migrated count {count} not match"
+            f" source count {expected}"
+        )
+        logger.error(msg)
+        raise ValueError(msg)
+
+
+def main() -> None:
+    """migrate collections of command line, all per-file collections if none"""
+
+    parser = argparse.ArgumentParser(
+        description="move documents of per-file collections into shared"
+        " collections"
+    )
+    parser.add_argument(
+        "file_ids",
+        nargs="*",
+        help="file ids to migrate, all per-file collections if empty",
+    )
+    parser.add_argument(
+        "--drop",
+        action="store_true",
+        help="drop per-file collection after migrated",
+    )
+    args = parser.parse_args()
+
+    src = VDB.default_vdb(layout="collection")
+    file_ids = args.file_ids or [
+        name
+        for name in src.list_collections()
+        if not name.startswith(VDB.SHARED_COLLECTION_PREFIX)
+    ]
+
+    for file_id in file_ids:
+        src.collection = file_id
+        dst = VDB.default_vdb(file_id, layout="shared")
+        count = migrate_collection(src, dst)
+        logger.info(f"{file_id} migrated, count: {count}")
+        if args.drop:
+            src.drop_collection()
+
+
+if __name__ == "__main__":
+    main()
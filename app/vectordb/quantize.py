@@ -0,0 +1,287 @@
+"""quantized codes of segment vectors
+
+Codes are written next to a segment and scanned by search instead of
+the float vectors, then the shortlist is re-ranked by the float vectors.
+
+- int8: each vector is scaled by its max absolute component into int8,
+  a quarter of float32
+- pq: product quantization, vector is split into m sub vectors, each
+  is encoded as the index of its nearest of up to 256 centroids,
+  m bytes per vector
+
+Layout of code file, little endian:
+
+- header: magic, format version, quantization code, count, dimension,
+  m, centroids of each sub space, and offsets of code block and
+  aux block
+- code block: count x dimension int8, or count x m uint8, 64 bytes aligned
+- aux block: count float32 scales of int8, or m x centroids x
+  (dimension / m) float32 codebook of pq
+"""
+
+import os
+import struct
+import threading
+import numpy as np
+from app.vectordb.segment import map_file
+
+MAGIC = b"VQNT"
+FORMAT_VERSION = 1
+
+_HEADER = struct.Struct("<4sHHIIIIQQ")
+_ALIGN = 64
+
+QUANTIZATIONS = {"int8": 1, "pq": 2}
+"""supported quantizations and their code in header"""
+
+_QUANTIZATION_NAMES = {code: name for name, code in QUANTIZATIONS.items()}
+
+PQ_CENTROIDS = 256
+"""max centroids of each pq sub space, so that a code is one byte"""
+
+PQ_TRAIN_SIZE = 8192
+"""max vectors sampled to train pq codebook"""
+
+PQ_TRAIN_ITERATIONS = 10
+"""k-means iterations to train pq codebook"""
+
+BLOCK_ROWS = 4096
+"""rows encoded or scored at a time"""
+
+
+def encode_int8(vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """scale each vector by its max absolute component into int8
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: count x dimension int8 codes,
+        and count float32 scales, vector is about codes * scale
+    """
+
+    vectors = np.asarray(vectors, dtype=np.float32)
+    scales = np.abs(vectors).max(axis=1, initial=0.0) / 127
+    scales[scales == 0] = 1.0
+    codes = np.rint(vectors / scales[:, None]).clip(-127, 127)
+    return codes.astype(np.int8), scales.astype(np.float32)
+
+
+def train_pq(vectors: np.ndarray, m: int, seed: int = 0) -> np.ndarray:
+    """train pq codebook by k-means of each sub space
+
+    Args:
+        vectors (np.ndarray): count x dimension vectors
+        m (int): sub space count, dimension must be a multiple of m
+        seed (int, optional): random seed. Defaults to 0.
+
+    Raises:
+        ValueError: if dimension is not a multiple of m
+
+    Returns:
+        np.ndarray: m x centroids x (dimension / m) codebook,
+        centroids is up to PQ_CENTROIDS
+    """
+
+    vectors = np.asarray(vectors, dtype=np.float32)
+    count, dimension = vectors.shape
+    if m <= 0 or dimension % m != 0:
+        raise ValueError(f"dimension {dimension} is not a multiple of m {m}")
+
+    rng = np.random.default_rng(seed)
+    if count > PQ_TRAIN_SIZE:
+        vectors = vectors[rng.choice(count, PQ_TRAIN_SIZE, replace=False)]
+    centroids = max(1, min(PQ_CENTROIDS, len(vectors)))
+    subs = np.ascontiguousarray(
+        vectors.reshape(len(vectors), m, -1).transpose(1, 0, 2)
+    )
+
+    codebook = np.zeros((m, centroids, dimension // m), dtype=np.float32)
+    if len(vectors) > 0:
+        for i, sub in enumerate(subs):
+            codebook[i] = _kmeans(sub, centroids, rng)
+    return codebook
+
+
+def _kmeans(
+    sub: np.ndarray, centroids: int, rng: np.random.Generator
+) -> np.ndarray:
+    """return centroids x sub dimension centers of sub vectors"""
+
+    center = sub[rng.choice(len(sub), centroids, replace=False)]
+    columns = np.ascontiguousarray(sub.T)
+    for _ in range(PQ_TRAIN_ITERATIONS):
+        nearest = _nearest(sub, center)
+        sums = np.stack(
+            [
+                np.bincount(nearest, weights=column, minlength=centroids)
+                for column in columns
+            ],
+            axis=1,
+        )
+        sizes = np.bincount(nearest, minlength=centroids)[:, None]
+        # empty centroid keeps its place
+        center = np.where(sizes > 0, sums / np.maximum(sizes, 1), center)
+    return center
+
+
+def _nearest(sub: np.ndarray, center: np.ndarray) -> np.ndarray:
+    """index of the nearest centroid of each sub vector"""
+
+    distances = sub @ center.T
+    distances *= -2
+    distances += (center * center).sum(axis=1)
+    return distances.argmin(axis=1)
+
+
+def encode_pq(vectors: np.ndarray, codebook: np.ndarray) -> np.ndarray:
+    """encode vectors into count x m uint8 codes of codebook"""
+
+    vectors = np.asarray(vectors, dtype=np.float32)
+    m = len(codebook)
+    codes = np.empty((len(vectors), m), dtype=np.uint8)
+    for start in range(0, len(vectors), BLOCK_ROWS):
+        block = vectors[start : start + BLOCK_ROWS]
+        subs = block.reshape(len(block), m, -1)
+        for i in range(m):
+            codes[start : start + len(block), i] = _nearest(
+                subs[:, i], codebook[i]
+            )
+    return codes
+
+
+def _align(offset: int) -> int:
+    return (offset + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def write_codes(
+    path: str, quantization: str, vectors: np.ndarray, pq_m: int = 0
+) -> None:
+    """quantize vectors and write code file atomically
+
+    Args:
+        path (str): code file path
+        quantization (str): int8 or pq
+        vectors (np.ndarray): count x dimension vectors
+        pq_m (int, optional): sub space count of pq. Defaults to 0.
+
+    Raises:
+        ValueError: if quantization is not supported,
+        or dimension is not a multiple of pq_m
+    """
+
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if quantization == "int8":
+        codes, aux = encode_int8(vectors)
+        pq_m = centroids = 0
+    elif quantization == "pq":
+        aux = train_pq(vectors, pq_m)
+        codes = encode_pq(vectors, aux)
+        centroids = aux.shape[1]
+    else:
+        raise ValueError(f"quantization {quantization} not supported")
+
+    codes_offset = _align(_HEADER.size)
+    aux_offset = _align(codes_offset + codes.nbytes)
+    header = _HEADER.pack(
+        MAGIC,
+        FORMAT_VERSION,
+        QUANTIZATIONS[quantization],
+        *vectors.shape,
+        pq_m,
+        centroids,
+        codes_offset,
+        aux_offset,
+    )
+
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header)
+        f.write(b"\0" * (codes_offset - len(header)))
+        f.write(codes.tobytes())
+        f.write(b"\0" * (aux_offset - codes_offset - codes.nbytes))
+        f.write(aux.astype("<f4").tobytes())
+    os.replace(tmp_path, path)
+
+
+class Codes:
+    """Read-only code file opened with mmap"""
+
+    def __init__(self, path: str) -> None:
+        """open code file
+
+        Raises:
+            ValueError: if the file is not a code file
+        """
+
+        self.path = path
+        self._mmap, fields = map_file(path, _HEADER, MAGIC, FORMAT_VERSION)
+        (
+            quantization_code,
+            self.count,
+            dimension,
+            m,
+            centroids,
+            codes_offset,
+            aux_offset,
+        ) = fields
+
+        self.quantization = _QUANTIZATION_NAMES[quantization_code]
+        if self.quantization == "int8":
+            self.codes = np.frombuffer(
+                self._mmap, np.int8, self.count * dimension, codes_offset
+            ).reshape(self.count, dimension)
+            self.aux = np.frombuffer(self._mmap, "<f4", self.count, aux_offset)
+        else:
+            self.codes = np.frombuffer(
+                self._mmap, np.uint8, self.count * m, codes_offset
+            ).reshape(self.count, m)
+            self.aux = np.frombuffer(
+                self._mmap, "<f4", dimension * centroids, aux_offset
+            ).reshape(m, centroids, dimension // max(m, 1))
+
+    def score(self, queries: np.ndarray) -> np.ndarray:
+        """approximate inner product of queries to every row
+
+        Args:
+            queries (np.ndarray): queries x dimension vectors
+
+        Returns:
+            np.ndarray: queries x rows scores
+        """
+
+        if self.quantization == "int8":
+            return self._score_int8(queries)
+        return self._score_pq(queries)
+
+    def _score_int8(self, queries: np.ndarray) -> np.ndarray:
+        scores = np.empty((len(queries), self.count), dtype=np.float32)
+        for start in range(0, self.count, BLOCK_ROWS):
+            stop = min(start + BLOCK_ROWS, self.count)
+            scores[:, start:stop] = (
+                queries @ self.codes[start:stop].astype(np.float32).T
+            ) * self.aux[start:stop]
+        return scores
+
+    def _score_pq(self, queries: np.ndarray) -> np.ndarray:
+        # lookup table of query sub vectors to every centroid
+        table = np.einsum(
+            "mkd,qmd->qmk",
+            self.aux,
+            queries.reshape(len(queries), len(self.aux), -1),
+        )
+        columns = np.arange(len(self.aux))
+        scores = np.empty((len(queries), self.count), dtype=np.float32)
+        for start in range(0, self.count, BLOCK_ROWS):
+            stop = min(start + BLOCK_ROWS, self.count)
+            scores[:, start:stop] = table[
+                :, columns, self.codes[start:stop]
+            ].sum(axis=2)
+        return scores
+
+    def close(self) -> None:
+        """unmap code file"""
+
+        # views on the mapping must be released before close
+        self.codes = self.aux = np.zeros(0, dtype=np.float32)
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass
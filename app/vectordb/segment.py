@@ -0,0 +1,195 @@
+"""memory-mapped vector segment file
+
+Layout, little endian:
+
+- header: magic, format version, dtype code, count, dimension,
+  and offsets of vector block, id table and content table
+- vector block: count x dimension float32 or float16, 64 bytes aligned
+- id table: count + 1 uint64 offsets, then utf-8 bytes of ids
+- content table: count + 1 uint64 offsets, then utf-8 bytes of contents
+
+Segment is immutable once written, opened with mmap so that pages are
+read on demand.
+"""
+
+import os
+import mmap
+import struct
+import threading
+import numpy as np
+
+MAGIC = b"VSEG"
+FORMAT_VERSION = 1
+
+_HEADER = struct.Struct("<4sHHIIQQQ")
+_ALIGN = 64
+
+DTYPES = {"float32": 0, "float16": 1}
+"""supported vector dtypes and their code in header"""
+
+_DTYPE_NAMES = {code: name for name, code in DTYPES.items()}
+
+
+def _align(offset: int) -> int:
+    return (offset + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def map_file(
+    path: str, header: struct.Struct, magic: bytes, version: int
+) -> tuple[mmap.mmap, tuple]:
+    """mmap file read-only, check magic and format version of its header
+
+    Raises:
+        ValueError: if magic or format version not match
+
+    Returns:
+        tuple[mmap.mmap, tuple]: the mapping, and header fields
+        after magic and format version
+    """
+
+    with open(path, "rb") as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    fields = header.unpack_from(mapping, 0)
+    if fields[:2] != (magic, version):
+        mapping.close()
+        raise ValueError(f"invalid file: {path}")
+    return mapping, fields[2:]
+
+
+def _string_table(values: list[str]) -> bytes:
+    blobs = [v.encode("utf-8") for v in values]
+    offsets = np.zeros(len(blobs) + 1, dtype="<u8")
+    np.cumsum([len(b) for b in blobs], out=offsets[1:])
+    return offsets.tobytes() + b"".join(blobs)
+
+
+def write_segment(
+    path: str,
+    ids: list[str],
+    contents: list[str],
+    vectors: np.ndarray,
+    dtype: str = "float32",
+) -> None:
+    """write segment file atomically
+
+    Args:
+        path (str): segment file path
+        ids (list[str]): document ids
+        contents (list[str]): document contents
+        vectors (np.ndarray): count x dimension vectors
+        dtype (str, optional): dtype of vector block, float32 or float16.
+        Defaults to "float32".
+
+    Raises:
+        ValueError: if dtype is not supported or counts not match
+    """
+
+    if dtype not in DTYPES:
+        raise ValueError(f"dtype {dtype} not supported")
+    if not len(ids) == len(contents) == len(vectors):
+        raise ValueError("ids, contents and vectors count not match")
+
+    block = np.ascontiguousarray(
+        vectors, dtype=np.dtype(dtype).newbyteorder("<")
+    )
+    id_table = _string_table(ids)
+    content_table = _string_table(contents)
+
+    vectors_offset = _align(_HEADER.size)
+    ids_offset = vectors_offset + block.nbytes
+    contents_offset = ids_offset + len(id_table)
+    header = _HEADER.pack(
+        MAGIC,
+        FORMAT_VERSION,
+        DTYPES[dtype],
+        *vectors.shape,
+        vectors_offset,
+        ids_offset,
+        contents_offset,
+    )
+
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header)
+        f.write(b"\0" * (vectors_offset - len(header)))
+        f.write(block.tobytes())
+        f.write(id_table)
+        f.write(content_table)
+    os.replace(tmp_path, path)
+
+
+# pylint: disable-next=too-many-instance-attributes
+class Segment:
+    """Read-only segment opened with mmap
+
+    vectors is a view on the mapped vector block, ids and contents are
+    decoded only for the rows asked.
+    """
+
+    def __init__(self, path: str) -> None:
+        """open segment file
+
+        Raises:
+            ValueError: if the file is not a segment
+        """
+
+        self.path = path
+        self._mmap, fields = map_file(path, _HEADER, MAGIC, FORMAT_VERSION)
+        (
+            dtype_code,
+            self.count,
+            self.dimension,
+            vectors_offset,
+            ids_offset,
+            contents_offset,
+        ) = fields
+
+        self.dtype = _DTYPE_NAMES[dtype_code]
+        self.vectors: np.ndarray = np.frombuffer(
+            self._mmap,
+            dtype=np.dtype(self.dtype).newbyteorder("<"),
+            count=self.count * self.dimension,
+            offset=vectors_offset,
+        ).reshape(self.count, self.dimension)
+        self._ids = self._open_string_table(ids_offset)
+        self._contents = self._open_string_table(contents_offset)
+
+    def _open_string_table(self, offset: int) -> tuple[np.ndarray, int]:
+        offsets = np.frombuffer(
+            self._mmap, dtype="<u8", count=self.count + 1, offset=offset
+        )
+        return offsets, offset + offsets.nbytes
+
+    def _get_string(self, table: tuple[np.ndarray, int], row: int) -> str:
+        offsets, start = table
+        return self._mmap[
+            start + int(offsets[row]) : start + int(offsets[row + 1])
+        ].decode("utf-8")
+
+    def get_id(self, row: int) -> str:
+        """return document id of row"""
+
+        return self._get_string(self._ids, row)
+
+    def get_content(self, row: int) -> str:
+        """return document content of row"""
+
+        return self._get_string(self._contents, row)
+
+    def get_ids(self) -> list[str]:
+        """return document ids of all rows"""
+
+        return [self.get_id(row) for row in range(self.count)]
+
+    def close(self) -> None:
+        """unmap segment file"""
+
+        # views on the mapping must be released before close
+        self.vectors = np.zeros((0, self.dimension), dtype=np.float32)
+        self._ids = self._contents = (np.zeros(1, dtype="<u8"), 0)
+        try:
+            self._mmap.close()
+        except BufferError:
+            # still used by a search result, unmapped when collected
+            pass
@@ -0,0 +1,588 @@
+"""test vector db"""
+
+# pylint: disable=protected-access
+
+import threading
+import multiprocessing
+from collections import OrderedDict
+import numpy as np
+import pytest
+from tcvectordb import exceptions
+from tcvectordb.model.document import Document
+from tcvectordb.model.enum import ReadConsistency
+from .write_buffer import VDBWriteBuffer
+from .handle_cache import HandleCache
+from .vectordb import VDB
+from .migrate import migrate_collection
+from .local import LocalVDB, LocalCollection
+from .segment import Segment, write_segment
+from .quantize import Codes, encode_int8, write_codes
+
+
+def test_write_buffer_flush_by_size(mocker):
+    """test write buffer flush when reach flush size and on close"""
+
+    vdb = mocker.MagicMock()
+    flushed: list[int] = []
+
+    with VDBWriteBuffer(
+        vdb,
+        on_flush=lambda docs: flushed.append(len(docs)),
+        flush_size=3,
+        flush_interval=60,
+    ) as buffer:
+        buffer.add(list(range(7)))
+
+    assert [call.args[0] for call in vdb.upsert_data.call_args_list] == [
+        [0, 1, 2],
+        [3, 4, 5],
+        [6],
+    ]
+    assert flushed == [3, 3, 1]
+
+
+def test_write_buffer_flush_by_interval(mocker):
+    """test write buffer flush when document wait over flush interval"""
+
+    vdb = mocker.MagicMock()
+    flushed = threading.Event()
+
+    buffer = VDBWriteBuffer(
+        vdb,
+        on_flush=lambda docs: flushed.set(),
+        flush_size=100,
+        flush_interval=0.01,
+    )
+    buffer.add([0])
+    assert flushed.wait(timeout=5)
+    vdb.upsert_data.assert_called_once_with([0])
+    buffer.close()
+
+
+def test_write_buffer_raise_flush_error(mocker):
+    """test write buffer raise flush error on close"""
+
+    mocker.patch("app.helper.retry.time.sleep")
+    vdb = mocker.MagicMock()
+    vdb.upsert_data.side_effect = ValueError("upsert failed")
+
+    with pytest.raises(ValueError, match="upsert failed"):
+        with VDBWriteBuffer(vdb, flush_size=1, max_pending=1) as buffer:
+            buffer.add(list(range(5)))
+
+
+def test_write_buffer_raise_on_flush_error(mocker):
+    """test write buffer stop upsert and raise if on_flush failed"""
+
+    vdb = mocker.MagicMock()
+
+    def on_flush(docs: list) -> None:
+        raise ValueError("checkpoint failed")
+
+    with pytest.raises(ValueError, match="checkpoint failed"):
+        with VDBWriteBuffer(
+            vdb, on_flush=on_flush, flush_size=2, max_pending=1
+        ) as buffer:
+            buffer.add(list(range(10)))
+    vdb.upsert_data.assert_called_once_with([0, 1])
+
+
+def test_write_buffer_thread_stopped(mocker):
+    """test add and close not block after the flush thread stopped"""
+
+    mocker.patch.object(
+        VDBWriteBuffer, "_drain", side_effect=ValueError("thread failed")
+    )
+    buffer = VDBWriteBuffer(mocker.MagicMock(), max_pending=1)
+    buffer._thread.join()
+
+    with pytest.raises(ValueError, match="thread failed"):
+        buffer.add([0, 1])
+    with pytest.raises(ValueError, match="thread failed"):
+        buffer.close()
+
+
+def _mock_client(mocker):
+    mocker.patch.object(VDB, "_clients", {})
+    mocker.patch.object(VDB, "_handles", HandleCache(ttl=60, missing_ttl=60))
+    client_class = mocker.patch("tcvectordb.VectorDBClient")
+    return client_class
+
+
+def _vdb(collection: str = "", layout: str = "collection") -> VDB:
+    return VDB(
+        url="http://test",
+        username="root",
+        key="key",
+        database=VDB.DATABASE_RAG,
+        collection=collection,
+        layout=layout,
+    )
+
+
+def test_vdb_shared_client_and_cached_handles(mocker):
+    """test client is shared, extract makes one network call when warm"""
+
+    client_class = _mock_client(mocker)
+    client = client_class.return_value
+    db = client.database.return_value
+    coll = db.collection.return_value
+    coll.search.return_value = [[{"id": "a-1", "content": "c"}]]
+
+    for _ in range(3):
+        # same as Extract.generate_answer
+        vdb = _vdb()
+        assert vdb.is_collection_existed("a-file-id") is coll
+        vdb.collection = "a-file-id"
+        assert vdb.search([1.0]) == [{"id": "a-1", "content": "c"}]
+
+    client_class.assert_called_once()
+    client.database.assert_called_once_with(VDB.DATABASE_RAG)
+    db.collection.assert_called_once_with("a-file-id")
+    assert coll.search.call_count == 3
+
+    # handle is invalidated after request failed
+    coll.search.side_effect = exceptions.ServerInternalError(message="fail")
+    with pytest.raises(exceptions.ServerInternalError):
+        vdb.search([1.0])
+    vdb.is_collection_existed()
+    assert db.collection.call_count == 2
+
+
+def test_vdb_read_consistency(mocker):
+    """test instances of each read consistency have their own client"""
+
+    client_class = _mock_client(mocker)
+
+    _vdb()
+    VDB(
+        url="http://test",
+        username="root",
+        key="key",
+        database=VDB.DATABASE_RAG,
+        collection="",
+        layout="collection",
+        consistency=VDB.CONSISTENCY_EVENTUAL,
+    )
+    assert [
+        call.kwargs["read_consistency"] for call in client_class.call_args_list
+    ] == [
+        ReadConsistency.STRONG_CONSISTENCY,
+        ReadConsistency.EVENTUAL_CONSISTENCY,
+    ]
+
+    with pytest.raises(exceptions.ParamError):
+        VDB(
+            url="http://test",
+            username="root",
+            key="key",
+            database=VDB.DATABASE_RAG,
+            collection="",
+            consistency="session",
+        )
+
+
+def test_vdb_cached_missing_collection(mocker):
+    """test missing collection is cached, and checked again before create"""
+
+    client = _mock_client(mocker).return_value
+    db = client.database.return_value
+    db.collection.side_effect = exceptions.ServerInternalError(
+        message=f"{VDB.MSG_COLLECTION_NOT_EXIST}: a-file-id"
+    )
+
+    vdb = _vdb()
+    assert vdb.is_collection_existed("a-file-id") is None
+    assert vdb.is_collection_existed("a-file-id") is None
+    assert db.collection.call_count == 1
+
+    vdb.collection = "a-file-id"
+    with pytest.raises(exceptions.ServerInternalError):
+        vdb.search([1.0])
+
+    # created by another process
+    db.collection.side_effect = None
+    vdb._get_or_create_collection(dimension=VDB.DEFAULT_EMBEDDING_DIMENSION)
+    db.create_collection.assert_not_called()
+    assert vdb.is_collection_existed() is db.collection.return_value
+
+
+def test_vdb_search_batch(mocker):
+    """test search batch split into SEARCH_BATCH_SIZE vectors a call"""
+
+    client = _mock_client(mocker).return_value
+    coll = client.database.return_value.collection.return_value
+    coll.search.side_effect = lambda vectors, **kwargs: [
+        [{"id": str(vector[0])}] for vector in vectors
+    ]
+
+    vdb = _vdb("a-file-id")
+    vectors = [[float(i)] for i in range(45)]
+    doc_lists = vdb.search_batch(vectors, top_k=3)
+    assert [doc_list[0]["id"] for doc_list in doc_lists] == [
+        str(vector[0]) for vector in vectors
+    ]
+    assert [len(c.kwargs["vectors"]) for c in coll.search.call_args_list] == [
+        20,
+        20,
+        5,
+    ]
+    assert coll.search.call_args.kwargs["limit"] == 3
+    assert vars(coll.search.call_args.kwargs["params"]) == {
+        "ef": VDB.VDB_SEARCH_EF
+    }
+    assert vdb.search([1.0]) == [{"id": "1.0"}]
+    vdb.search([1.0], top_k=30, ef=16)
+    assert vars(coll.search.call_args.kwargs["params"]) == {"ef": 30}
+    vdb.search([1.0], top_k=3, ef=16)
+    assert vars(coll.search.call_args.kwargs["params"]) == {"ef": 16}
+
+    # nothing found
+    coll.search.side_effect = None
+    coll.search.return_value = []
+    assert vdb.search_batch([[1.0], [2.0]]) == [[], []]
+
+
+def test_vdb_shared_layout(mocker):
+    """test documents of files in shared collections filtered by file_id"""
+
+    mocker.patch.object(VDB, "VDB_SHARED_COLLECTIONS", 4)
+    mocker.patch.object(VDB, "VDB_SHARED_SHARDS", 2)
+    client = _mock_client(mocker).return_value
+    db = client.database.return_value
+    db.collection.side_effect = exceptions.ServerInternalError(
+        message=VDB.MSG_COLLECTION_NOT_EXIST
+    )
+
+    vdb = _vdb("a-file-id", layout="shared")
+    name = VDB.get_shared_collection("a-file-id")
+    assert name.startswith(VDB.SHARED_COLLECTION_PREFIX)
+    assert name == VDB.get_shared_collection("a-file-id")
+    assert len({VDB.get_shared_collection(f"file-{i}") for i in range(40)}) == 4
+
+    vdb._get_or_create_collection(dimension=3)
+    kwargs = db.create_collection.call_args.kwargs
+    assert kwargs["name"] == name and kwargs["shard"] == 2
+    assert {
+        "fieldName": "file_id",
+        "fieldType": "string",
+        "indexType": "filter",
+    } in kwargs["index"].list()
+    coll = db.create_collection.return_value
+
+    doc = vdb.new_document("a-file-id-0", [1.0], "c")
+    assert vars(doc)["file_id"] == "a-file-id"
+
+    coll.search.return_value = [[{"id": "a-file-id-0"}]]
+    assert vdb.search([1.0]) == [{"id": "a-file-id-0"}]
+    assert coll.search.call_args.kwargs["filter"] == 'file_id in ("a-file-id")'
+
+    # file without documents does not exist
+    coll.count.return_value = 0
+    assert vdb.is_collection_existed("b-file-id") is None
+    coll.count.return_value = 3
+    assert vdb.is_collection_existed() is coll
+    assert vdb.count() == 3
+
+    vdb.drop_collection()
+    coll.delete.assert_called_once_with(filter='file_id in ("a-file-id")')
+    db.drop_collection.assert_not_called()
+
+    with pytest.raises(ValueError):
+        VDB.get_file_filter('a") or ("1')
+
+
+def test_migrate_collection(mocker):
+    """test documents of per-file collection copied by page"""
+
+    mocker.patch("app.helper.retry.time.sleep")
+    src = mocker.MagicMock()
+    docs = [{"id": f"a-file-id-{i}", "vector": [float(i)]} for i in range(5)]
+    src.query_data.side_effect = lambda offset, limit: docs[
+        offset : offset + limit
+    ]
+    dst = _vdb("a-file-id", layout="shared")
+    upsert_data = mocker.patch.object(dst, "upsert_data")
+    mocker.patch.object(dst, "count", side_effect=[4, 5])
+
+    assert migrate_collection(src, dst, page_size=2) == 5
+    written = [
+        vars(doc) for c in upsert_data.call_args_list for doc in c.args[0]
+    ]
+    assert [doc["id"] for doc in written] == [doc["id"] for doc in docs]
+    assert written[0]["file_id"] == "a-file-id"
+    assert written[0]["content"] == ""
+
+    # count not match
+    mocker.patch.object(dst, "count", return_value=4)
+    with pytest.raises(ValueError):
+        migrate_collection(src, dst, page_size=2)
+
+
+def test_local_vdb(mocker, tmp_path):
+    """test local vdb search top k, persisted and reloaded"""
+
+    mocker.patch.object(LocalVDB, "_collections", OrderedDict())
+    vdb = LocalVDB("rag", "a-file-id", root=str(tmp_path))
+    assert vdb.is_collection_existed() is None
+    vdb._get_or_create_collection(dimension=3)
+
+    vectors = {
+        "a-file-id-0": [1.0, 0.0, 0.0],
+        "a-file-id-1": [0.0, 1.0, 0.0],
+        "a-file-id-2": [1.0, 1.0, 0.0],
+        "a-file-id-3": [0.0, 0.0, -2.0],
+    }
+    vdb.upsert_data(
+        [vdb.new_document(k, v, f"content {k}") for k, v in vectors.items()]
+    )
+    result = vdb.search([2.0, 0.2, 0.0], top_k=2, retrieve_vector=True)
+    assert [doc["id"] for doc in result] == ["a-file-id-0", "a-file-id-2"]
+    assert result[0]["content"] == "content a-file-id-0"
+    assert result[0]["score"] == pytest.approx(2.0 / np.sqrt(4.04))
+    assert result[0]["vector"] == [1.0, 0.0, 0.0]
+
+    # overwrite and delete
+    vdb.upsert_data([vdb.new_document("a-file-id-0", [0.0, 0.0, 1.0], "c0")])
+    vdb.delete_data(["a-file-id-2"])
+    assert [doc["id"] for doc in vdb.search([2.0, 0.2, 0.1], top_k=10)] == [
+        "a-file-id-1",
+        "a-file-id-0",
+        "a-file-id-3",
+    ]
+    assert vdb.get_vectors(["a-file-id-0", "a-file-id-2"]) == {
+        "a-file-id-0": [0.0, 0.0, 1.0]
+    }
+
+    # loaded by another process
+    mocker.patch.object(LocalVDB, "_collections", OrderedDict())
+    other = LocalVDB("rag", "", root=str(tmp_path))
+    coll = other.is_collection_existed("a-file-id")
+    assert coll.size == 3
+    other.collection = "a-file-id"
+    assert other.search([0.0, 0.0, 1.0], top_k=1)[0]["content"] == "c0"
+
+    # written by another process, reloaded on search
+    writer = LocalCollection(coll.path, dimension=3)
+    writer.upsert([vdb.new_document("a-file-id-4", [0.0, 0.0, 1.0], "c4")])
+    assert coll.size == 3
+    assert len(other.search([0.0, 0.0, 1.0])) == 4
+    assert coll.size == 4
+
+    queries = [[2.0, 0.2, 0.1], [0.0, 0.0, 1.0], [0.0, 1.0, 0.0]]
+    assert other.search_batch(queries, top_k=2) == [
+        other.search(query, top_k=2) for query in queries
+    ]
+    assert not other.search_batch([])
+
+    with pytest.raises(ValueError):
+        vdb.upsert_data([vdb.new_document("a-file-id-5", [1.0], "c5")])
+
+
+def test_segment(tmp_path):
+    """test segment written and read back by mmap"""
+
+    path = str(tmp_path / "seg.vseg")
+    vectors = np.array([[1.0, 0.5], [0.25, -1.0], [0.0, 0.0]])
+    write_segment(
+        path, ["a", "b", "日本"], ["x", "", "文書"], vectors, "float16"
+    )
+
+    segment = Segment(path)
+    assert (segment.count, segment.dimension) == (3, 2)
+    assert segment.vectors.dtype == np.float16
+    assert segment.vectors.tolist() == vectors.tolist()
+    assert segment.get_ids() == ["a", "b", "日本"]
+    assert segment.get_content(2) == "文書"
+    segment.close()
+
+    write_segment(path, [], [], np.zeros((0, 2)))
+    assert Segment(path).count == 0
+
+    with pytest.raises(ValueError):
+        write_segment(path, ["a"], [], vectors[:1])
+    (tmp_path / "broken.vseg").write_bytes(b"\0" * 64)
+    with pytest.raises(ValueError):
+        Segment(str(tmp_path / "broken.vseg"))
+
+
+def test_local_collection_segments(mocker, tmp_path):
+    """test segments merged, float16 vectors and closed collections"""
+
+    mocker.patch("app.vectordb.local.VDB_LOCAL_MAX_SEGMENTS", 3)
+    mocker.patch("app.vectordb.local.VDB_LOCAL_MAX_OPEN", 1)
+    mocker.patch("app.vectordb.local.VDB_LOCAL_SEARCH_BLOCK", 2)
+    mocker.patch.object(LocalVDB, "_collections", OrderedDict())
+    vdb = LocalVDB("rag", "a-file-id", root=str(tmp_path))
+    coll = vdb._get_or_create_collection(dimension=2)
+    coll.dtype = "float16"
+
+    for i in range(3):
+        vdb.upsert_data(
+            [
+                vdb.new_document(f"doc-{j}", [float(i), float(j)], f"c{i}{j}")
+                for j in range(3)
+            ]
+        )
+    assert len(coll._manifest["segments"]) == 3
+    assert coll.size == 3
+    vdb.delete_data(["doc-0"])
+
+    # one more segment is merged into one
+    vdb.upsert_data([vdb.new_document("doc-3", [0.0, 1.0], "c3")])
+    assert len(coll._manifest["segments"]) == 1
+    assert len(list((tmp_path / "rag" / "a-file-id").glob("*.vseg"))) == 1
+    result = vdb.search([0.0, 1.0], top_k=10, retrieve_vector=True)
+    assert [doc["id"] for doc in result] == ["doc-3", "doc-2", "doc-1"]
+    assert [doc["content"] for doc in result] == ["c3", "c22", "c21"]
+    assert result[1]["vector"] == pytest.approx([0.707, 0.707], abs=1e-3)
+
+    # the least recently used collection is closed, and reopened on use
+    other = LocalVDB("rag", "b-file-id", root=str(tmp_path))
+    other._get_or_create_collection(dimension=2)
+    assert list(LocalVDB._collections) == [other._get_path("b-file-id")]
+    assert len(coll._segments) == 0
+    assert [doc["id"] for doc in coll.search([0.0, 1.0], 1, False)] == ["doc-3"]
+
+
+def _upsert_local(path: str, prefix: str, count: int) -> None:
+    coll = LocalCollection(path, dimension=2)
+    for i in range(count):
+        coll.upsert(
+            [Document(id=f"{prefix}-{i}", vector=[1.0, float(i)], content="")]
+        )
+
+
+def test_local_collection_processes(mocker, tmp_path):
+    """test upserts and merges of two processes are all kept"""
+
+    mocker.patch("app.vectordb.local.VDB_LOCAL_MAX_SEGMENTS", 2)
+    path = str(tmp_path / "a-file-id")
+    (tmp_path / "a-file-id").mkdir()
+    LocalCollection(path, dimension=2).create()
+
+    ctx = multiprocessing.get_context("fork")
+    processes = [
+        ctx.Process(target=_upsert_local, args=(path, prefix, 20))
+        for prefix in ("a", "b")
+    ]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+        assert p.exitcode == 0
+
+    coll = LocalCollection(path, dimension=2)
+    coll.load()
+    assert coll.size == 40
+    ids = [f"{prefix}-{i}" for prefix in "ab" for i in range(20)]
+    assert len(coll.get_vectors(ids)) == 40
+    assert len(list((tmp_path / "a-file-id").glob("*.vseg"))) == len(
+        coll._manifest["segments"]
+    )
+
+
+def test_default_vdb_local(mocker, tmp_path):
+    """test local backend selected by VDB_BACKEND"""
+
+    mocker.patch.object(VDB, "VDB_BACKEND", "local")
+    mocker.patch.object(LocalVDB, "_collections", OrderedDict())
+    mocker.patch("app.vectordb.local.VDB_LOCAL_DIR", str(tmp_path))
+    mocker.patch.object(LocalVDB.__init__, "__defaults__", (str(tmp_path),))
+
+    vdb = VDB.default_vdb("a-file-id")
+    assert isinstance(vdb, LocalVDB)
+    assert (
+        tmp_path / VDB.DATABASE_RAG / "a-file-id" / "manifest.json"
+    ).exists()
+    assert VDB.default_vdb().is_collection_existed("a-file-id") is not None
+
+
+def test_quantize(tmp_path):
+    """test int8 and pq codes scored close to exact inner product"""
+
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((300, 8)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    query = vectors[0]
+    exact = vectors @ query
+
+    codes, scales = encode_int8(np.vstack([vectors, np.zeros(8)]))
+    assert codes.dtype == np.int8 and scales[-1] == 1.0
+    assert codes[:-1] * scales[:-1, None] == pytest.approx(vectors, abs=0.01)
+
+    for quantization, tolerance in (("int8", 0.02), ("pq", 0.3)):
+        path = str(tmp_path / quantization)
+        write_codes(path, quantization, vectors, pq_m=4)
+        codes = Codes(path)
+        assert codes.count == 300
+        scores = codes.score(np.stack([query, vectors[1]]))
+        assert scores.shape == (2, 300)
+        assert scores[0] == pytest.approx(exact, abs=tolerance)
+        codes.close()
+
+    assert Codes(str(tmp_path / "pq")).codes.shape == (300, 4)
+    with pytest.raises(ValueError):
+        write_codes(str(tmp_path / "bad"), "pq", vectors, pq_m=3)
+    with pytest.raises(ValueError):
+        write_codes(str(tmp_path / "bad"), "int4", vectors)
+
+
+def test_local_collection_quantization(mocker, tmp_path):
+    """test quantized search re-ranked to exact top k"""
+
+    mocker.patch("app.vectordb.local.VDB_LOCAL_PQ_M", 4)
+    mocker.patch("app.vectordb.local.VDB_LOCAL_RERANK_FACTOR", 3)
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((200, 8))
+    documents = [
+        Document(id=f"doc-{i}", vector=vector.tolist(), content=f"c{i}")
+        for i, vector in enumerate(vectors)
+    ]
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    exact = np.argsort(-(vectors @ vectors[7]))
+
+    for quantization in ("int8", "pq"):
+        path = tmp_path / quantization
+        path.mkdir()
+        coll = LocalCollection(str(path), 8, quantization=quantization)
+        coll.save()
+        coll.upsert(documents[:100])
+        coll.upsert(documents[100:])
+        assert len(list(path.glob(f"*.vseg.{quantization}"))) == 2
+
+        result = coll.search(vectors[7].tolist(), 5, False)
+        assert [doc["id"] for doc in result] == [f"doc-{i}" for i in exact[:5]]
+        assert (
+            coll.search_batch([vectors[7], vectors[9]], 5, False)[0] == result
+        )
+        assert result[0]["score"] == pytest.approx(1.0)
+
+        # shortlist of ef rows
+        assert coll.search_batch([vectors[7]], 5, False, ef=200)[0] == result
+        rerank = mocker.spy(coll, "_rerank")
+        coll.search(vectors[7].tolist(), 5, False, ef=60)
+        assert [c.args[3] for c in rerank.call_args_list] == [60, 60]
+        coll.search(vectors[7].tolist(), 5, False)
+        assert rerank.call_args.args[3] == 15
+
+        coll.delete([f"doc-{i}" for i in exact[:3]])
+        result = coll.search(vectors[7].tolist(), 2, False)
+        assert [doc["id"] for doc in result] == [f"doc-{i}" for i in exact[3:5]]
+
+    # pq codebook is trained on merged segments of enough rows only
+    assert [
+        Codes(str(path)).quantization
+        for path in sorted((tmp_path / "pq").glob("*.vseg.pq"))
+    ] == ["int8", "int8"]
+    mocker.patch("app.vectordb.local.VDB_LOCAL_PQ_MIN_ROWS", 100)
+    coll.compact()
+    (codes_path,) = (tmp_path / "pq").glob("*.vseg.pq")
+    assert Codes(str(codes_path)).quantization == "pq"
+    result = coll.search(vectors[7].tolist(), 2, False)
+    assert [doc["id"] for doc in result] == [f"doc-{i}" for i in exact[3:5]]
+
+    # codes are written on search when quantization is enabled later
+    reader = LocalCollection(str(tmp_path / "pq"), 8, quantization="int8")
+    assert len(reader.search(vectors[7].tolist(), 2, False)) == 2
+    assert len(list((tmp_path / "pq").glob("*.vseg.int8"))) == 1
@@ -1,10 +1,12 @@
 """vector db operations"""
 
 import os
+import zlib
+import threading
 from loguru import logger
 import tcvectordb
 from tcvectordb import exceptions
-from tcvectordb.model.document import Document, SearchParams
+from tcvectordb.model.document import Document, Filter, SearchParams
 from tcvectordb.model.enum import (
     FieldType,
     IndexType,
@@ -19,6 +21,8 @@ from tcvectordb.model.index import (
 )
 from tcvectordb.model.database import Database
 from tcvectordb.model.collection import Collection
+from app.vectordb.handle_cache import HandleCache
+from app.vectordb.local import LocalVDB
 
 # disable/enable http request log print
 tcvectordb.debug.DebugEnable = False
@@ -34,18 +38,101 @@ class VDB:
     MSG_DATABASE_NOT_EXIST = "Database not exist:"
     MSG_COLLECTION_NOT_EXIST = "Collection not exist"
 
+    SEARCH_BATCH_SIZE = 20
+    """max vectors of a search call"""
+
+    VDB_HNSW_M = int(os.getenv("VDB_HNSW_M", "16"))
+    """
+    max neighbors of a node in HNSW graph of new collections, larger is
+    better recall at the cost of memory and build time
+    """
+
+    VDB_HNSW_EF_CONSTRUCTION = int(os.getenv("VDB_HNSW_EF_CONSTRUCTION", "200"))
+    """candidates examined to link a node in HNSW graph of new collections"""
+
+    VDB_SEARCH_EF = int(os.getenv("VDB_SEARCH_EF", "200"))
+    """
+    candidates examined by HNSW search, larger is better recall at the cost
+    of latency, at least top_k
+    """
+
+    VDB_BACKEND = os.getenv("VDB_BACKEND", "tencent")
+    """
+    vector db backend, tencent for Tencent Vector Database,
+    local for in-process vector index saved in VDB_LOCAL_DIR
+    """
+
+    VDB_POOL_SIZE = int(os.getenv("VDB_POOL_SIZE", "10"))
+    """keep-alive http connections of the shared client"""
+
+    VDB_LAYOUT = os.getenv("VDB_LAYOUT", "collection")
+    """
+    collection for a collection per file,
+    shared for documents of all files in VDB_SHARED_COLLECTIONS collections
+    with file_id filter index, collection of VDB instance is the file_id
+    either way
+    """
+
+    VDB_SHARED_COLLECTIONS = int(os.getenv("VDB_SHARED_COLLECTIONS", "1"))
+    """shared collections files are hashed into, not to change once written"""
+
+    VDB_SHARED_SHARDS = int(os.getenv("VDB_SHARED_SHARDS", "1"))
+    """shards of each shared collection, only 1 for free test instance"""
+
+    SHARED_COLLECTION_PREFIX = "shared-chunks-"
+
+    CONSISTENCY_STRONG = "strong"
+    """reads see all writes acknowledged before, e.g. right after ingestion"""
+
+    CONSISTENCY_EVENTUAL = "eventual"
+    """reads may miss latest writes of replicas, cheaper and faster"""
+
+    READ_CONSISTENCIES = {
+        CONSISTENCY_STRONG: ReadConsistency.STRONG_CONSISTENCY,
+        CONSISTENCY_EVENTUAL: ReadConsistency.EVENTUAL_CONSISTENCY,
+    }
+    """read consistency of search, query and count by name"""
+
+    _clients: dict[tuple, tcvectordb.VectorDBClient] = {}
+    """clients shared by VDB instances of the same process"""
+
+    _clients_lock = threading.Lock()
+
+    _handles: HandleCache = HandleCache()
+    """database and collection handles shared by VDB instances"""
+
     @classmethod
-    def default_vdb(cls, collection: str = ""):
+    def default_vdb(
+        cls,
+        collection: str = "",
+        layout: str = "",
+        consistency: str = CONSISTENCY_STRONG,
+    ):
         """create a default vector database instance
 
         - if collection is not empty, create collection if not existed
         - if collection is empty, you need to set collection before call
             instance functions
+        - layout is VDB_LAYOUT if empty, not used by local backend
+        - consistency is read consistency of the instance, strong or
+            eventual, not used by local backend which is always strong
 
         Returns:
-            VDB: a default vector database instance
+            VDB | LocalVDB: a default vector database instance,
+            LocalVDB if VDB_BACKEND is local
         """
 
+        if VDB.VDB_BACKEND == "local":
+            local_vdb = LocalVDB(
+                database=VDB.DATABASE_RAG, collection=collection
+            )
+            if len(collection) > 0:
+                # pylint: disable-next=protected-access
+                local_vdb._get_or_create_collection(
+                    dimension=VDB.DEFAULT_EMBEDDING_DIMENSION
+                )
+            return local_vdb
+
         try:
             vdb = VDB(
                 url=os.getenv("TENCENT_VECTOR_URL"),
@@ -53,6 +140,8 @@ class VDB:
                 username=os.getenv("TENCENT_VECTOR_USER"),
                 database=VDB.DATABASE_RAG,
                 collection=collection,
+                layout=layout,
+                consistency=consistency,
             )
         except exceptions.VectorDBException as e:
             logger.error(f"create vdb client failed, e:{e}")
@@ -73,6 +162,8 @@ class VDB:
         database: str,
         collection: str,
         timeout: int = 30,
+        layout: str = "",
+        consistency: str = CONSISTENCY_STRONG,
     ):
         """init client
 
@@ -81,6 +172,10 @@ class VDB:
             username (str): user name
             key (str): db key
             timeout (int, optional): timeout, seconds. Defaults to 30.
+            layout (str, optional): collection or shared,
+            VDB_LAYOUT if empty. Defaults to "".
+            consistency (str, optional): read consistency, strong or
+            eventual. Defaults to CONSISTENCY_STRONG.
         """
 
         if not url or not username or not key:
@@ -88,16 +183,88 @@ class VDB:
             logger.error(msg)
             raise exceptions.ParamError(message=msg)
 
-        self._client = tcvectordb.VectorDBClient(
-            url=url,
-            username=username,
-            key=key,
-            read_consistency=ReadConsistency.STRONG_CONSISTENCY,
-            timeout=timeout,
-        )
+        if consistency not in VDB.READ_CONSISTENCIES:
+            msg = f"read consistency {consistency} not supported"
+            logger.error(msg)
+            raise exceptions.ParamError(message=msg)
+
+        self._client = VDB._get_client(url, username, key, timeout, consistency)
+        # handles of different instances are distinguished by url and user,
+        # handles keep read consistency of the client
+        self._handle_prefix = (url, username, database, consistency)
 
         self._database = database
         self.collection = collection
+        self._layout = layout or VDB.VDB_LAYOUT
+
+    def _is_shared(self) -> bool:
+        return self._layout == "shared"
+
+    @classmethod
+    def get_shared_collection(cls, file_id: str) -> str:
+        """return name of the shared collection which file_id is hashed into"""
+
+        index = zlib.crc32(file_id.encode("utf-8")) % cls.VDB_SHARED_COLLECTIONS
+        return f"{cls.SHARED_COLLECTION_PREFIX}{index}"
+
+    @classmethod
+    def get_file_filter(cls, file_id: str) -> str:
+        """return filter expression of documents of file_id
+
+        Raises:
+            ValueError: if file_id can not be quoted in expression
+        """
+
+        if '"' in file_id or "\\" in file_id:
+            raise ValueError(f"invalid file_id: {file_id}")
+        return Filter.In("file_id", [file_id])
+
+    def _get_file_filter(self) -> str | None:
+        """return filter expression of documents of collection,
+        None if not shared layout"""
+
+        if self._is_shared():
+            return VDB.get_file_filter(self.collection)
+        return None
+
+    def _get_collection_name(self, collection: str = "") -> str:
+        """return name of the collection keeping documents of collection"""
+
+        if len(collection) == 0:
+            collection = self.collection
+        if self._is_shared():
+            return VDB.get_shared_collection(collection)
+        return collection
+
+    @classmethod
+    # pylint: disable-next=too-many-arguments,too-many-positional-arguments
+    def _get_client(
+        cls,
+        url: str,
+        username: str,
+        key: str,
+        timeout: int,
+        consistency: str = CONSISTENCY_STRONG,
+    ) -> tcvectordb.VectorDBClient:
+        """return the client shared in current process, its http session
+        keep connections alive across requests, a client a read consistency
+        """
+
+        client_key = (os.getpid(), url, username, key, timeout, consistency)
+        with cls._clients_lock:
+            client = cls._clients.get(client_key)
+            if client is None:
+                client = tcvectordb.VectorDBClient(
+                    url=url,
+                    username=username,
+                    key=key,
+                    read_consistency=VDB.READ_CONSISTENCIES[consistency],
+                    timeout=timeout,
+                    pool_size=VDB.VDB_POOL_SIZE,
+                )
+                cls._clients[client_key] = client
+                logger.info(f"create vdb client, url: {url}")
+            return client
 
     def drop_db(self):
         """Drop database"""
@@ -111,6 +278,8 @@ class VDB:
                 logger.info(f"{self._database} Database not exist")
             else:
                 raise
+        finally:
+            VDB._handles.clear()
 
     # def delete_and_drop(self):
     #     db = self._client.database(self._database)
@@ -122,53 +291,129 @@ class VDB:
     #     db.drop_database(self._database)
 
     def is_db_existed(self) -> Database | None:
-        """check whether database existed or not"""
+        """check whether database existed or not,
+        result is cached, see HandleCache"""
+
+        key = self._handle_prefix
+        found, db = VDB._handles.get(key)
+        if found:
+            return db
 
         try:
             db = self._client.database(self._database)
-            return db
         except exceptions.ParamError as e:
             if e.message.startswith(VDB.MSG_DATABASE_NOT_EXIST):
                 logger.info(f"{self._database} Database not exist, e: {e}")
+                db = None
             else:
                 raise
 
-        return None
+        VDB._handles.put(key, db)
+        return db
 
     def is_collection_existed(self, collection: str = "") -> Collection | None:
-        """check whether collection existed or not"""
+        """check whether collection existed or not,
+        for shared layout, whether the shared collection has documents
+        of collection, result is cached, see HandleCache"""
 
         if len(collection) == 0:
             collection = self.collection
 
+        coll = self._get_collection_handle(
+            self._get_collection_name(collection)
+        )
+        if coll is None or not self._is_shared():
+            return coll
+
+        key = self._handle_prefix + ("file", collection)
+        found, file_coll = VDB._handles.get(key)
+        if found:
+            return file_coll
+
         try:
-            db = self._client.database(self._database)
-            coll = db.collection(collection)
+            count = coll.count(filter=VDB.get_file_filter(collection))
+        except exceptions.VectorDBException:
+            self._invalidate_collection()
+            raise
+
+        file_coll = coll if count > 0 else None
+        VDB._handles.put(key, file_coll)
+        return file_coll
+
+    def _get_collection_handle(self, collection: str) -> Collection | None:
+        """return cached handle of collection, None if not existed"""
+
+        key = self._handle_prefix + (collection,)
+        found, coll = VDB._handles.get(key)
+        if found:
             return coll
-        except exceptions.ServerInternalError as e:
-            if e.message.startswith(VDB.MSG_COLLECTION_NOT_EXIST):
-                logger.info(f"{collection} Collection not exist, e: {e}")
-            else:
-                raise
 
-        return None
+        db = self.is_db_existed()
+        if db is None:
+            coll = None
+        else:
+            try:
+                coll = db.collection(collection)
+            except exceptions.ServerInternalError as e:
+                if e.message.startswith(VDB.MSG_COLLECTION_NOT_EXIST):
+                    logger.info(f"{collection} Collection not exist, e: {e}")
+                    coll = None
+                else:
+                    raise
+
+        VDB._handles.put(key, coll)
+        return coll
+
+    def _get_collection(self) -> Collection:
+        """return handle of collection
+
+        Raises:
+            exceptions.ServerInternalError: if collection not existed
+        """
+
+        name = self._get_collection_name()
+        coll = self._get_collection_handle(name)
+        if coll is None:
+            raise exceptions.ServerInternalError(
+                message=f"{VDB.MSG_COLLECTION_NOT_EXIST}: {name}"
+            )
+        return coll
+
+    def _invalidate_collection(self) -> None:
+        """remove cached handle of collection, after request failed
+        in case the collection has been dropped"""
+
+        VDB._handles.invalidate(
+            self._handle_prefix + (self._get_collection_name(),)
+        )
+        VDB._handles.invalidate(self._handle_prefix + ("file", self.collection))
 
     def _get_or_create_db(self) -> Database:
         db = self.is_db_existed()
+        if db is None:
+            # missing may be cached, check again before create
+            VDB._handles.invalidate(self._handle_prefix)
+            db = self.is_db_existed()
         if db is not None:
             logger.info(f"{self._database} Database existed, {db}")
             return db
 
         logger.info(f"{self._database} Database not existed, create")
         db = self._client.create_database(self._database)
+        VDB._handles.put(self._handle_prefix, db)
         logger.info(f"{self._database} Database create success")
         return db
 
     def _get_or_create_collection(self, dimension: int):
         db = self._get_or_create_db()
-        coll = self.is_collection_existed()
+        name = self._get_collection_name()
+        coll = self._get_collection_handle(name)
+        if coll is None:
+            # missing may be cached, check again before create
+            self._invalidate_collection()
+            coll = self._get_collection_handle(name)
         if coll is not None:
-            logger.info(f"{self.collection} Collection existed, {coll}")
+            logger.info(f"{name} Collection existed, {coll}")
             return coll
 
         index = Index()
@@ -178,22 +423,33 @@ class VDB:
                 dimension,
                 IndexType.HNSW,
                 MetricType.COSINE,
-                HNSWParams(m=16, efconstruction=200),
+                HNSWParams(
+                    m=VDB.VDB_HNSW_M,
+                    efconstruction=VDB.VDB_HNSW_EF_CONSTRUCTION,
+                ),
             )
         )
         index.add(FilterIndex("id", FieldType.String, IndexType.PRIMARY_KEY))
+        shard = 1
+        if self._is_shared():
+            # documents of a file are searched by file_id filter
+            index.add(
+                FilterIndex("file_id", FieldType.String, IndexType.FILTER)
+            )
+            shard = VDB.VDB_SHARED_SHARDS
 
         # 第二步：创建 Collection
         # 免费测试版实例，其分片 shard 只能为 1，副本 replicas 仅能为 0。
         coll = db.create_collection(
-            name=self.collection,
-            shard=1,
+            name=name,
+            shard=shard,
             replicas=0,
             description="",
             index=index,
         )
 
-        logger.info(f"{self.collection} Create collection success, {coll}")
+        VDB._handles.put(self._handle_prefix + (name,), coll)
+        logger.info(f"{name} Create collection success, {coll}")
         return coll
 
     def new_document(
@@ -201,54 +457,220 @@ class VDB:
     ) -> Document:
         """return a new document instance"""
 
+        if self._is_shared():
+            return Document(
+                id=doc_id,
+                vector=vector,
+                content=content,
+                file_id=self.collection,
+            )
         return Document(id=doc_id, vector=vector, content=content)
 
+    @classmethod
+    def get_document_id(cls, doc: Document) -> str:
+        """return id of document"""
+
+        # Document keep fields in __dict__, no attribute for id
+        return vars(doc)["id"]
+
     def upsert_data(self, document_list: list[Document]) -> None:
         """update or insert document list data into collection"""
 
         # 获取 Collection 对象
-        db = self._client.database(self._database)
-        coll = db.collection(self.collection)
+        coll = self._get_collection()
 
         # upsert 写入数据，可能会有一定延迟
         # 1. 支持动态 Schema，除了 id、vector 字段必须写入，可以写入其他任意字段；
         # 2. upsert 会执行覆盖写，若文档id已存在，则新数据会直接覆盖原有数据(删除原有数据，再插入新数据)
 
-        result = coll.upsert(documents=document_list)
+        try:
+            result = coll.upsert(documents=document_list)
+        except exceptions.VectorDBException:
+            self._invalidate_collection()
+            raise
         logger.info(f"upsert success, result: {result}")
 
+    def delete_data(self, doc_id_list: list[str]) -> None:
+        """delete documents of doc_id_list from collection"""
+
+        if len(doc_id_list) == 0:
+            return
+
+        coll = self._get_collection()
+        try:
+            result = coll.delete(document_ids=doc_id_list)
+        except exceptions.VectorDBException:
+            self._invalidate_collection()
+            raise
+        logger.info(f"delete success, result: {result}")
+
     def search(
         self,
         vector: list[float],
         top_k: int = 10,
         retrieve_vector: bool = False,
+        ef: int = 0,
     ) -> list[dict]:
-        """search using vector"""
+        """search using vector, ef is VDB_SEARCH_EF if 0"""
+
+        # search vectors only one item, get first result
+        return self.search_batch([vector], top_k, retrieve_vector, ef)[0]
+
+    def search_batch(
+        self,
+        vectors: list[list[float]],
+        top_k: int = 10,
+        retrieve_vector: bool = False,
+        ef: int = 0,
+    ) -> list[list[dict]]:
+        """search using vectors, SEARCH_BATCH_SIZE vectors a call
+
+        Args:
+            vectors (list[list[float]]): query vectors
+            top_k (int, optional): documents of each vector. Defaults to 10.
+            retrieve_vector (bool, optional): return vector of documents.
+            Defaults to False.
+            ef (int, optional): candidates examined by HNSW search,
+            VDB_SEARCH_EF if 0, at least top_k. Defaults to 0.
+
+        Returns:
+            list[list[dict]]: documents of each vector in the same order
+        """
 
         # 获取 Collection 对象
-        db = self._client.database(self._database)
-        coll = db.collection(self.collection)
+        coll = self._get_collection()
 
         # search
         # 1. search 提供按照 vector 搜索的能力
         # 其他选项类似 search 接口
 
         # 批量相似性查询，根据指定的多个向量查找多个 Top K 个相似性结果
-        doc_list = coll.search(
-            vectors=[vector],  # 指定检索向量，最多指定20个
-            params=SearchParams(
-                ef=200
-            ),  # 若使用HNSW索引，则需要指定参数ef，ef越大，召回率越高，但也会影响检索速度
-            retrieve_vector=retrieve_vector,
-            limit=top_k,
-        )
+        # shared layout only searches documents of the file
+        file_filter = self._get_file_filter()
+        doc_lists: list[list[dict]] = []
+        for i in range(0, len(vectors), VDB.SEARCH_BATCH_SIZE):
+            batch = vectors[i : i + VDB.SEARCH_BATCH_SIZE]
+            try:
+                result = coll.search(
+                    vectors=batch,  # 指定检索向量，最多指定20个
+                    filter=file_filter,
+                    params=SearchParams(
+                        ef=max(ef or VDB.VDB_SEARCH_EF, top_k)
+                    ),  # 若使用HNSW索引，则需要指定参数ef，ef越大，召回率越高，但也会影响检索速度
+                    retrieve_vector=retrieve_vector,
+                    limit=top_k,
+                )
+            except exceptions.VectorDBException:
+                self._invalidate_collection()
+                raise
+
+            # empty result if nothing found
+            result = list(result or [])
+            result += [[] for _ in range(len(batch) - len(result))]
+            doc_lists.extend(result)
 
-        if len(doc_list) == 0:
+        if any(len(doc_list) == 0 for doc_list in doc_lists):
             logger.warning("doc_list is empty")
-            return doc_list
+        return doc_lists
 
-        # search vectors only one item, get first result
-        return doc_list[0]
+    def query_data(self, offset: int, limit: int) -> list[dict]:
+        """return documents of collection with vector, by page
+
+        Args:
+            offset (int): documents to skip
+            limit (int): max documents to return
+        """
+
+        coll = self._get_collection()
+        try:
+            return coll.query(
+                retrieve_vector=True,
+                limit=limit,
+                offset=offset,
+                filter=self._get_file_filter(),
+            )
+        except exceptions.VectorDBException:
+            self._invalidate_collection()
+            raise
+
+    def get_vectors(self, doc_id_list: list[str]) -> dict[str, list[float]]:
+        """return vectors of documents of doc_id_list,
+        documents not existed are missing"""
+
+        if len(doc_id_list) == 0:
+            return {}
+
+        coll = self._get_collection()
+        try:
+            doc_list = coll.query(
+                document_ids=doc_id_list,
+                retrieve_vector=True,
+                output_fields=["id"],
+                filter=self._get_file_filter(),
+            )
+        except exceptions.VectorDBException:
+            self._invalidate_collection()
+            raise
+        return {doc["id"]: doc["vector"] for doc in doc_list}
+
+    def list_document_ids(self, page_size: int = 100) -> list[str]:
+        """return ids of all documents of collection, without vectors
+
+        Args:
+            page_size (int, optional): documents a request. Defaults to 100.
+        """
+
+        coll = self._get_collection()
+        doc_id_list: list[str] = []
+        try:
+            while True:
+                doc_list = coll.query(
+                    retrieve_vector=False,
+                    limit=page_size,
+                    offset=len(doc_id_list),
+                    output_fields=["id"],
+                    filter=self._get_file_filter(),
+                )
+                doc_id_list.extend(doc["id"] for doc in doc_list)
+                if len(doc_list) < page_size:
+                    return doc_id_list
+        except exceptions.VectorDBException:
+            self._invalidate_collection()
+            raise
+
+    def count(self) -> int:
+        """return document count of collection"""
+
+        coll = self._get_collection()
+        try:
+            return coll.count(filter=self._get_file_filter())
+        except exceptions.VectorDBException:
+            self._invalidate_collection()
+            raise
+
+    def list_collections(self) -> list[str]:
+        """return names of all collections of database"""
+
+        db = self.is_db_existed()
+        if db is None:
+            return []
+        return [coll.collection_name for coll in db.list_collections()]
+
+    def drop_collection(self) -> None:
+        """drop collection, for shared layout, delete documents of
+        collection from the shared collection"""
+
+        try:
+            if self._is_shared():
+                result = self._get_collection().delete(
+                    filter=self._get_file_filter()
+                )
+            else:
+                db = self._get_or_create_db()
+                result = db.drop_collection(self.collection)
+        finally:
+            self._invalidate_collection()
+        logger.info(f"{self.collection} drop collection success, {result}")
 
     @classmethod
     def get_list_without_content(cls, doc_list: list[dict]) -> list[dict]:
@@ -0,0 +1,207 @@
+"""write-behind buffer for vector db"""
+
+import os
+import time
+import queue
+import threading
+from typing import Callable
+from loguru import logger
+from tcvectordb.model.document import Document
+from app.helper.retry import retry
+from app.vectordb.vectordb import VDB
+
+_CLOSE = object()
+"""sentinel to stop the flush thread"""
+
+_PUT_POLL_INTERVAL = 0.5
+"""seconds between checks the flush thread alive while buffer is full"""
+
+
+# pylint: disable=too-many-instance-attributes
+class VDBWriteBuffer:
+    """Write-behind buffer for vector db
+
+    Documents added are upserted in batches by a background thread,
+    a batch is flushed once it reaches flush_size documents or the first
+    document in it waited for flush_interval seconds.
+    add will block if max_pending documents are waiting, which slow down
+    the producer when vector db is the bottleneck.
+    """
+
+    VDB_FLUSH_SIZE = int(os.getenv("VDB_FLUSH_SIZE", "100"))
+    """max document count of one upsert"""
+
+    VDB_FLUSH_INTERVAL = float(os.getenv("VDB_FLUSH_INTERVAL", "1"))
+    """max seconds a document wait in buffer before flush"""
+
+    VDB_MAX_PENDING = int(os.getenv("VDB_MAX_PENDING", "500"))
+    """max document count waiting in buffer"""
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        vdb: VDB,
+        on_flush: Callable[[list[Document]], None] | None = None,
+        flush_size: int = VDB_FLUSH_SIZE,
+        flush_interval: float = VDB_FLUSH_INTERVAL,
+        max_pending: int = VDB_MAX_PENDING,
+    ) -> None:
+        """init buffer and start the flush thread
+
+        Args:
+            vdb (VDB): vector db with collection set
+            on_flush (Callable[[list[Document]], None], optional): called
+            with documents after each success flush. Defaults to None.
+            flush_size (int, optional): Defaults to VDB_FLUSH_SIZE.
+            flush_interval (float, optional): Defaults to VDB_FLUSH_INTERVAL.
+            max_pending (int, optional): Defaults to VDB_MAX_PENDING.
+        """
+
+        self._vdb = vdb
+        self._on_flush = on_flush
+        self._flush_size = max(1, flush_size)
+        self._flush_interval = flush_interval
+        self._queue: queue.Queue = queue.Queue(maxsize=max(1, max_pending))
+        self._error: Exception | None = None
+        self._closed = False
+
+        self._thread = threading.Thread(
+            target=self._run, name="vdb-write-buffer", daemon=True
+        )
+        self._thread.start()
+
+    def __enter__(self) -> "VDBWriteBuffer":
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb) -> None:
+        # don't hide the exception raised in with block
+        self.close(raise_error=exc_type is None)
+
+    @property
+    def queue_depth(self) -> int:
+        """document count waiting in buffer"""
+
+        return self._queue.qsize()
+
+    def add(self, document_list: list[Document]) -> None:
+        """add documents to buffer, block if buffer is full
+
+        Raises:
+            ValueError: if buffer is closed
+            RuntimeError: if the flush thread stopped
+            Exception: the error of a previous flush
+        """
+
+        if self._closed:
+            msg = "add document to closed write buffer"
+            logger.error(msg)
+            raise ValueError(msg)
+
+        for doc in document_list:
+            self._raise_error()
+            if not self._put(doc):
+                self._raise_error()
+                msg = "write buffer flush thread stopped"
+                logger.error(msg)
+                raise RuntimeError(msg)
+
+    def close(self, raise_error: bool = True) -> None:
+        """flush remaining documents and stop the flush thread
+
+        Args:
+            raise_error (bool, optional): raise the error of flush.
+            Defaults to True.
+        """
+
+        if not self._closed:
+            self._closed = True
+            if self._put(_CLOSE):
+                self._thread.join()
+
+        if raise_error:
+            self._raise_error()
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            raise self._error
+
+    def _put(self, item) -> bool:
+        """put item into queue, block while buffer is full
+
+        Returns:
+            bool: False if the flush thread stopped, item is not put
+        """
+
+        while self._thread.is_alive():
+            try:
+                self._queue.put(item, timeout=_PUT_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    # pylint: disable=broad-exception-caught
+    def _run(self) -> None:
+        try:
+            self._drain()
+        except Exception as e:
+            logger.error(f"write buffer flush thread stopped, e: {e}")
+            self._error = e
+
+    def _drain(self) -> None:
+        pending: list[Document] = []
+        deadline = 0.0
+
+        while True:
+            timeout = None
+            if len(pending) > 0:
+                timeout = max(0.0, deadline - time.monotonic())
+
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is _CLOSE:
+                self._flush(pending)
+                return
+
+            if item is not None:
+                if len(pending) == 0:
+                    deadline = time.monotonic() + self._flush_interval
+                pending.append(item)
+
+            if len(pending) >= self._flush_size or time.monotonic() >= deadline:
+                self._flush(pending)
+                pending = []
+
+    # pylint: disable=broad-exception-caught
+    def _flush(self, pending: list[Document]) -> None:
+        if len(pending) == 0:
+            return
+
+        if self._error is not None:
+            # keep draining so that producer will not block forever
+            logger.warning(f"discard {len(pending)} documents after error")
+            return
+
+        try:
+            retry(self._vdb.upsert_data, pending)
+        except Exception as e:
+            logger.error(f"flush write buffer failed, e: {e}")
+            self._error = e
+            return
+
+        logger.info(
+            f"flush write buffer success, len: {len(pending)}"
+            f", queue_depth: {self.queue_depth}"
+        )
+        if self._on_flush is None:
+            return
+
+        try:
+            self._on_flush(pending)
+        except Exception as e:
+            # documents after are discarded, so that on_flush never skips
+            logger.error(f"on_flush of write buffer failed, e: {e}")
+            self._error = e